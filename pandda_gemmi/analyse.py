@@ -32,6 +32,7 @@ from pandda_gemmi.dataset import (
 from pandda_gemmi.edalignment import (GetGrid, GetAlignments,
                                       LoadXmap, LoadXmapFlat
                                       )
+from pandda_gemmi.model import GetSigmaSMBisect, GetSigmaSMNewton, GetSigmaSMRoot
 from pandda_gemmi.filters import (
     FiltersDataQuality,
     FiltersReferenceCompatibility,
@@ -46,7 +47,7 @@ from pandda_gemmi.filters import (
 from pandda_gemmi.comparators import (
     GetComparatorsHybrid, GetComparatorsHighResFirst, GetComparatorsHighResRandom, GetComparatorsHighRes,
     GetComparatorsCluster)
-from pandda_gemmi.shells import get_shells_multiple_models
+from pandda_gemmi.shells import get_shells_multiple_models, get_shell_groups, get_shell_working_resolutions
 from pandda_gemmi.logs import (
     save_json_log,
 )
@@ -146,6 +147,8 @@ def get_comparator_func(pandda_args: PanDDAArgs,
             load_xmap_flat_func=load_xmap_flat_func,
             process_local=process_local,
             debug=pandda_args.debug,
+            batch_size=pandda_args.comparison_batch_size,
+            max_batch_memory=pandda_args.comparison_max_batch_memory,
         )
 
     elif pandda_args.comparison_strategy == "hybrid":
@@ -158,6 +161,8 @@ def get_comparator_func(pandda_args: PanDDAArgs,
             load_xmap_flat_func=load_xmap_flat_func,
             process_local=process_local,
             debug=pandda_args.debug,
+            batch_size=pandda_args.comparison_batch_size,
+            max_batch_memory=pandda_args.comparison_max_batch_memory,
         )
 
     else:
@@ -264,16 +269,36 @@ def get_smooth_func(pandda_args: PanDDAArgs) -> SmoothBFactorsInterface:
     return smooth_func
 
 
+def get_xmap_cache_dir(pandda_args) -> Optional[Path]:
+    # Grouped shells share their xmaps through the cache, so one is always used when shells are grouped
+    if (not pandda_args.xmap_cache_dir) and (pandda_args.shell_grouping_resolution > 0):
+        return pandda_args.out_dir / constants.PANDDA_XMAP_CACHE_DIR
+    return pandda_args.xmap_cache_dir
+
+
 def get_load_xmap_func(pandda_args) -> LoadXMapInterface:
-    load_xmap_func = LoadXmap()
+    load_xmap_func = LoadXmap(get_xmap_cache_dir(pandda_args))
     return load_xmap_func
 
 
 def get_load_xmap_flat_func(pandda_args) -> LoadXMapFlatInterface:
-    load_xmap_flat_func = LoadXmapFlat()
+    load_xmap_flat_func = LoadXmapFlat(get_xmap_cache_dir(pandda_args))
     return load_xmap_flat_func
 
 
+def get_sigma_s_m_func(pandda_args) -> GetSigmaSMInterface:
+    if pandda_args.sigma_s_m_engine == "bisect":
+        sigma_s_m_func = GetSigmaSMBisect()
+    elif pandda_args.sigma_s_m_engine == "newton":
+        sigma_s_m_func = GetSigmaSMNewton()
+    elif pandda_args.sigma_s_m_engine == "root":
+        sigma_s_m_func = GetSigmaSMRoot()
+    else:
+        raise Exception(f"No sigma_s_m engine named: {pandda_args.sigma_s_m_engine}")
+
+    return sigma_s_m_func
+
+
 def get_analyse_model_func(pandda_args):
     analyse_model_func = analyse_model
     return analyse_model_func
@@ -322,7 +347,7 @@ def get_filter_reference_compatability(
 
 def get_score_events_func(pandda_args: PanDDAArgs) -> GetEventScoreInterface:
     if pandda_args.event_score == "inbuilt":
-        return GetEventScoreInbuilt()
+        return GetEventScoreInbuilt(pandda_args.conformer_cache_dir, pandda_args.event_fit_num_threads)
     elif pandda_args.event_score == "size":
         return GetEventScoreSize()
 
@@ -369,6 +394,9 @@ def process_pandda(pandda_args: PanDDAArgs, ):
     load_xmap_func: LoadXMapInterface = get_load_xmap_func(pandda_args)
     load_xmap_flat_func: LoadXMapFlatInterface = get_load_xmap_flat_func(pandda_args)
 
+    # Get the pointwise variance solver
+    sigma_s_m_func: GetSigmaSMInterface = get_sigma_s_m_func(pandda_args)
+
     # Get the Smile generating function
     get_dataset_smiles: GetDatasetSmilesInterface = GetDatasetSmiles()
 
@@ -463,7 +491,10 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         ###################################################################
         # Get datasets
         console.start_load_datasets()
-        datasets_initial: DatasetsInterface = GetDatasets()(pandda_fs_model, )
+        get_datasets = GetDatasets(pandda_args.local_cpus, pandda_args.lazy_load, pandda_args.metadata_index_file)
+        datasets_initial: DatasetsInterface = get_datasets(pandda_fs_model, )
+        pandda_log[constants.LOG_DATASET_LOAD_TIMES] = {
+            str(dtag.dtag): timings for dtag, timings in get_datasets.timings.items()}
         datasets_statistics: DatasetsStatisticsInterface = DatasetsStatistics(datasets_initial)
         console.summarise_datasets(datasets_initial, datasets_statistics)
 
@@ -607,6 +638,10 @@ def process_pandda(pandda_args: PanDDAArgs, ):
 
         console.summarise_get_grid(grid)
 
+        # Protein masks for event scoring only depend on the reference and grid
+        if score_events_func.tag == "inbuilt":
+            score_events_func.get_protein_masks(reference, grid)
+
         ###################################################################
         # # Getting alignments
         ###################################################################
@@ -699,6 +734,19 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         #         pandda_args.only_datasets,
         #
         #     )
+        if pandda_args.shell_grouping_resolution > 0:
+            shell_groups = get_shell_groups(shells, datasets, pandda_args.shell_grouping_resolution)
+            shell_working_resolutions = get_shell_working_resolutions(shells, datasets, shell_groups)
+
+            # Order the shells by group so that later shells in a group find their xmaps in the cache
+            shells = {res: shells[res] for group in shell_groups for res in group}
+            if pandda_args.debug >= Debug.PRINT_SUMMARIES:
+                print(f'Grouped {len(shells)} shells into {len(shell_groups)} groups')
+                for group in shell_groups:
+                    print(f'\tShells: {group}: working resolution: {shell_working_resolutions[group[0]]}')
+        else:
+            shell_working_resolutions = {res: None for res in shells}
+
         pandda_fs_model.shell_dirs = GetShellDirs()(pandda_fs_model.pandda_dir, shells)
         pandda_fs_model.shell_dirs.build()
 
@@ -750,6 +798,8 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                                 analyse_model_func=analyse_model_func,
                                 score_events_func=score_events_func,
                                 debug=pandda_args.debug,
+                                sigma_s_m_func=sigma_s_m_func,
+                                working_resolution=shell_working_resolutions[res],
                             )
                             for res, shell
                             in shells.items()
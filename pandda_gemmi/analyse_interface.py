@@ -41,6 +41,12 @@ class ProcessorInterface(Protocol):
     def __call__(self, funcs: Iterable[Callable[P, V]]) -> List[V]:
         ...
 
+    def iterate(self,
+                funcs: Mapping[Hashable, Callable[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        ...
+
 
 class ResidueIDInterface(Protocol):
     model: str
@@ -72,9 +78,15 @@ class ModelIDInterface(Protocol):
 
 
 class ModelInterface(Protocol):
-    mean: NDArrayInterface
+    mean_flat: NDArrayInterface
     sigma_is: Dict[DtagInterface, float]
-    sigma_s_m: NDArrayInterface
+    sigma_s_m_flat: NDArrayInterface
+
+    def get_mean_array(self, grid: GridInterface) -> NDArrayInterface:
+        ...
+
+    def get_sigma_s_m_array(self, grid: GridInterface) -> NDArrayInterface:
+        ...
 
 
 ModelsInterface = MutableMapping[ModelIDInterface, ModelInterface]
@@ -235,6 +247,9 @@ class StructureInterface(Protocol):
     def protein_atoms(self) -> Iterator[AtomInterface]:
         ...
 
+    def chains(self) -> List[str]:
+        ...
+
 
 class ResolutionInterface(Protocol):
     ...
@@ -244,6 +259,12 @@ class ReflectionsInterface(Protocol):
     def get_resolution(self) -> float:
         ...
 
+    def get_cell(self) -> gemmi.UnitCell:
+        ...
+
+    def get_spacegroup_hm(self) -> str:
+        ...
+
     def transform_f_phi_to_map(self, f: str, phi: str, sample_rate: float) -> CrystallographicGridInterface:
         ...
 
@@ -323,9 +344,12 @@ AlignmentsInterface = Dict[DtagInterface, AlignmentInterface]
 
 
 class ZmapInterface(Protocol):
-    zmap: CrystallographicGridInterface
+    zmap_flat: NDArrayInterface
 
-    def to_array(self, copy=True) -> NDArrayInterface:
+    def get_grid(self, grid: GridInterface) -> CrystallographicGridInterface:
+        ...
+
+    def to_array(self, grid: GridInterface) -> NDArrayInterface:
         ...
 
 
@@ -651,6 +675,18 @@ class LoadXMapFlatInterface(Protocol):
         ...
 
 
+class GetSigmaSMInterface(Protocol):
+    tag: Literal["bisect", "newton", "root"]
+
+    def __call__(self,
+                 mean: NDArrayInterface,
+                 arrays: NDArrayInterface,
+                 sigma_is_array: NDArrayInterface,
+                 process_local: Optional[ProcessorInterface] = None,
+                 ) -> NDArrayInterface:
+        ...
+
+
 class AnalyseModelInterface(Protocol):
     def __call__(self,
                  model: ModelInterface,
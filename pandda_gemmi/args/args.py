@@ -56,6 +56,8 @@ class PanDDAArgs:
     clustering_cutoff: float = 1.5
     cluster_cutoff_distance_multiplier: float = 1.0
     event_score: str = constants.ARGS_EVENT_SCORE_DEFAULT
+    conformer_cache_dir: Optional[Path] = None
+    event_fit_num_threads: int = constants.ARGS_EVENT_FIT_NUM_THREADS_DEFAULT
     max_site_distance_cutoff: float = constants.ARGS_MAX_SITE_DISTANCE_CUTOFF_DEFAULT
     min_bdc: float = constants.ARGS_MIN_BDC_DEFAULT
     max_bdc: float = constants.ARGS_MAX_BDC_DEFAULT
@@ -65,11 +67,18 @@ class PanDDAArgs:
     comparison_res_cutoff: float = 0.5
     comparison_min_comparators: int = 30
     comparison_max_comparators: int = 30
+    comparison_batch_size: int = constants.ARGS_COMPARISON_BATCH_SIZE_DEFAULT
+    comparison_max_batch_memory: Optional[float] = None
     known_apos: Optional[List[str]] = None
     exclude_local: int = 5
     cluster_selection: str = "close"
     local_processing: str = constants.ARGS_LOCAL_PROCESSING_DEFAULT
     local_cpus: int = constants.ARGS_LOCAL_CPUS_DEFAULT
+    lazy_load: bool = False
+    metadata_index_file: Optional[Path] = None
+    sigma_s_m_engine: str = constants.ARGS_SIGMA_S_M_ENGINE_DEFAULT
+    xmap_cache_dir: Optional[Path] = None
+    shell_grouping_resolution: float = 0.0
     global_processing: str = constants.ARGS_GLOBAL_PROCESSING_DEFAULT
     memory_availability: str = constants.ARGS_MEMORY_AVAILABILITY_DEFAULT
     job_params_file: Optional[str] = None
@@ -167,12 +176,42 @@ class PanDDAArgs:
             default=constants.ARGS_LOCAL_CPUS_DEFAULT,
             help=constants.ARGS_LOCAL_CPUS_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_LAZY_LOAD,
+            type=lambda x: bool(strtobool(x)),
+            default=False,
+            help=constants.ARGS_LAZY_LOAD_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_METADATA_INDEX_FILE,
+            type=Path,
+            default=None,
+            help=constants.ARGS_METADATA_INDEX_FILE_HELP,
+        )
         parser.add_argument(
             constants.ARGS_GLOBAL_PROCESSING,
             type=str,
             default=constants.ARGS_GLOBAL_PROCESSING_DEFAULT,
             help=constants.ARGS_GLOBAL_PROCESSING_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_SIGMA_S_M_ENGINE,
+            type=str,
+            default=constants.ARGS_SIGMA_S_M_ENGINE_DEFAULT,
+            help=constants.ARGS_SIGMA_S_M_ENGINE_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_XMAP_CACHE_DIR,
+            type=Path,
+            default=None,
+            help=constants.ARGS_XMAP_CACHE_DIR_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_SHELL_GROUPING_RESOLUTION,
+            type=float,
+            default=0.0,
+            help=constants.ARGS_SHELL_GROUPING_RESOLUTION_HELP,
+        )
         parser.add_argument(
             constants.ARGS_MEMORY_AVAILABILITY,
             type=str,
@@ -366,6 +405,18 @@ class PanDDAArgs:
             default=30,
             help=constants.ARGS_COMPARISON_MAX_COMPARATORS_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_COMPARISON_BATCH_SIZE,
+            type=int,
+            default=constants.ARGS_COMPARISON_BATCH_SIZE_DEFAULT,
+            help=constants.ARGS_COMPARISON_BATCH_SIZE_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_COMPARISON_MAX_BATCH_MEMORY,
+            type=float,
+            default=None,
+            help=constants.ARGS_COMPARISON_MAX_BATCH_MEMORY_HELP,
+        )
         parser.add_argument(
             constants.ARGS_KNOWN_APOS,
             type=list,
@@ -543,6 +594,18 @@ class PanDDAArgs:
             default=constants.ARGS_EVENT_SCORE_DEFAULT,
             help=constants.ARGS_EVENT_SCORE_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_CONFORMER_CACHE_DIR,
+            type=Path,
+            default=None,
+            help=constants.ARGS_CONFORMER_CACHE_DIR_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_EVENT_FIT_NUM_THREADS,
+            type=int,
+            default=constants.ARGS_EVENT_FIT_NUM_THREADS_DEFAULT,
+            help=constants.ARGS_EVENT_FIT_NUM_THREADS_HELP,
+        )
 
         # Site finding options
         parser.add_argument(
@@ -676,6 +739,8 @@ class PanDDAArgs:
             clustering_cutoff=args.clustering_cutoff,
             cluster_cutoff_distance_multiplier=args.cluster_cutoff_distance_multiplier,
             event_score=args.event_score,
+            conformer_cache_dir=args.conformer_cache_dir,
+            event_fit_num_threads=args.event_fit_num_threads,
             max_site_distance_cutoff=args.max_site_distance_cutoff,
             min_bdc=args.min_bdc,
             max_bdc=args.max_bdc,
@@ -685,11 +750,18 @@ class PanDDAArgs:
             comparison_res_cutoff=args.comparison_res_cutoff,
             comparison_min_comparators=args.comparison_min_comparators,
             comparison_max_comparators=args.comparison_max_comparators,
+            comparison_batch_size=args.comparison_batch_size,
+            comparison_max_batch_memory=args.comparison_max_batch_memory,
             known_apos=args.known_apos,
             exclude_local=args.exclude_local,
             cluster_selection=args.cluster_selection,
             local_processing=args.local_processing,
             local_cpus=args.local_cpus,
+            lazy_load=args.lazy_load,
+            metadata_index_file=args.metadata_index_file,
+            sigma_s_m_engine=args.sigma_s_m_engine,
+            xmap_cache_dir=args.xmap_cache_dir,
+            shell_grouping_resolution=args.shell_grouping_resolution,
             global_processing=args.global_processing,
             memory_availability=args.memory_availability,
             job_params_file=args.job_params_file,
@@ -26,6 +26,7 @@ from pandda_gemmi.dataset import (StructureFactors, Structure, Reflections, Data
 # from pandda_gemmi.shells import Shell
 # from pandda_gemmi.edalignment import Alignment, Alignments, Transform, Grid, Partitioning, Xmap
 # from pandda_gemmi.model import Zmap, Model
+from pandda_gemmi.common import get_points_around
 from pandda_gemmi.event import Event
 from pandda_gemmi.scoring.scoring import event_map_to_contour_score_map, score_structure_contour
 from pandda_gemmi.autobuild.cif import generate_cif, generate_cif_grade, generate_cif_grade2
@@ -158,17 +159,13 @@ def get_cut_out_event_map(
     # print(f"Spacegroup: {mask_grid.spacegroup.xhm()}")
     # mask_grid.spacegroup = gemmi.find_spacegroup_by_name("P 21 21 21")  #  gemmi.find_spacegroup_by_name("P 1")#event_map.spacegroup
     mask_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")  # event_map.spacegroup
-    mask_grid_array = np.array(mask_grid)
+    mask_grid_array = np.array(mask_grid, copy=False)
 
     # print(f"Grid size: {mask_grid.size}")
     mask_grid.set_unit_cell(event_map.unit_cell)
 
-    for position_python in coords:
-        position = gemmi.Position(*position_python)
-        mask_grid.set_points_around(position,
-                                    radius=radius,
-                                    value=1,
-                                    )
+    if len(coords) > 0:
+        mask_grid_array[get_points_around(mask_grid_array.shape, event_map.unit_cell, np.array(coords), radius)] = 1
     mask_grid.symmetrize_max()
 
     mask_array = np.array(mask_grid, copy=False, dtype=np.int8)
@@ -50,8 +50,8 @@ def get_index_dict(grid: Grid):
 
     index_array_dict = {}
 
-    for resid, index_to_pos in partitioning.partitioning.items():
-        index_array = np.vstack([np.array(indexes).reshape((1, 3)) for indexes in index_to_pos.keys()])
+    for resid in partitioning:
+        index_array = partitioning.get_points(resid)
 
         index_tuples = (index_array[:, 0], index_array[:, 1], index_array[:, 2])
 
@@ -3,5 +3,7 @@ from pandda_gemmi.common.event_id import EventID, EventIDX, ClusterID
 from pandda_gemmi.common.site_id import SiteID
 from pandda_gemmi.common.delayed import delayed, DelayedFuncReady, DelayedFuncWaiting
 from pandda_gemmi.common.positions_array import PositionsArray
+from pandda_gemmi.common.coordinates import (fractional_to_orthogonal, orthogonal_to_fractional,
+                                             grid_coords_to_orthogonal, get_points_around)
 from pandda_gemmi.common.partial_func import Partial
 # from pandda_gemmi.common.debug import Debug
\ No newline at end of file
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import numpy as np
+import gemmi
+
+
+def get_orthogonalization_matrix(unit_cell: gemmi.UnitCell) -> np.ndarray:
+    return np.array(unit_cell.orthogonalization_matrix.tolist(), dtype=np.float64)
+
+
+def get_fractionalization_matrix(unit_cell: gemmi.UnitCell) -> np.ndarray:
+    return np.array(unit_cell.fractionalization_matrix.tolist(), dtype=np.float64)
+
+
+def fractional_to_orthogonal(unit_cell: gemmi.UnitCell, fractional_array: np.ndarray) -> np.ndarray:
+    # fractional_array[n, 3] -> orthogonal[n, 3]
+    return np.asarray(fractional_array, dtype=np.float64) @ get_orthogonalization_matrix(unit_cell).T
+
+
+def orthogonal_to_fractional(unit_cell: gemmi.UnitCell, orthogonal_array: np.ndarray) -> np.ndarray:
+    # orthogonal_array[n, 3] -> fractional[n, 3]
+    return np.asarray(orthogonal_array, dtype=np.float64) @ get_fractionalization_matrix(unit_cell).T
+
+
+def grid_coords_to_orthogonal(grid: gemmi.FloatGrid, coord_array: np.ndarray) -> np.ndarray:
+    # Grid coordinates need not be inside the unit cell
+    # coord_array[n, 3] -> orthogonal[n, 3]
+    fractional_array = coord_array / np.array([grid.nu, grid.nv, grid.nw]).reshape((1, 3))
+    return fractional_to_orthogonal(grid.unit_cell, fractional_array)
+
+
+def _iround(array: np.ndarray) -> np.ndarray:
+    # Round half away from zero, as gemmi does
+    return (np.sign(array) * np.floor(np.abs(array) + 0.5)).astype(int)
+
+
+def get_points_around(shape, unit_cell: gemmi.UnitCell, orthogonal_array: np.ndarray, radius: float):
+    # Vectorised equivalent of gemmi's Grid.set_points_around over many positions: the wrapped grid indicies within
+    # radius of any position, as a tuple of three arrays
+    shape_array = np.array(shape).reshape((1, 3))
+    reciprocal_lengths = np.array([unit_cell.reciprocal().a, unit_cell.reciprocal().b, unit_cell.reciprocal().c])
+    spacing = 1.0 / (np.array(shape) * reciprocal_lengths)
+    extent = np.ceil(radius / spacing).astype(int)
+
+    offsets = np.stack(
+        np.meshgrid(
+            np.arange(-extent[0], extent[0] + 1),
+            np.arange(-extent[1], extent[1] + 1),
+            np.arange(-extent[2], extent[2] + 1),
+            indexing="ij",
+        ),
+        axis=-1,
+    ).reshape((-1, 3))  # s, 3
+
+    orthogonalization_matrix = get_orthogonalization_matrix(unit_cell)
+    fractional_array = orthogonal_to_fractional(unit_cell, orthogonal_array)  # n, 3
+    nearest_points = _iround(fractional_array * shape_array)  # n, 3
+
+    # Offsets from each position to its nearest point, and from that point to each candidate, in orthogonal space
+    position_deltas = ((fractional_array - (nearest_points / shape_array)) @ orthogonalization_matrix.T)  # n, 3
+    offset_deltas = (offsets / shape_array) @ orthogonalization_matrix.T  # s, 3
+    offset_lengths_sq = np.sum(np.square(offset_deltas), axis=-1)  # s
+
+    mask = np.zeros(shape, dtype=bool)
+    # Chunk over positions to bound the size of the n * s distance array
+    chunk_size = max(1, 2 ** 22 // offsets.shape[0])
+    for start in range(0, fractional_array.shape[0], chunk_size):
+        chunk_deltas = position_deltas[start:start + chunk_size]
+        distances_sq = (np.sum(np.square(chunk_deltas), axis=-1)[:, np.newaxis]
+                        - 2 * (chunk_deltas @ offset_deltas.T)
+                        + offset_lengths_sq[np.newaxis, :])
+        position_indexes, offset_indexes = np.nonzero(distances_sq < radius ** 2)
+        points = np.mod(nearest_points[start + position_indexes] + offsets[offset_indexes], shape_array)
+        mask[points[:, 0], points[:, 1], points[:, 2]] = True
+
+    return np.nonzero(mask)
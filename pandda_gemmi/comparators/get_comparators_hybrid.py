@@ -12,6 +12,8 @@ class GetComparatorsHybrid(GetComparatorsInterface):
                  load_xmap_flat_func,
                  process_local: ProcessorInterface,
                  debug: Debug,
+                 batch_size: int = 90,
+                 max_batch_memory: Optional[float] = None,
                  ):
         self.comparison_min_comparators = comparison_min_comparators
         self.comparison_max_comparators = comparison_max_comparators
@@ -20,6 +22,8 @@ class GetComparatorsHybrid(GetComparatorsInterface):
         self.resolution_cutoff = resolution_cutoff
         self.process_local = process_local
         self.debug = debug
+        self.batch_size = batch_size
+        self.max_batch_memory = max_batch_memory
 
     def __call__(self,
                  datasets: Dict[DtagInterface, DatasetInterface],
@@ -52,6 +56,8 @@ class GetComparatorsHybrid(GetComparatorsInterface):
             load_xmap_flat_func=self.load_xmap_flat_func,
             process_local=self.process_local,
             debug=self.debug,
+            batch_size=self.batch_size,
+            max_batch_memory=self.max_batch_memory,
         )
 
         # print(comparators_multiple)
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from typing import *
 import time
+import tempfile
 from functools import partial
 
 import dataclasses
@@ -42,15 +43,8 @@ def truncate(datasets: DatasetsInterface, resolution: ResolutionInterface, struc
     # truncate on reflections
     new_datasets_reflections = {}
     for dtag in dataset_resolution_truncated:
-        reflections = dataset_resolution_truncated[dtag].reflections.reflections
-        reflections_array = np.array(reflections)
-
-        # print(f"Truncated reflections: {dtag}")
         truncated_dataset = dataset_resolution_truncated[dtag].truncate_reflections(common_reflections,
                                                                                     )
-        reflections = truncated_dataset.reflections.reflections
-        reflections_array = np.array(reflections)
-
         new_datasets_reflections[dtag] = truncated_dataset
 
     return new_datasets_reflections
@@ -162,11 +156,14 @@ def get_reduced_array(
         dtag_list,
         load_xmap_flat_func,
 grid, structure_factors, sample_rate,
-        debug: Debug= Debug.DEFAULT
+        debug: Debug= Debug.DEFAULT,
+        batch_size: int = 90,
+        max_batch_memory: Optional[float] = None,
+        scratch_dir: Optional[Path] = None,
 ):
     # Get reduced array
     total_sample_size = len(shell_truncated_datasets)
-    batch_size = min(90, total_sample_size)
+    batch_size = min(batch_size, total_sample_size)
     num_batches = (total_sample_size // batch_size) + 1
     # batches = [
     #     np.arange(x*batch_size, min((x+1)*batch_size, total_sample_size))
@@ -186,116 +183,60 @@ grid, structure_factors, sample_rate,
             print("\t\tAll batches larger than batch size, trying smaller split!")
             continue
 
+    # Split further if a batch of maps would not fit in the memory bound (given in GB)
+    num_points = int(np.sum(grid.partitioning.total_mask == 1))
+    if max_batch_memory:
+        max_batch_size = max(1, int((max_batch_memory * 1e9) // (num_points * 4)))
+        if max(len(batch) for batch in batches) > max_batch_size:
+            batches = np.array_split(np.arange(total_sample_size), int(np.ceil(total_sample_size / max_batch_size)))
+
     # if debug:
     #     print(f'\t\tBatches are: {batches}')
 
     from sklearn.decomposition import PCA, IncrementalPCA
-    ipca = IncrementalPCA(n_components=min(200, batch_size))
-
-    from dask.distributed import performance_report
-
-    for batch in batches:
-
-        # ms = MemorySampler()
-        # with performance_report(filename=f"collection_{batch}.html"):
-
-            # if debug:
-            #     print(f'\t\t\tProcessing batch: {batch}')
-        start = time.time()
-        # results = process_local(
-        #     [
-        #         partial(
-        #             load_xmap_paramaterised,
-        #             shell_truncated_datasets[key],
-        #             alignments[key],
-        #         )
-        #         for key
-        #         in dtag_array[batch]
-        #     ]
-        # )
-
-        results = process_local(
-            [
-                Partial(load_xmap_flat_func).paramaterise(
-                    shell_truncated_datasets[key],
-                    alignments[key],
-                    grid,
-                    structure_factors,
-                    sample_rate=sample_rate,
-                )
-                for key
-                in dtag_array[batch]
-            ]
-        )
-
-
-
-        # Get the maps as arrays
-        xmaps = {dtag: xmap
-                 for dtag, xmap
-                 in zip(dtag_list, results)
-                 }
-
-        finish = time.time()
-        if debug >= Debug.PRINT_SUMMARIES:
-            # print(f'\t\t\tProcessing batch: {batch} in {finish - start}')
-            print(f'\t\t\tProcessing batch in {finish - start}')
-
-
-        # Get pca
-        xmap_array = np.vstack([xmap for xmap in xmaps.values()])
-        ipca.partial_fit(xmap_array)
-
-        # ax = ms.plot(align=True)
-        # f = plt.figure()
-        # f.axes.append(ax)
-        # f.savefig(f"{batch}.png")
-        # plt.close('all')
-
-
-    # Transform
-    transformed_arrays = []
-    for batch in batches:
-        start = time.time()
-        # results = process_local(
-        #     [
-        #         Partial(
-        #             load_xmap_paramaterised,
-        #             shell_truncated_datasets[key],
-        #             alignments[key],
-        #         )
-        #         for key
-        #         in dtag_array[batch]
-        #     ]
-        # )
-        results = process_local(
-            [
-                Partial(
-                    load_xmap_flat_func).paramaterise(
-                    shell_truncated_datasets[key],
-                    alignments[key],
-                    grid,
-                    structure_factors,
-                    sample_rate=sample_rate,
-                )
-                for key
-                in dtag_array[batch]
-            ]
+    ipca = IncrementalPCA(n_components=min(200, batch_size, min(len(batch) for batch in batches)))
+
+    # Maps are generated once, fitted and kept in a scratch memmap so that the transform does not regenerate them
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp_dir:
+        scratch_array = np.lib.format.open_memmap(
+            str(Path(tmp_dir) / "reduction_scratch.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(total_sample_size, num_points),
         )
 
-        # Get the maps as arrays
-        xmaps = {dtag: xmap
-                 for dtag, xmap
-                 in zip(dtag_list, results)
-                 }
-
-        finish = time.time()
-        if debug >= Debug.PRINT_SUMMARIES:
-            # print(f'\t\t\tProcessing batch: {batch} in {finish - start}')
-            print(f'\t\t\tProcessing batch for transform in {finish - start}')
-        # Get pca
-        xmap_array = np.vstack([xmap for xmap in xmaps.values()])
-        transformed_arrays.append(ipca.transform(xmap_array))
+        for batch in batches:
+            start = time.time()
+            results = process_local(
+                [
+                    Partial(load_xmap_flat_func).paramaterise(
+                        shell_truncated_datasets[key],
+                        alignments[key],
+                        grid,
+                        structure_factors,
+                        sample_rate=sample_rate,
+                    )
+                    for key
+                    in dtag_array[batch]
+                ]
+            )
+
+            for index, xmap in zip(batch, results):
+                scratch_array[index, :] = xmap
+
+            finish = time.time()
+            if debug >= Debug.PRINT_SUMMARIES:
+                print(f'\t\t\tProcessing batch in {finish - start}')
+
+            # Get pca
+            ipca.partial_fit(scratch_array[batch[0]:batch[-1] + 1])
+
+        # Transform
+        transformed_arrays = []
+        for batch in batches:
+            transformed_arrays.append(ipca.transform(scratch_array[batch[0]:batch[-1] + 1]))
+
+        del scratch_array
 
     reduced_array = np.vstack(transformed_arrays)
     return reduced_array
@@ -370,6 +311,8 @@ def get_multiple_comparator_sets(
         process_local=None,
         max_comparator_sets=None,
         debug: Debug=Debug.DEFAULT,
+        batch_size: int = 90,
+        max_batch_memory: Optional[float] = None,
 ) -> Dict[int, ComparatorCluster]:
     dtag_list = [dtag for dtag in datasets]
     dtag_array = np.array(dtag_list)
@@ -445,7 +388,10 @@ def get_multiple_comparator_sets(
         characterisation_dtag_list,
         load_xmap_flat_func,
         grid, structure_factors, sample_rate,
-        debug=debug
+        debug=debug,
+        batch_size=batch_size,
+        max_batch_memory=max_batch_memory,
+        scratch_dir=pandda_fs_model.pandda_dir,
     )
     if debug >= Debug.PRINT_SUMMARIES:
         print('\tLoaded in datasets and found dimension reduced feature vectors')
@@ -541,6 +487,8 @@ class GetComparatorsCluster(GetComparatorsInterface):
                  load_xmap_flat_func,
                  process_local: ProcessorInterface,
                  debug: Debug,
+                 batch_size: int = 90,
+                 max_batch_memory: Optional[float] = None,
                  ):
         self.comparison_min_comparators = comparison_min_comparators
         self.comparison_max_comparators = comparison_max_comparators
@@ -549,6 +497,8 @@ class GetComparatorsCluster(GetComparatorsInterface):
         self.resolution_cutoff = resolution_cutoff
         self.process_local = process_local
         self.debug = debug
+        self.batch_size = batch_size
+        self.max_batch_memory = max_batch_memory
 
     def __call__(self,
                  datasets: Dict[DtagInterface, DatasetInterface],
@@ -571,6 +521,8 @@ class GetComparatorsCluster(GetComparatorsInterface):
             load_xmap_flat_func=self.load_xmap_flat_func,
             process_local=self.process_local,
             debug=self.debug,
+            batch_size=self.batch_size,
+            max_batch_memory=self.max_batch_memory,
         )
 
         # print(comparators_multiple)
@@ -15,6 +15,7 @@ PANDDA_HTML_SUMMARIES_DIR = "html_summaries"
 PANDDA_PROCESSED_DATASETS_DIR = "processed_datasets"
 PANDDA_MODELLED_STRUCTURES_DIR = "modelled_structures"
 PANDDA_LIGAND_FILES_DIR = "ligand_files"
+PANDDA_XMAP_CACHE_DIR = "xmap_cache"
 PANDDA_PDB_FILE = "{}-pandda-input.pdb"
 PANDDA_MTZ_FILE = "{}-pandda-input.mtz"
 PANDDA_TEXT_LOG_FILE = "pandda_log.txt"
@@ -34,6 +35,7 @@ PANDDA_SYMMETRY_MASK_FILE = "symmetry_mask.ccp4"
 PANDDA_TOTAL_MASK_FILE = "total_mask.ccp4"
 PANDDA_MEAN_MAP_FILE = "mean_{number}_{res}.ccp4"
 PANDDA_SIGMA_S_M_FILE = "sigma_s_m_{number}_{res}.ccp4"
+PANDDA_XMAP_ARRAY_FILE = "xmap_array.npy"
 
 ###################################################################
 # # Logging constants
@@ -107,8 +109,35 @@ ARGS_LOCAL_PROCESSING_HELP = "A string from 'serial', 'joblib', 'multiprocessing
                              "workers will handle multiprocessing. If multiprocessing_forkserver, then a forkserver " \
                              "will handle multiprocessing. If multiprocessing_spawn then spaened processes will be " \
                              "used."
+ARGS_SIGMA_S_M_ENGINE = "--sigma_s_m_engine"
+ARGS_SIGMA_S_M_ENGINE_HELP = "A string from 'bisect', 'newton' or 'root' that gives how the pointwise variance " \
+                             "sigma_s_m is solved for. If bisect, then a fixed number of vectorised bisection steps " \
+                             "will be used. If newton, then a vectorised safeguarded Newton iteration will be used. " \
+                             "If root, then scipy root finding will be used for each point."
+ARGS_XMAP_CACHE_DIR = "--xmap_cache_dir"
+ARGS_XMAP_CACHE_DIR_HELP = "A path to a directory in which aligned, masked xmaps will be cached between shells and " \
+                           "runs. Entries are keyed by a hash of the reflections, alignment and grid they were " \
+                           "generated from, so the directory may be shared between runs. If not given, then xmaps " \
+                           "will not be cached."
+ARGS_SHELL_GROUPING_RESOLUTION = "--shell_grouping_resolution"
+ARGS_SHELL_GROUPING_RESOLUTION_HELP = "A float which gives how far, in angstroms, the working resolution of a shell " \
+                                      "may be coarsened to group it with others. Shells that share training " \
+                                      "datasets and whose working resolutions are within this of each other are " \
+                                      "processed at the coarsest of them, so each dataset's aligned xmap is computed " \
+                                      "once per group and shared through the xmap cache. If no --xmap_cache_dir is " \
+                                      "given, then a cache in the output directory is used. If 0, then shells are " \
+                                      "not grouped."
 ARGS_LOCAL_CPUS = "--local_cpus"
 ARGS_LOCAL_CPUS_HELP = "An integer that gives number of node-local cpus to use for multiprocessing."
+ARGS_LAZY_LOAD = "--lazy_load"
+ARGS_LAZY_LOAD_HELP = "Whether to defer parsing each dataset's pdb and mtz until they are first used. Until " \
+                      "then, filtering and dataset statistics run on metadata read from the file headers, so " \
+                      "only datasets that survive filtering are loaded in full. Datasets are always loaded " \
+                      "with --local_cpus threads."
+ARGS_METADATA_INDEX_FILE = "--metadata_index_file"
+ARGS_METADATA_INDEX_FILE_HELP = "A path to a json file in which the header metadata read with --lazy_load will be " \
+                                "cached between runs. Entries are invalidated when a file's modification time or " \
+                                "size changes. If not given, then metadata will not be cached."
 ARGS_GLOBAL_PROCESSING = "--global_processing"
 ARGS_GLOBAL_PROCESSING_HELP = "A string from 'serial' and 'distributed'. that gives how to handle processing each " \
                               "resolution shell. If serial then shells will be processed on one computer. If " \
@@ -123,7 +152,8 @@ ARGS_LOW_MEMORY_HELP = "DEPREACTED. "
 ARGS_DISTRIBUTED_SCHEDULER = "--distributed_scheduler"
 ARGS_DISTRIBUTED_SCHEDULER_HELP = "A string from 'HTCONDOR', 'PBS', 'SGE', 'SLURM' that gives the name of which " \
                                   "cluster to " \
-                                  "attempt to use for distributed computing of resolution shells."
+                                  "attempt to use for distributed computing of resolution shells. 'LOCAL' runs " \
+                                  "the SGE job scripts as local processes instead of submitting them."
 ARGS_DISTRIBUTED_QUEUE = "--distributed_queue"
 ARGS_DISTRIBUTED_QUEUE_HELP = "A string that gives the name of the SGE queue to submit shells to."
 ARGS_DISTRIBUTED_PROJECT = "--distributed_project"
@@ -187,6 +217,13 @@ ARGS_COMPARISON_MIN_COMPARATORS = "--comparison_min_comparators"
 ARGS_COMPARISON_MIN_COMPARATORS_HELP = "An integer that gives The minimum number of comparators for each dataset."
 ARGS_COMPARISON_MAX_COMPARATORS = "--comparison_max_comparators"
 ARGS_COMPARISON_MAX_COMPARATORS_HELP = "An integer that gives the maximum number of comparators for each dataset."
+ARGS_COMPARISON_BATCH_SIZE = "--comparison_batch_size"
+ARGS_COMPARISON_BATCH_SIZE_HELP = "An integer giving the minimum number of datasets whose maps are generated and " \
+                                  "reduced together when clustering datasets to find comparators."
+ARGS_COMPARISON_MAX_BATCH_MEMORY = "--comparison_max_batch_memory"
+ARGS_COMPARISON_MAX_BATCH_MEMORY_HELP = "A float giving the most memory in GB that a batch of maps may take when " \
+                                        "clustering datasets to find comparators. Batches will be split to fit " \
+                                        "within it. If not given, then batches are not bounded."
 ARGS_KNOWN_APOS = "--known_apos"
 ARGS_KNOWN_APOS_HELP = "A list of dtags which give those datasets known not to have a fragment bound."
 ARGS_EXCLUDE_LOCAL = "--exclude_local"
@@ -248,6 +285,15 @@ ARGS_CLUSTER_CUTOFF_DISTANCE_MULTIPLIER_HELP = "A float which gives what multipl
 ARGS_EVENT_SCORE = "--event_score"
 ARGS_EVENT_SCORE_HELP = "Method to score events: either inbuilt or size"
 ARGS_EVENT_SCORE_DEFAULT = "inbuilt"
+ARGS_CONFORMER_CACHE_DIR = "--conformer_cache_dir"
+ARGS_CONFORMER_CACHE_DIR_HELP = "A path to a directory in which ligand conformers generated for inbuilt event " \
+                                "scoring will be cached between runs. Entries are keyed by the canonical smiles " \
+                                "and embedding parameters. If not given, then conformers are only reused within a " \
+                                "process."
+ARGS_EVENT_FIT_NUM_THREADS = "--event_fit_num_threads"
+ARGS_EVENT_FIT_NUM_THREADS_HELP = "An integer that gives the number of threads used to run the repeated " \
+                                  "differential evolution fits of each conformer during inbuilt event scoring."
+ARGS_EVENT_FIT_NUM_THREADS_DEFAULT = 1
 ARGS_MAX_SITE_DISTANCE_CUTOFF = "--max_site_distance_cutoff"
 ARGS_MAX_SITE_DISTANCE_CUTOFF_HELP = "The maximum distance between events for them to be considered for inclusion in " \
                                      "the same site"
@@ -286,6 +332,8 @@ ARGS_MIN_CHARACTERISATION_DATASETS_DEFAULT: int = 25
 ARGS_COMPARISON_STRATEGY_DEFAULT: str = "hybrid"
 ARGS_LOCAL_PROCESSING_DEFAULT: str = "multiprocessing_spawn"
 ARGS_LOCAL_CPUS_DEFAULT: int = 6
+ARGS_COMPARISON_BATCH_SIZE_DEFAULT: int = 90
+ARGS_SIGMA_S_M_ENGINE_DEFAULT: str = "bisect"
 ARGS_MEMORY_AVAILABILITY_DEFAULT: str = "high"
 ARGS_AUTOBUILD_DEFAULT: bool = True
 ARGS_RANK_METHOD_DEFAULT: str = "event_score"
@@ -335,6 +383,7 @@ LOG_GAPS: str = "Datasets filtered for having large gaps"
 LOG_SG: str = "Datasets filtered for having a different spacegroup"
 
 LOG_DATASETS: str = "Summary of input datasets"
+LOG_DATASET_LOAD_TIMES: str = "Time taken to load each dataset's files"
 
 LOG_KNOWN_APOS: str = "Known apo dtags"
 
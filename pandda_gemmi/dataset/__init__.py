@@ -1,4 +1,5 @@
-from pandda_gemmi.dataset.dataset import (Structure, Dataset, Datasets, StructureFactors, Reflections, ResidueID,
+from pandda_gemmi.dataset.dataset import (Structure, Dataset, Datasets, StructureFactors, Reflections, LazyReflections, ResidueID,
+                                          LazyStructure,
                                           Resolution, Reference, Symops, smooth,
                                           #smooth_ray,
                                           drop_columns, SmoothBFactors, GetDatasets, GetReferenceDataset)
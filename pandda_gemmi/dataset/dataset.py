@@ -1,13 +1,15 @@
 from __future__ import annotations
 
+import time
 import typing
 from typing import Tuple
 import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from functools import partial
 
 import scipy
-from scipy import spatial
+from scipy import spatial, optimize
 from joblib.externals.loky import set_loky_pickler
 
 set_loky_pickler('pickle')
@@ -22,6 +24,7 @@ from pandda_gemmi.constants import *
 from pandda_gemmi.python_types import *
 from pandda_gemmi.common import Dtag, delayed
 from pandda_gemmi.common import Partial
+from pandda_gemmi.dataset.metadata import MtzMetadata, PdbMetadata, MetadataIndex
 
 
 # from pandda_gemmi.fs import PanDDAFSModel
@@ -103,6 +106,9 @@ class Structure:
     def rfree(self):
         return RFree.from_structure(self)
 
+    def chains(self) -> typing.List[str]:
+        return [chain.name for model in self.structure for chain in model]
+
     def __getitem__(self, item: ResidueID):
         return self.structure[item.model][item.chain][item.insertion]
 
@@ -305,6 +311,48 @@ class Structure:
         self.path = path
 
 
+class LazyStructure(Structure):
+    # The pdb is only parsed when the structure is first accessed. Until then, header metadata answers what it can
+    def __init__(self, path: Path, metadata: typing.Optional[PdbMetadata] = None):
+        self.path = path
+        self.metadata = metadata
+
+    def __getattr__(self, item):
+        if item != "structure":
+            raise AttributeError(item)
+        self.structure = Structure.from_file(self.path).structure
+        return self.structure
+
+    def is_loaded(self) -> bool:
+        return "structure" in self.__dict__
+
+    def rfree(self):
+        if self.metadata and (self.metadata.rfree is not None) and not self.is_loaded():
+            return RFree(self.metadata.rfree)
+        return super().rfree()
+
+    def chains(self) -> typing.List[str]:
+        if self.metadata and not self.is_loaded():
+            return self.metadata.chains
+        return super().chains()
+
+    def __repr__(self):
+        return f"LazyStructure(path={self.path})"
+
+    def __getstate__(self):
+        if not self.is_loaded():
+            return (None, self.path, self.metadata)
+        return super().__getstate__()
+
+    def __setstate__(self, data: Tuple):
+        if data[0] is None:
+            self.path = data[1]
+            self.metadata = data[2]
+        else:
+            super().__setstate__(data)
+            self.metadata = None
+
+
 @dataclasses.dataclass()
 class StructureFactors:
     f: str
@@ -334,6 +382,25 @@ class Symops:
             yield symop
 
 
+HKL_KEY_BITS = 21
+HKL_KEY_OFFSET = 2 ** 20
+
+
+def pack_hkl(hkl) -> np.ndarray:
+    # Pack miller indices into int64 keys that sort in the same order as (h, k, l) tuples
+    hkl = np.asarray(hkl, dtype=np.int64).reshape((-1, 3)) + HKL_KEY_OFFSET
+    return (hkl[:, 0] << (2 * HKL_KEY_BITS)) | (hkl[:, 1] << HKL_KEY_BITS) | hkl[:, 2]
+
+
+def unpack_hkl(keys: np.ndarray) -> np.ndarray:
+    mask = (1 << HKL_KEY_BITS) - 1
+    keys = np.asarray(keys, dtype=np.int64)
+    return np.stack(
+        [keys >> (2 * HKL_KEY_BITS), (keys >> HKL_KEY_BITS) & mask, keys & mask],
+        axis=-1,
+    ) - HKL_KEY_OFFSET
+
+
 @dataclasses.dataclass()
 class Reflections(ReflectionsInterface):
     reflections: gemmi.Mtz
@@ -357,6 +424,12 @@ class Reflections(ReflectionsInterface):
     def get_resolution(self) -> float:
         return self.reflections.resolution_high()
 
+    def get_cell(self) -> gemmi.UnitCell:
+        return self.reflections.cell
+
+    def get_spacegroup_hm(self) -> str:
+        return self.reflections.spacegroup.hm
+
     def truncate_resolution(self, resolution: Resolution) -> Reflections:
         new_reflections = gemmi.Mtz(with_base=False)
 
@@ -404,6 +477,15 @@ class Reflections(ReflectionsInterface):
 
         return Reflections(new_reflections)
 
+    def get_hkl_keys(self, structure_factors: StructureFactors, tol: typing.Optional[float] = None) -> np.ndarray:
+        # Sorted packed keys of the reflections with an observed amplitude
+        data_array = np.array(self.reflections, copy=False)
+        f_array = data_array[:, self.reflections.column_labels().index(structure_factors.f)]
+        mask = ~np.isnan(f_array)
+        if tol is not None:
+            mask &= ~(np.abs(f_array) < tol)
+        return np.unique(pack_hkl(data_array[mask, :3]))
+
     def truncate_reflections(self, index=None) -> Reflections:
         new_reflections = gemmi.Mtz(with_base=False)
 
@@ -418,34 +500,25 @@ class Reflections(ReflectionsInterface):
         for column in self.reflections.columns:
             new_reflections.add_column(column.label, column.type)
 
-        # Get data
-        data_array = np.array(self.reflections, copy=True)
-        data = pd.DataFrame(data_array,
-                            columns=self.reflections.column_labels(),
-                            )
-        data.set_index(["H", "K", "L"], inplace=True)
-        # print(data)
-        # print(self.reflections.make_miller_array().shape)
+        # Get the packed keys to keep, which may also be given as (h, k, l) tuples
+        index = np.asarray(index)
+        if index.dtype != np.int64 or index.ndim != 1:
+            index = pack_hkl(index)
 
-        # Truncate by index
-        data_indexed = data.loc[index]
-
-        # To numpy
-        data_dropped_array = data_indexed.to_numpy()
-
-        # new data
-        new_data = np.hstack([data_indexed.index.to_frame().to_numpy(),
-                              data_dropped_array,
-                              ]
-                             )
-        # print(new_data)
+        # Find the rows of the keys
+        data_array = np.array(self.reflections, copy=False)
+        keys = pack_hkl(data_array[:, :3])
+        sorter = np.argsort(keys, kind="stable")
+        positions = np.searchsorted(keys, index, sorter=sorter)
+        rows = sorter[np.minimum(positions, keys.size - 1)]
+        if not np.array_equal(keys[rows], index):
+            raise KeyError(f"Reflections to truncate to are missing from {self.path}")
 
         # Update
-        new_reflections.set_data(new_data)
+        new_reflections.set_data(data_array[rows])
 
         # Update resolution
         new_reflections.update_reso()
-        # print(new_reflections.make_miller_array().shape)
 
         return Reflections(new_reflections)
 
@@ -663,6 +736,61 @@ class Reflections(ReflectionsInterface):
         self.path = path
 
 
+class LazyReflections(Reflections):
+    # The mtz is only parsed when the reflections are first accessed. Until then, header metadata answers what it can
+    def __init__(self, path: Path, metadata: typing.Optional[MtzMetadata] = None):
+        self.path = path
+        self.metadata = metadata
+
+    def __getattr__(self, item):
+        if item != "reflections":
+            raise AttributeError(item)
+        self.reflections = Reflections.from_file(self.path).reflections
+        return self.reflections
+
+    def is_loaded(self) -> bool:
+        return "reflections" in self.__dict__
+
+    def resolution(self) -> Resolution:
+        return Resolution.from_float(self.get_resolution())
+
+    def get_resolution(self) -> float:
+        if self.metadata and not self.is_loaded():
+            return self.metadata.resolution
+        return super().get_resolution()
+
+    def get_cell(self) -> gemmi.UnitCell:
+        if self.metadata and not self.is_loaded():
+            return gemmi.UnitCell(*self.metadata.cell)
+        return super().get_cell()
+
+    def get_spacegroup_hm(self) -> str:
+        if self.metadata and not self.is_loaded():
+            return self.metadata.spacegroup
+        return super().get_spacegroup_hm()
+
+    def columns(self):
+        if self.metadata and not self.is_loaded():
+            return self.metadata.columns
+        return super().columns()
+
+    def __repr__(self):
+        return f"LazyReflections(path={self.path})"
+
+    def __getstate__(self):
+        if not self.is_loaded():
+            return (None, self.path, self.metadata)
+        return super().__getstate__()
+
+    def __setstate__(self, data: Tuple):
+        if data[0] is None:
+            self.path = data[1]
+            self.metadata = data[2]
+        else:
+            super().__setstate__(data)
+            self.metadata = None
+
+
 @dataclasses.dataclass()
 class Reference:
     dtag: Dtag
@@ -692,7 +820,7 @@ class Reference:
         min_resolution_dtag: Optional[DtagInterface] = None
         for dtag in sorted(resolutions, key=lambda x: resolutions[x].to_float()):
             dataset = datasets[dtag]
-            dataset_spacegroup = dataset.reflections.reflections.spacegroup.hm
+            dataset_spacegroup = dataset.reflections.get_spacegroup_hm()
             if dataset_spacegroup == modal_spacegroup:
                 min_resolution_dtag = dtag
                 break
@@ -732,7 +860,7 @@ def get_reference_from_datasets(
         min_resolution_dtag = None
         for dtag in sorted(resolutions, key=lambda x: resolutions[x]):
             dataset = datasets[dtag]
-            dataset_spacegroup = dataset.reflections.reflections.spacegroup.hm
+            dataset_spacegroup = dataset.reflections.get_spacegroup_hm()
             if dataset_spacegroup == modal_spacegroup:
                 min_resolution_dtag = dtag
                 break
@@ -799,31 +927,13 @@ class Dataset:
                            reference_ref: Reflections,
                            structure_factors: StructureFactors,
                            ):
-        # Get own reflections
-        dtag_reflections = self.reflections.reflections
-        dtag_reflections_array = np.array(dtag_reflections, copy=True)
-        dtag_reflections_table = pd.DataFrame(dtag_reflections_array,
-                                              columns=dtag_reflections.column_labels(),
-                                              )
-        dtag_reflections_table.set_index(["H", "K", "L"], inplace=True)
-        dtag_flattened_index = dtag_reflections_table[
-            ~dtag_reflections_table[structure_factors.f].isna()].index.to_flat_index()
-
-        # Get reference
-        reference_reflections = reference_ref.reflections
-        reference_reflections_array = np.array(reference_reflections, copy=True)
-        reference_reflections_table = pd.DataFrame(reference_reflections_array,
-                                                   columns=reference_reflections.column_labels(),
-                                                   )
-        reference_reflections_table.set_index(["H", "K", "L"], inplace=True)
-        reference_flattened_index = reference_reflections_table[
-            ~reference_reflections_table[structure_factors.f].isna()].index.to_flat_index()
-
-        running_index = dtag_flattened_index.intersection(reference_flattened_index)
-
-        return running_index.to_list()
+        return np.intersect1d(
+            self.reflections.get_hkl_keys(structure_factors),
+            reference_ref.get_hkl_keys(structure_factors),
+            assume_unique=True,
+        )
 
-    def smooth(self, reference: Reference, structure_factors: StructureFactors):
+    def smooth(self, reference: Reference, structure_factors: StructureFactors, refine_scale: bool = False):
         reference_dataset = reference.dataset
 
         # Get common set of reflections
@@ -864,45 +974,7 @@ class Dataset:
 
         r = resolution_array
 
-        sample_grid = np.linspace(min(r), max(r), 100)
-
-        knn_x = neighbors.RadiusNeighborsRegressor(0.01)
-        knn_x.fit(r.reshape(-1, 1),
-                  x.reshape(-1, 1),
-                  )
-        x_f = knn_x.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-        scales = []
-        rmsds = []
-
-        knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-        knn_y.fit(r.reshape(-1, 1),
-                  (y * np.exp(0.0 * r)).reshape(-1, 1),
-                  )
-
-        # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-        y_neighbours = knn_y.radius_neighbors(sample_grid[:, np.newaxis])
-
-        # Optimise the scale factor
-        for scale in np.linspace(-4, 4, 100):
-            y_s = y * np.exp(scale * r)
-            # knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-            # knn_y.fit(r.reshape(-1, 1),
-            #           y_s.reshape(-1, 1),
-            #           )
-            #
-            # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-            y_f = np.array([np.mean(y_s[y_neighbours[1][j]]) for j, val in enumerate(sample_grid[:,
-                                                                                     np.newaxis].flatten())])
-
-            rmsd = np.sum(np.abs(x_f - y_f))
-
-            scales.append(scale)
-            rmsds.append(rmsd)
-
-        min_scale = scales[np.argmin(rmsds)]
+        min_scale = get_smoothing_scale(r, x, y, refine_scale)
 
         # Get the original reflections
         original_reflections = self.reflections.reflections
@@ -978,7 +1050,65 @@ class Dataset:
     #     return correlation
 
 
-def smooth(dataset, reference: Reference, structure_factors: StructureFactors):
+def get_smoothing_scale(r: np.ndarray, x: np.ndarray, y: np.ndarray, refine: bool = False,
+                        num_samples: int = 100, num_scales: int = 100, radius: float = 0.01) -> float:
+    # Find the scale that best matches the resolution binned amplitudes of y * exp(scale * r) to x
+    sample_grid = np.linspace(np.min(r), np.max(r), num_samples)
+
+    knn = neighbors.RadiusNeighborsRegressor(radius)
+    knn.fit(r.reshape(-1, 1),
+            y.reshape(-1, 1),
+            )
+    neighbourhoods = knn.radius_neighbors(sample_grid[:, np.newaxis])[1]
+
+    # In one dimension each neighbourhood is a contiguous run of the reflections sorted by resolution, so binned
+    # means are differences of cumulative sums
+    order = np.argsort(r, kind="stable")
+    ranks = np.empty(order.size, dtype=int)
+    ranks[order] = np.arange(order.size)
+    counts = np.array([neighbours.size for neighbours in neighbourhoods])
+    starts = np.array([np.min(ranks[neighbours]) if neighbours.size else 0 for neighbours in neighbourhoods])
+    stops = starts + counts
+    r_sorted = r[order].astype(np.float64)
+    y_sorted = y[order].astype(np.float64)
+
+    def get_binned_means(values: np.ndarray) -> np.ndarray:
+        cumulative = np.zeros((values.shape[0], values.shape[1] + 1))
+        np.cumsum(values, axis=1, out=cumulative[:, 1:])
+        # Empty neighbourhoods give nan, as the mean of an empty selection does
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (cumulative[:, stops] - cumulative[:, starts]) / counts[np.newaxis, :]
+
+    x_f = get_binned_means(x[order].astype(np.float64)[np.newaxis, :])
+
+    def get_rmsds(scales: np.ndarray) -> np.ndarray:
+        rmsds = np.empty(scales.size)
+        chunk_size = max(1, 2 ** 22 // max(r_sorted.size, 1))
+        for start in range(0, scales.size, chunk_size):
+            chunk = scales[start:start + chunk_size]
+            y_f = get_binned_means(y_sorted[np.newaxis, :] * np.exp(chunk[:, np.newaxis] * r_sorted[np.newaxis, :]))
+            rmsds[start:start + chunk.size] = np.sum(np.abs(x_f - y_f), axis=1)
+        return rmsds
+
+    # Optimise the scale factor
+    scales = np.linspace(-4, 4, num_scales)
+    rmsds = get_rmsds(scales)
+    min_scale = scales[np.argmin(rmsds)]
+
+    if refine and np.isfinite(rmsds).all():
+        step = scales[1] - scales[0]
+        result = optimize.minimize_scalar(
+            lambda scale: get_rmsds(np.array([scale]))[0],
+            bounds=(min_scale - step, min_scale + step),
+            method="bounded",
+        )
+        if result.fun < np.min(rmsds):
+            min_scale = result.x
+
+    return min_scale
+
+
+def smooth(dataset, reference: Reference, structure_factors: StructureFactors, refine_scale: bool = False):
     reference_dataset = reference.dataset
 
     # Get common set of reflections
@@ -1019,45 +1149,7 @@ def smooth(dataset, reference: Reference, structure_factors: StructureFactors):
 
     r = resolution_array
 
-    sample_grid = np.linspace(min(r), max(r), 100)
-
-    knn_x = neighbors.RadiusNeighborsRegressor(0.01)
-    knn_x.fit(r.reshape(-1, 1),
-              x.reshape(-1, 1),
-              )
-    x_f = knn_x.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-    scales = []
-    rmsds = []
-
-    knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-    knn_y.fit(r.reshape(-1, 1),
-              (y * np.exp(0.0 * r)).reshape(-1, 1),
-              )
-
-    # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-    y_neighbours = knn_y.radius_neighbors(sample_grid[:, np.newaxis])
-
-    # Optimise the scale factor
-    for scale in np.linspace(-4, 4, 100):
-        y_s = y * np.exp(scale * r)
-        # knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-        # knn_y.fit(r.reshape(-1, 1),
-        #           y_s.reshape(-1, 1),
-        #           )
-        #
-        # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-        y_f = np.array([np.mean(y_s[y_neighbours[1][j]]) for j, val in enumerate(sample_grid[:,
-                                                                                 np.newaxis].flatten())])
-
-        rmsd = np.sum(np.abs(x_f - y_f))
-
-        scales.append(scale)
-        rmsds.append(rmsd)
-
-    min_scale = scales[np.argmin(rmsds)]
+    min_scale = get_smoothing_scale(r, x, y, refine_scale)
 
     # Get the original reflections
     original_reflections = dataset.reflections.reflections
@@ -1111,11 +1203,14 @@ def smooth(dataset, reference: Reference, structure_factors: StructureFactors):
 
 
 class SmoothBFactors(SmoothBFactorsInterface):
+    def __init__(self, refine_scale: bool = False):
+        self.refine_scale = refine_scale
+
     def __call__(self,
                  dataset: DatasetInterface,
                  reference: ReferenceInterface,
                  structure_factors: StructureFactorsInterface) -> DatasetsInterface:
-        return smooth(dataset, reference, structure_factors)
+        return smooth(dataset, reference, structure_factors, self.refine_scale)
 
 
 # @ray.remote
@@ -1345,29 +1440,17 @@ class Datasets:
 
     def common_reflections(self, structure_factors: StructureFactors, tol=0.000001):
 
-        running_index: Optional[pd.Index] = None
+        running_index: Optional[np.ndarray] = None
 
         for dtag in self.datasets:
-            dataset = self.datasets[dtag]
-            reflections = dataset.reflections.reflections
-            reflections_array = np.array(reflections, copy=True)
-            reflections_table = pd.DataFrame(reflections_array,
-                                             columns=reflections.column_labels(),
-                                             )
-            reflections_table.set_index(["H", "K", "L"], inplace=True)
-
-            is_na = reflections_table[structure_factors.f].isna()
-            is_zero = reflections_table[structure_factors.f].abs() < tol
-            mask = ~(is_na | is_zero)
-
-            flattened_index = reflections_table[mask].index.to_flat_index()
+            keys = self.datasets[dtag].reflections.get_hkl_keys(structure_factors, tol)
             if running_index is None:
-                running_index = flattened_index
-            if running_index is not None:
-                running_index = running_index.intersection(flattened_index)
-        
+                running_index = keys
+            else:
+                running_index = np.intersect1d(running_index, keys, assume_unique=True)
+
         if running_index is not None:
-            return running_index.to_list()
+            return running_index
 
         else:
             raise Exception("Somehow a running index has not been calculated. This should be impossible. Contact mantainer.")
@@ -1389,14 +1472,8 @@ class Datasets:
         # truncate on reflections
         new_datasets_reflections = {}
         for dtag in dataset_resolution_truncated:
-            reflections = dataset_resolution_truncated[dtag].reflections.reflections
-            reflections_array = np.array(reflections)
-
             truncated_dataset = dataset_resolution_truncated[dtag].truncate_reflections(common_reflections,
                                                                                         )
-            reflections = truncated_dataset.reflections.reflections
-            reflections_array = np.array(reflections)
-
             new_datasets_reflections[dtag] = truncated_dataset
 
         return Datasets(new_datasets_reflections)
@@ -1776,18 +1853,84 @@ def drop_columns(datasets: DatasetsInterface, structure_factors: StructureFactor
     return new_datasets
 
 
+def prefetch_file(path: Path):
+    # Reading in python releases the GIL, so threads can pull files into the page cache concurrently
+    with open(path, "rb") as f:
+        while f.read(2 ** 24):
+            pass
+
+
+def load_dataset(pdb_file: Path, mtz_file: Path, lazy_load: bool = False,
+                 metadata_index: typing.Optional[MetadataIndex] = None):
+    timings = {}
+
+    start = time.time()
+    if lazy_load:
+        structure = LazyStructure(pdb_file, metadata_index.get_pdb(pdb_file) if metadata_index else None)
+    else:
+        prefetch_file(pdb_file)
+        structure = Structure.from_file(pdb_file)
+    timings["pdb"] = time.time() - start
+
+    start = time.time()
+    if lazy_load:
+        reflections = LazyReflections(mtz_file, metadata_index.get_mtz(mtz_file) if metadata_index else None)
+    else:
+        prefetch_file(mtz_file)
+        reflections = Reflections.from_file(mtz_file)
+    timings["mtz"] = time.time() - start
+
+    return Dataset(structure=structure, reflections=reflections, ), timings
+
+
 def get_datasets_from_pandda_fs_model(pandda_fs_model: PanDDAFSModelInterface,
-                ) -> DatasetsInterface:
-    datasets = {}
-    for dtag, dataset_dir in pandda_fs_model.data_dirs.to_dict().items():
-        dataset: Dataset = Dataset.from_files(dataset_dir.input_pdb_file,
-                                                dataset_dir.input_mtz_file,
-                                                )
+                                      num_threads: int = 1,
+                                      lazy_load: bool = False,
+                                      timings: typing.Optional[typing.Dict] = None,
+                                      metadata_index: typing.Optional[MetadataIndex] = None,
+                                      ) -> DatasetsInterface:
+    data_dirs = pandda_fs_model.data_dirs.to_dict()
+
+    with ThreadPoolExecutor(max(num_threads, 1)) as executor:
+        futures = {
+            dtag: executor.submit(
+                load_dataset,
+                dataset_dir.input_pdb_file,
+                dataset_dir.input_mtz_file,
+                lazy_load,
+                metadata_index,
+            )
+            for dtag, dataset_dir
+            in data_dirs.items()
+        }
+
+        datasets = {}
+        for dtag, future in futures.items():
+            dataset, dataset_timings = future.result()
+            datasets[dtag] = dataset
+            if timings is not None:
+                timings[dtag] = dataset_timings
 
-        datasets[dtag] = dataset
+    if metadata_index:
+        metadata_index.save()
 
     return datasets
 
+
 class GetDatasets(GetDatasetsInterface):
+    def __init__(self, num_threads: int = 1, lazy_load: bool = False,
+                 metadata_index_file: typing.Optional[Path] = None):
+        self.num_threads = num_threads
+        self.lazy_load = lazy_load
+        self.metadata_index_file = metadata_index_file
+        self.timings = {}
+
     def __call__(self, pandda_fs_model: PanDDAFSModelInterface) -> DatasetsInterface:
-        return get_datasets_from_pandda_fs_model(pandda_fs_model)
\ No newline at end of file
+        metadata_index = MetadataIndex(self.metadata_index_file) if self.lazy_load else None
+        return get_datasets_from_pandda_fs_model(
+            pandda_fs_model,
+            self.num_threads,
+            self.lazy_load,
+            self.timings,
+            metadata_index,
+        )
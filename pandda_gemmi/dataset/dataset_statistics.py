@@ -16,7 +16,7 @@ class DatasetsStatistics(DatasetsStatisticsInterface):
     @staticmethod
     def get_unit_cell_stats(datasets: Dict[Dtag, Dataset]):
 
-        unit_cells = [dataset.reflections.reflections.cell for dtag, dataset in datasets.items()]
+        unit_cells = [dataset.reflections.get_cell() for dtag, dataset in datasets.items()]
 
         unit_cells = {"a": [unit_cell.a for unit_cell in unit_cells],
          "b": [unit_cell.b for unit_cell in unit_cells],
@@ -30,13 +30,13 @@ class DatasetsStatistics(DatasetsStatisticsInterface):
 
     @staticmethod
     def get_spacegroup_stats(datasets: Dict[Dtag, Dataset]):
-        spacegroups = [dataset.reflections.reflections.spacegroup.hm for dtag, dataset in datasets.items()]
+        spacegroups = [dataset.reflections.get_spacegroup_hm() for dtag, dataset in datasets.items()]
 
         return spacegroups
 
     @staticmethod
     def get_resolution_stats(datasets: Dict[Dtag, Dataset]):
-        resolutions = [dataset.reflections.reflections.resolution_high() for dtag, dataset in datasets.items()]
+        resolutions = [dataset.reflections.get_resolution() for dtag, dataset in datasets.items()]
         return resolutions
 
     @staticmethod
@@ -44,15 +44,7 @@ class DatasetsStatistics(DatasetsStatisticsInterface):
         chains = []
         for dtag, dataset in datasets.items():
 
-            dataset_structure = dataset.structure.structure
-
-            dataset_chains = []
-
-            for model in dataset_structure:
-                for chain in model:
-                    dataset_chains.append(chain.name)
-
-            dataset_chains = list(sorted(dataset_chains))
+            dataset_chains = list(sorted(dataset.structure.chains()))
 
             chains.append(dataset_chains)
 
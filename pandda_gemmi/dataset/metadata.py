@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import struct
+import threading
+import dataclasses
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import gemmi
+
+PDB_RFREE_REGEX = re.compile(r"^REMARK   3   FREE R VALUE\s*:\s*(\S+)")
+
+
+def get_spacegroup_hm(name: str) -> str:
+    spacegroup = gemmi.find_spacegroup_by_name(name)
+    if spacegroup is None:
+        return name
+    return spacegroup.hm
+
+
+@dataclasses.dataclass()
+class MtzMetadata:
+    resolution: float
+    cell: List[float]
+    spacegroup: str
+    columns: List[str]
+    num_reflections: int
+
+    @staticmethod
+    def from_file(path: Path) -> MtzMetadata:
+        # Only the header records at the end of the file are read, never the reflection data
+        with open(path, "rb") as f:
+            start = f.read(12)
+            if start[:4] != b"MTZ ":
+                raise Exception(f"Error trying to read mtz header: {path}: not an mtz file")
+
+            # The machine stamp gives the byte order of the header location
+            byte_order = ">" if (start[8] >> 4) == 1 else "<"
+            header_location = struct.unpack(f"{byte_order}i", start[4:8])[0]
+            if header_location == -1:
+                header_location = struct.unpack(f"{byte_order}q", f.read(8))[0]
+
+            f.seek((header_location - 1) * 4)
+            header = f.read().decode("ascii", errors="replace")
+
+        resolution, cell, spacegroup, num_reflections = None, None, None, None
+        columns = []
+        for j in range(0, len(header), 80):
+            record = header[j:j + 80]
+            keyword = record[:4]
+            if keyword == "NCOL":
+                num_reflections = int(record.split()[2])
+            elif keyword == "CELL":
+                cell = [float(x) for x in record.split()[1:7]]
+            elif keyword == "SYMI":
+                spacegroup = get_spacegroup_hm(record.split("'")[1])
+            elif keyword == "RESO":
+                resolution = float(1 / np.sqrt(float(record.split()[2])))
+            elif keyword == "COLU":
+                columns.append(record.split()[1])
+            elif keyword == "END ":
+                break
+
+        return MtzMetadata(resolution, cell, spacegroup, columns, num_reflections)
+
+
+@dataclasses.dataclass()
+class PdbMetadata:
+    rfree: Optional[float]
+    cell: List[float]
+    spacegroup: str
+    chains: List[str]
+
+    @staticmethod
+    def from_file(path: Path) -> PdbMetadata:
+        rfree, cell, spacegroup = None, None, None
+        chains = []
+        model_chains, model_started = [], False
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith(("ATOM", "HETATM")):
+                    chain = line[21].strip()
+                    if chain not in model_chains:
+                        model_chains.append(chain)
+                    model_started = True
+                elif line.startswith("ENDMDL"):
+                    chains += model_chains
+                    model_chains = []
+                elif line.startswith("CRYST1"):
+                    cell = [float(line[6:15]), float(line[15:24]), float(line[24:33]),
+                            float(line[33:40]), float(line[40:47]), float(line[47:54])]
+                    spacegroup = get_spacegroup_hm(line[55:66].strip())
+                elif (rfree is None) and (not model_started) and line.startswith("REMARK   3"):
+                    match = PDB_RFREE_REGEX.match(line)
+                    if match:
+                        try:
+                            rfree = float(match.group(1))
+                        except ValueError:
+                            pass
+        chains += model_chains
+
+        return PdbMetadata(rfree, cell, spacegroup, chains)
+
+
+class MetadataIndex:
+    # Metadata of the input files, cached by path and invalidated by file modification time and size
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and path.exists():
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, path: Path, metadata_type: Type):
+        key = str(Path(path).resolve())
+        stat = os.stat(path)
+
+        entry = self.entries.get(key)
+        if entry and (entry["mtime"] == stat.st_mtime_ns) and (entry["size"] == stat.st_size):
+            return metadata_type(**entry["metadata"])
+
+        metadata = metadata_type.from_file(path)
+        with self.lock:
+            self.entries[key] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "metadata": dataclasses.asdict(metadata),
+            }
+        return metadata
+
+    def get_mtz(self, path: Path) -> MtzMetadata:
+        return self.get(path, MtzMetadata)
+
+    def get_pdb(self, path: Path) -> PdbMetadata:
+        return self.get(path, PdbMetadata)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with self.lock:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
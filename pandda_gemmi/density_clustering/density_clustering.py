@@ -5,7 +5,9 @@ import typing
 from typing import *
 import dataclasses
 
-from scipy.cluster.hierarchy import fclusterdata
+from scipy import spatial
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import DBSCAN
 from joblib.externals.loky import set_loky_pickler
 from pandda_gemmi.analyse_interface import *
@@ -15,12 +17,27 @@ set_loky_pickler('pickle')
 # from pandda_gemmi.pandda_functions import save_event_map
 
 from pandda_gemmi.python_types import *
-from pandda_gemmi.common import EventIDX, EventID, SiteID, Dtag, PositionsArray, delayed
+from pandda_gemmi.common import EventIDX, EventID, SiteID, Dtag, PositionsArray, delayed, fractional_to_orthogonal
 from pandda_gemmi.dataset import Reference, Dataset, StructureFactors
 from pandda_gemmi.edalignment import Grid, Xmap, Alignment, Xmaps, Partitioning
 from pandda_gemmi.model import Zmap, Zmaps, Model
 
 
+def get_single_linkage_cluster_ids(positions: np.ndarray, cutoff: float) -> np.ndarray:
+    # Single linkage clusters at a distance cutoff are the connected components of the graph joining points no
+    # further apart than the cutoff, which a KD tree finds without the O(n^2) distance matrix of fclusterdata.
+    # Clusters are numbered from 1 in order of their first point
+    pairs = spatial.cKDTree(positions).query_pairs(r=cutoff, output_type="ndarray")
+    num_points = positions.shape[0]
+    adjacency = coo_matrix(
+        (np.ones(pairs.shape[0], dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape=(num_points, num_points),
+    )
+    num_clusters, labels = connected_components(adjacency, directed=False)
+
+    return labels + 1
+
+
 @dataclasses.dataclass()
 class Cluster(EDClusterInterface):
     indexes: typing.Tuple[np.ndarray]
@@ -66,7 +83,7 @@ class Clustering(EDClusteringInterface):
 
         time_np_start = time.time()
 
-        zmap_array = zmap.to_array(copy=True)
+        zmap_array = zmap.to_array(grid)
         # event_map_array = np.array(event_map, copy=True)
 
         # Get the protein mask
@@ -125,32 +142,11 @@ class Clustering(EDClusteringInterface):
         extrema_fractional_array = extrema_point_array / np.array([grid.grid.nu, grid.grid.nv, grid.grid.nw]).reshape(
             (1, 3))
 
-        # TODO: possible bottleneck
         time_get_orth_pos_start = time.time()
-        positions_orthogonal = [zmap.zmap.unit_cell.orthogonalize(gemmi.Fractional(fractional[0],
-                                                                                   fractional[1],
-                                                                                   fractional[2],
-                                                                                   )) for fractional in
-                                extrema_fractional_array]
+        extrema_cart_coords_array = fractional_to_orthogonal(zmap.unit_cell(),
+                                                             extrema_fractional_array)  # n, 3
         time_get_orth_pos_finish = time.time()
 
-        positions = [[position.x, position.y, position.z] for position in positions_orthogonal]
-
-        # positions = []
-        # for point in extrema_grid_coords_array:
-        #     # position = gemmi.Fractional(*point)
-        #     point = grid.grid.get_point(*point)
-        #     # fractional = grid.grid.point_to_fractional(point)
-        #     # pos_orth = zmap.zmap.unit_cell.orthogonalize(fractional)
-        #     orthogonal = grid.grid.point_to_position(point)
-
-        #     pos_orth_array = [orthogonal[0],
-        #                       orthogonal[1],
-        #                       orthogonal[2], ]
-        #     positions.append(pos_orth_array)
-
-        extrema_cart_coords_array = np.array(positions)  # n, 3
-
         point_000 = grid.grid.get_point(0, 0, 0)
         point_111 = grid.grid.get_point(1, 1, 1)
         position_000 = grid.grid.point_to_position(point_000)
@@ -165,13 +161,7 @@ class Clustering(EDClusteringInterface):
 
         # TODO: possible bottleneck
         time_fcluster_start = time.time()
-        cluster_ids_array = fclusterdata(X=extrema_cart_coords_array,
-                                         # t=blob_finding.clustering_cutoff,
-                                         t=clustering_cutoff,
-                                         criterion='distance',
-                                         metric='euclidean',
-                                         method='single',
-                                         )
+        cluster_ids_array = get_single_linkage_cluster_ids(extrema_cart_coords_array, clustering_cutoff)
         time_fcluster_finish = time.time()
 
         clusters = {}
@@ -343,7 +333,7 @@ def get_clustering_from_zmap(zmap: ZmapInterface, reference: ReferenceInterface,
 
     time_np_start = time.time()
 
-    zmap_array = zmap.to_array(copy=True)
+    zmap_array = zmap.to_array(grid)
 
     # Get the protein mask
     protein_mask_grid = grid.partitioning.protein_mask
@@ -394,32 +384,11 @@ def get_clustering_from_zmap(zmap: ZmapInterface, reference: ReferenceInterface,
     extrema_fractional_array = extrema_point_array / np.array([grid.grid.nu, grid.grid.nv, grid.grid.nw]).reshape(
         (1, 3))
 
-    # TODO: possible bottleneck
     time_get_orth_pos_start = time.time()
-    positions_orthogonal = [zmap.zmap.unit_cell.orthogonalize(gemmi.Fractional(fractional[0],
-                                                                                fractional[1],
-                                                                                fractional[2],
-                                                                                )) for fractional in
-                            extrema_fractional_array]
+    extrema_cart_coords_array = fractional_to_orthogonal(zmap.unit_cell(),
+                                                         extrema_fractional_array)  # n, 3
     time_get_orth_pos_finish = time.time()
 
-    positions = [[position.x, position.y, position.z] for position in positions_orthogonal]
-
-    # positions = []
-    # for point in extrema_grid_coords_array:
-    #     # position = gemmi.Fractional(*point)
-    #     point = grid.grid.get_point(*point)
-    #     # fractional = grid.grid.point_to_fractional(point)
-    #     # pos_orth = zmap.zmap.unit_cell.orthogonalize(fractional)
-    #     orthogonal = grid.grid.point_to_position(point)
-
-    #     pos_orth_array = [orthogonal[0],
-    #                       orthogonal[1],
-    #                       orthogonal[2], ]
-    #     positions.append(pos_orth_array)
-
-    extrema_cart_coords_array = np.array(positions)  # n, 3
-
     point_000 = grid.grid.get_point(0, 0, 0)
     point_111 = grid.grid.get_point(1, 1, 1)
     position_000 = grid.grid.point_to_position(point_000)
@@ -434,13 +403,7 @@ def get_clustering_from_zmap(zmap: ZmapInterface, reference: ReferenceInterface,
 
     # TODO: possible bottleneck
     time_fcluster_start = time.time()
-    cluster_ids_array = fclusterdata(X=extrema_cart_coords_array,
-                                        # t=blob_finding.clustering_cutoff,
-                                        t=clustering_cutoff,
-                                        criterion='distance',
-                                        metric='euclidean',
-                                        method='single',
-                                        )
+    cluster_ids_array = get_single_linkage_cluster_ids(extrema_cart_coords_array, clustering_cutoff)
     time_fcluster_finish = time.time()
 
     clusters = {}
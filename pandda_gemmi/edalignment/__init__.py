@@ -1,7 +1,7 @@
 from pandda_gemmi.edalignment.alignments import Alignments, Alignment, Transform, GetAlignments
-from pandda_gemmi.edalignment.grid import Grid, Partitioning, GetGrid
+from pandda_gemmi.edalignment.grid import Grid, Partitioning, GetGrid, ProteinMasks
 from pandda_gemmi.edalignment.edmaps import (
-    Xmap, Xmaps, XmapArray, from_unaligned_dataset_c,
+    Xmap, Xmaps, XmapArray, NativeFrame, from_unaligned_dataset_c,
     from_unaligned_dataset_c_flat,
     #from_unaligned_dataset_c_ray, from_unaligned_dataset_c_flat_ray,
    LoadXmap,
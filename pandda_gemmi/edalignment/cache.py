@@ -0,0 +1,84 @@
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+
+from pandda_gemmi.analyse_interface import *
+
+# Bump to invalidate existing caches when the way xmaps are generated changes
+XMAP_CACHE_VERSION = 2
+
+
+def _update_with_array(hasher, array: np.ndarray):
+    array = np.ascontiguousarray(array)
+    hasher.update(str(array.dtype).encode())
+    hasher.update(str(array.shape).encode())
+    hasher.update(array.tobytes())
+
+
+def get_xmap_key(dataset: DatasetInterface,
+                 alignment: AlignmentInterface,
+                 grid: GridInterface,
+                 structure_factors: StructureFactorsInterface,
+                 sample_rate: float,
+                 ) -> str:
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"{XMAP_CACHE_VERSION}".encode())
+
+    # Reflections as they will be transformed: after truncation and smoothing, not as on disk
+    reflections = dataset.reflections.reflections
+    hasher.update(str(reflections.cell.parameters).encode())
+    hasher.update(reflections.spacegroup.hm.encode())
+    hasher.update(str([column.label for column in reflections.columns]).encode())
+    _update_with_array(hasher, np.array(reflections, copy=False))
+    hasher.update(f"{structure_factors.f} {structure_factors.phi} {sample_rate}".encode())
+
+    # Alignment of each residue that is interpolated
+    for residue_id in grid.partitioning:
+        transform = alignment[residue_id]
+        hasher.update(str(residue_id).encode())
+        hasher.update(str(transform.transform.mat.tolist()).encode())
+        hasher.update(str(transform.transform.vec.tolist()).encode())
+        _update_with_array(hasher, np.array(transform.com_moving, dtype=np.float64))
+        _update_with_array(hasher, np.array(transform.com_reference, dtype=np.float64))
+
+    # Grid the maps are interpolated onto
+    hasher.update(str([grid.grid.nu, grid.grid.nv, grid.grid.nw]).encode())
+    hasher.update(str(grid.grid.unit_cell.parameters).encode())
+    _update_with_array(hasher, grid.partitioning.total_mask)
+
+    return hasher.hexdigest()
+
+
+class XmapCache:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def get_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.npy"
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        path = self.get_path(key)
+        if not path.exists():
+            return None
+
+        try:
+            return np.load(str(path), mmap_mode="r")
+        except Exception:
+            # A corrupt or partially written entry is treated as a miss and overwritten
+            return None
+
+    def save(self, key: str, masked_array: np.ndarray):
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file and move it into place so concurrent readers never see a partial array
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix=".npy.tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as f:
+                np.save(f, np.ascontiguousarray(masked_array, dtype=np.float32))
+            os.replace(tmp_path, str(path))
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise e
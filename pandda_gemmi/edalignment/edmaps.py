@@ -16,10 +16,11 @@ set_loky_pickler('pickle')
 
 from pandda_gemmi.analyse_interface import *
 from pandda_gemmi.python_types import *
-from pandda_gemmi.common import Dtag, delayed
+from pandda_gemmi.common import Dtag, delayed, grid_coords_to_orthogonal
 from pandda_gemmi.dataset import StructureFactors, Reflections, Dataset, Datasets
 from pandda_gemmi.edalignment.alignments import Alignment, Alignments, Transform
 from pandda_gemmi.edalignment.grid import Grid, Partitioning
+from pandda_gemmi.edalignment.cache import XmapCache, get_xmap_key
 
 
 def interpolate_points(
@@ -61,6 +62,65 @@ def interpolate_points_single(
         com_reference,
     )
 
+def get_partitioning_interpolation(
+        interpolated_map,
+        partitioning: PartitioningInterface,
+        transforms,
+):
+    # The positions in the moving map to sample for every point of a partitioning of interpolated_map, and the
+    # (wrapped) grid points they are written to. transforms maps residue ids to (transform, com_moving,
+    # com_reference); residues without a transform are not interpolated
+    positions = grid_coords_to_orthogonal(interpolated_map, partitioning.points)
+    moving_positions = np.zeros(positions.shape, dtype=np.float64)
+    interpolate = np.zeros(positions.shape[0], dtype=bool)
+
+    for residue_id in partitioning:
+        if residue_id not in transforms:
+            continue
+        transform, com_moving, com_reference = transforms[residue_id]
+        residue_slice = partitioning.residue_slice(residue_id)
+        rotation = np.array(transform.mat.tolist(), dtype=np.float64)
+        translation = np.array(transform.vec.tolist(), dtype=np.float64)
+
+        moving_positions[residue_slice] = (
+                ((positions[residue_slice] - np.array(com_reference).reshape((1, 3))) @ rotation.T)
+                + translation.reshape((1, 3))
+                + np.array(com_moving).reshape((1, 3))
+        )
+        interpolate[residue_slice] = True
+
+    shape = np.array([interpolated_map.nu, interpolated_map.nv, interpolated_map.nw]).reshape((1, 3))
+    points = np.mod(partitioning.points[interpolate], shape)
+
+    return np.ascontiguousarray(moving_positions[interpolate], dtype=np.float32), points
+
+
+def interpolate_positions(moving_map, positions):
+    vals = np.zeros(positions.shape[0], dtype=np.float32)
+    gemmi.interpolate_pos_array(
+        moving_map,
+        positions,
+        vals,
+    )
+    return vals
+
+
+def interpolate_partitioning(
+        moving_map,
+        interpolated_map,
+        partitioning: PartitioningInterface,
+        transforms,
+):
+    # Array equivalent of interpolate_points_single over every residue of a partitioning at once
+    positions, points = get_partitioning_interpolation(interpolated_map, partitioning, transforms)
+    vals = interpolate_positions(moving_map, positions)
+
+    interpolated_map_array = np.array(interpolated_map, copy=False)
+    interpolated_map_array[points[:, 0], points[:, 1], points[:, 2]] = vals
+
+    return interpolated_map
+
+
 def transform_point(point, grid, transform, com_ref, com_mov):
     frac = (
         point[0] * (1/grid.nu),
@@ -223,78 +283,17 @@ class Xmap(XmapInterface):
         unaligned_xmap_array[:, :, :] = unaligned_xmap_array[:, :, :] / std
 
         new_grid = grid.new_grid()
-        # Unpack the points, poitions and transforms
-        point_list: List[GridCoordInterface] = []
-        position_list: List[PositionInterface] = []
-        transform_list: List[gemmi.Transform] = []
-        com_moving_list: List[NDArrayInterface] = []
-        com_reference_list: List[NDArrayInterface] = []
 
-        for residue_id in grid.partitioning:
-
-            point_position_dict = grid.partitioning[residue_id]
-
-            al = alignment[residue_id]
-            # transform = al.transform.inverse()
-            # TODO: REMOVE?
-            transform = al.transform
-            com_moving = al.com_moving
-            com_reference = al.com_reference
-
-            points = [_point for _point in point_position_dict.keys()]
-            positions = [_position for _position in point_position_dict.values()]
-
-            # print(f"Interpolating: {residue_id}")
-            # print(f"\tPoint: {points[0]}")
-            # print(f"\tPos: {positions[0]}")
-            # # print(f"\tPos (from grid): {new_grid.}")
-            # print(f"\tcom_moving: {com_moving}")
-            # print(f"\tcom_reference: {com_reference}")
-            # print(f"\tTransform: {transform_point(points[0], new_grid, transform, com_reference, com_moving)}")
-
-            interpolate_points_single(unaligned_xmap,
-                                      new_grid,
-                                      points,
-                                      positions,
-                                      transform,
-                                      com_moving,
-                                      com_reference,
-                                      )
-            #
-            # for point, position in point_position_dict.items():
-            #     point_list.append(point)
-            #     position_list.append(position)
-            #     transform_list.append(transform)
-            #     com_moving_list.append(com_moving)
-            #     com_reference_list.append(com_reference)
-
-        # for point, position, transform, com_moving, com_reference in zip(point_list, position_list, transform_list, com_moving_list, com_reference_list):
-
-        # print((
-        #     f"point: {point}\n"
-        #     f"Position: {position}\n"
-        #     f"transform: {transform.vec.tolist()} # {transform.mat.tolist()} \n"
-        #     f"com moving: {com_moving} \n"
-        #     f"Com moving: {com_reference}\n"
-        # ))
-
-        # Interpolate values
-        # interpolated_grid = interpolate_points(unaligned_xmap,
-        #                                        new_grid,
-        #                                        point_list,
-        #                                        position_list,
-        #                                        transform_list,
-        #                                        com_moving_list,
-        #                                        com_reference_list,
-        #                                        )
-        # interpolated_grid = gemmi.interpolate_points(unaligned_xmap,
-        #                                              new_grid,
-        #                                              point_list,
-        #                                              position_list,
-        #                                              transform_list,
-        #                                              com_moving_list,
-        #                                              com_reference_list,
-        #                                              )
+        # Interpolate every residue with its own transform
+        transforms = {
+            residue_id: (alignment[residue_id].transform,
+                         alignment[residue_id].com_moving,
+                         alignment[residue_id].com_reference,
+                         )
+            for residue_id
+            in grid.partitioning
+        }
+        interpolate_partitioning(unaligned_xmap, new_grid, grid.partitioning, transforms)
 
         interpolated_grid = new_grid
 
@@ -436,66 +435,21 @@ class Xmap(XmapInterface):
             partitioning: PartitioningInterface,
             mask_radius_symmetry: float,
             sample_rate: float,
+            native_frame: Optional[NativeFrame] = None,
     ):
 
-        moving_xmap_grid: gemmi.FloatGrid = dataset.reflections.transform_f_phi_to_map(
-            structure_factors.f,
-            structure_factors.phi,
-            # sample_rate=sample_rate,
-            sample_rate=dataset.reflections.get_resolution() / 0.5,
-        )
-
-        new_grid = gemmi.FloatGrid(*[moving_xmap_grid.nu,
-                                     moving_xmap_grid.nv,
-                                     moving_xmap_grid.nw])
-        new_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-        new_grid.set_unit_cell(moving_xmap_grid.unit_cell)
-
-        # Unpack the points, poitions and transforms
-        point_list = []
-        position_list = []
-        transform_list = []
-        com_moving_list = []
-        com_reference_list = []
-        for residue_id in grid.partitioning:
-
-            if residue_id in partitioning:
-                al = alignment[residue_id]
-                # transform = al.transform
-                transform = al.transform.inverse()
-                com_moving = al.com_reference
-                com_reference = al.com_moving
-                point_position_dict = partitioning[residue_id]
-
-                for point, position in point_position_dict.items():
-                    point_list.append(point)
-                    position_list.append(position)
-                    transform_list.append(transform)
-                    com_moving_list.append(com_moving)
-                    com_reference_list.append(com_reference)
-            else:
-                continue
-
-        # Interpolate values
-        # interpolated_grid = gemmi.interpolate_points(
-        #     event_map_reference_grid,
-        #     new_grid,
-        #     point_list,
-        #     position_list,
-        #     transform_list,
-        #     com_moving_list,
-        #     com_reference_list,
-        # )
-        interpolated_grid = interpolate_points(event_map_reference_grid,
-                                               new_grid,
-                                               point_list,
-                                               position_list,
-                                               transform_list,
-                                               com_moving_list,
-                                               com_reference_list,
-                                               )
+        if native_frame is None:
+            native_frame = NativeFrame.from_dataset(
+                dataset,
+                alignment,
+                grid,
+                structure_factors,
+                mask_radius,
+                mask_radius_symmetry,
+                partitioning,
+            )
 
-        return Xmap(interpolated_grid)
+        return native_frame.interpolate(event_map_reference_grid)
 
     @staticmethod
     def interpolate_grid(grid: CrystallographicGridInterface,
@@ -541,6 +495,73 @@ class Xmap(XmapInterface):
         self.xmap = xmap_python.to_gemmi()
 
 
+@dataclasses.dataclass()
+class NativeFrame:
+    # The native frame grid of a dataset and the reference frame positions sampled for each of its points, shared
+    # by every map of the dataset that is interpolated back from the reference frame
+    shape: Tuple[int, int, int]
+    unit_cell_parameters: Tuple[float, float, float, float, float, float]
+    positions: np.ndarray
+    points: np.ndarray
+
+    @staticmethod
+    def from_dataset(
+            dataset: DatasetInterface,
+            alignment: AlignmentInterface,
+            grid: GridInterface,
+            structure_factors: StructureFactorsInterface,
+            mask_radius: float,
+            mask_radius_symmetry: float,
+            partitioning: Optional[PartitioningInterface] = None,
+    ) -> NativeFrame:
+        native_grid: gemmi.FloatGrid = dataset.reflections.transform_f_phi_to_map(
+            structure_factors.f,
+            structure_factors.phi,
+            sample_rate=dataset.reflections.get_resolution() / 0.5,
+        )
+
+        if partitioning is None:
+            partitioning = Partitioning.from_structure_multiprocess(
+                dataset.structure,
+                native_grid,
+                mask_radius,
+                mask_radius_symmetry,
+            )
+
+        # Interpolate back from the reference frame with the inverse of each residue's transform
+        transforms = {}
+        for residue_id in grid.partitioning:
+            if residue_id in partitioning:
+                al = alignment[residue_id]
+                transforms[residue_id] = (al.transform.inverse(), al.com_reference, al.com_moving)
+
+        positions, points = get_partitioning_interpolation(native_grid, partitioning, transforms)
+
+        unit_cell = native_grid.unit_cell
+        return NativeFrame(
+            (native_grid.nu, native_grid.nv, native_grid.nw),
+            (unit_cell.a, unit_cell.b, unit_cell.c, unit_cell.alpha, unit_cell.beta, unit_cell.gamma),
+            positions,
+            points,
+        )
+
+    def interpolate_values(self, reference_grid: CrystallographicGridInterface) -> np.ndarray:
+        return interpolate_positions(reference_grid, self.positions)
+
+    def to_grid(self, values: np.ndarray) -> gemmi.FloatGrid:
+        new_grid = gemmi.FloatGrid(*self.shape)
+        new_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+        new_grid.set_unit_cell(gemmi.UnitCell(*self.unit_cell_parameters))
+
+        grid_array = np.array(new_grid, copy=False)
+        grid_array[self.points[:, 0], self.points[:, 1], self.points[:, 2]] = values
+
+        return new_grid
+
+    def interpolate(self, reference_grid: CrystallographicGridInterface) -> Xmap:
+        return Xmap(self.to_grid(self.interpolate_values(reference_grid)))
+
+
 @dataclasses.dataclass()
 class Xmaps:
     xmaps: typing.Dict[Dtag, Xmap]
@@ -663,46 +684,53 @@ class XmapArray:
     @staticmethod
     def from_xmaps(xmaps: XmapsInterface,
                    grid: GridInterface,
+                   dtags: typing.Optional[typing.List[DtagInterface]] = None,
+                   memmap_path: typing.Optional[Path] = None,
                    ):
+        # Mask each map once into a single contiguous (n, m) array, in the order given by dtags if provided, so
+        # that subsets of adjacent rows can later be taken as views
+        if dtags is None:
+            dtag_list = list(xmaps)
+        else:
+            dtag_list = list(dtags)
 
-        protein_mask = grid.partitioning.protein_mask
-        protein_mask_array = np.array(protein_mask, copy=False, dtype=np.int8)
-
-        symmetry_contact_mask = grid.partitioning.symmetry_mask
-        symmetry_contact_mask_array = np.array(symmetry_contact_mask, copy=False, dtype=np.int8)
-
-        arrays = {}
-        for dtag in xmaps:
-            xmap = xmaps[dtag]
-            xmap_array = xmap.to_array()
-
-            array = xmap_array[grid.partitioning.total_mask == 1]
+        mask_indexes = np.flatnonzero(grid.partitioning.total_mask == 1)
 
-            arrays[dtag] = array
+        shape = (len(dtag_list), mask_indexes.size)
+        if memmap_path:
+            xmap_array = np.lib.format.open_memmap(str(memmap_path), mode="w+", dtype=np.float32, shape=shape)
+        else:
+            xmap_array = np.empty(shape, dtype=np.float32)
 
-        dtag_list = list(arrays.keys())
-        xmap_array = np.stack(list(arrays.values()), axis=0)
+        for j, dtag in enumerate(dtag_list):
+            xmap_array[j, :] = xmaps[dtag].to_array(copy=False).ravel()[mask_indexes]
 
         return XmapArray(dtag_list, xmap_array)
 
-    def from_dtags(self, dtags: typing.List[DtagInterface]):
-        bool_mask = []
-
+    def get_indexes(self, dtags: typing.List[DtagInterface]):
         for dtag in dtags:
             if dtag not in self.dtag_list:
                 raise Exception(f"Dtag {dtag} not in dtags: {self.dtag_list}")
 
-        for dtag in self.dtag_list:
-            if dtag in dtags:
-                bool_mask.append(True)
-            else:
-                bool_mask.append(False)
+        return np.array([j for j, dtag in enumerate(self.dtag_list) if dtag in dtags], dtype=int)
+
+    def from_dtags(self, dtags: typing.List[DtagInterface]):
+        indexes = self.get_indexes(dtags)
+
+        # Adjacent rows can be served as a view without copying, otherwise gather them
+        if indexes.size > 0 and np.all(np.diff(indexes) == 1):
+            view = self.xmap_array[indexes[0]:indexes[-1] + 1]
+        else:
+            view = self.xmap_array[indexes]
 
-        mask_array = np.array(bool_mask)
+        return XmapArray([self.dtag_list[j] for j in indexes], view)
 
-        view = self.xmap_array[mask_array]
+    def with_row(self, dtag: DtagInterface, row: np.ndarray):
+        # A dataset that already has a row is served from this array as it is, otherwise its row is appended to a copy
+        if dtag in self.dtag_list:
+            return self
 
-        return XmapArray([_dtag for _dtag in self.dtag_list if _dtag in dtags], view)
+        return XmapArray(self.dtag_list + [dtag], np.vstack((self.xmap_array, row[np.newaxis, :])))
 
 
 def from_unaligned_dataset_c(dataset: DatasetInterface,
@@ -721,7 +749,27 @@ def from_unaligned_dataset_c(dataset: DatasetInterface,
     return xmap
 
 
+def from_unaligned_dataset_c_flat_cached(dataset: DatasetInterface,
+                                         alignment: AlignmentInterface,
+                                         grid: GridInterface,
+                                         structure_factors: StructureFactorsInterface,
+                                         xmap_cache: XmapCache,
+                                         ):
+    sample_rate = dataset.reflections.get_resolution() / 0.5
+    key = get_xmap_key(dataset, alignment, grid, structure_factors, sample_rate)
+
+    masked_array = xmap_cache.load(key)
+    if masked_array is None:
+        masked_array = from_unaligned_dataset_c_flat(dataset, alignment, grid, structure_factors).astype(np.float32)
+        xmap_cache.save(key, masked_array)
+
+    return masked_array
+
+
 class LoadXmap(LoadXMapInterface):
+    def __init__(self, cache_path: Optional[Path] = None):
+        self.cache_path = cache_path
+
     def __call__(
             self,
             dataset: DatasetInterface,
@@ -729,7 +777,17 @@ class LoadXmap(LoadXMapInterface):
             grid: GridInterface,
             structure_factors: StructureFactorsInterface,
             sample_rate: float = 3) -> XmapInterface:
-        return from_unaligned_dataset_c(dataset, alignment, grid, structure_factors, sample_rate)
+        if not self.cache_path:
+            return from_unaligned_dataset_c(dataset, alignment, grid, structure_factors, sample_rate)
+
+        # Aligned xmaps are zero outside of the total mask, so the masked values are enough to rebuild them
+        masked_array = from_unaligned_dataset_c_flat_cached(dataset, alignment, grid, structure_factors,
+                                                            XmapCache(self.cache_path))
+        new_grid = grid.new_grid()
+        new_grid_array = np.array(new_grid, copy=False)
+        new_grid_array[grid.partitioning.total_mask == 1] = masked_array
+
+        return Xmap(new_grid)
 
 
 def from_unaligned_dataset_c_flat(dataset: DatasetInterface,
@@ -753,6 +811,9 @@ def from_unaligned_dataset_c_flat(dataset: DatasetInterface,
 
 
 class LoadXmapFlat(LoadXMapFlatInterface):
+    def __init__(self, cache_path: Optional[Path] = None):
+        self.cache_path = cache_path
+
     def __call__(
             self,
             dataset: DatasetInterface,
@@ -760,7 +821,11 @@ class LoadXmapFlat(LoadXMapFlatInterface):
             grid: GridInterface,
             structure_factors: StructureFactorsInterface,
             sample_rate: float = 3) -> XmapInterface:
-        return from_unaligned_dataset_c_flat(dataset, alignment, grid, structure_factors, sample_rate)
+        if not self.cache_path:
+            return from_unaligned_dataset_c_flat(dataset, alignment, grid, structure_factors, sample_rate)
+
+        return from_unaligned_dataset_c_flat_cached(dataset, alignment, grid, structure_factors,
+                                                    XmapCache(self.cache_path))
 
 
 # @ray.remote
@@ -802,8 +867,12 @@ class LoadXmapFlat(LoadXMapFlatInterface):
 
 
 class GetMapStatistics:
-    def __init__(self, xmap: Union[XmapInterface, ZmapInterface]):
-        array = xmap.to_array()
+    def __init__(self, xmap: Union[XmapInterface, ZmapInterface], grid: Optional[GridInterface] = None):
+        # Z-maps only hold their masked values, so they need the grid to be densified
+        if grid is None:
+            array = xmap.to_array()
+        else:
+            array = xmap.to_array(grid)
 
         self.mean = np.mean(array[array > 0])
         self.std = np.std(array[array > 0])
@@ -3,7 +3,6 @@ from __future__ import annotations
 import typing
 import dataclasses
 
-import itertools
 from pathlib import Path
 
 from scipy import spatial
@@ -16,25 +15,75 @@ from pandda_gemmi.analyse_interface import *
 from pandda_gemmi.constants import *
 from pandda_gemmi.python_types import *
 from pandda_gemmi.dataset import ResidueID, Reference, Structure, Symops
+from pandda_gemmi.common import get_points_around, grid_coords_to_orthogonal
 
 
 
 @dataclasses.dataclass()
 class Partitioning(PartitioningInterface):
-    partitioning: typing.Dict[ResidueIDInterface, typing.Dict[GridCoordInterface, PositionInterface]]
+    # The points of residue residue_ids[i] are points[residue_offsets[i]:residue_offsets[i+1]]
+    residue_ids: typing.List[ResidueIDInterface]
+    points: np.ndarray  # int32 [n, 3], grid coordinates which are not wrapped into the unit cell
+    positions: np.ndarray  # float32 [n, 3], orthogonal positions of the points
+    residue_offsets: np.ndarray  # int64 [r + 1]
     protein_mask: gemmi.Int8Grid
     inner_mask: gemmi.Int8Grid
     contact_mask: gemmi.Int8Grid
     symmetry_mask: gemmi.Int8Grid
     total_mask: np.ndarray
 
+    def __post_init__(self):
+        self.residue_indexes = {residue_id: i for i, residue_id in enumerate(self.residue_ids)}
+
+    def residue_slice(self, item: ResidueIDInterface) -> slice:
+        i = self.residue_indexes[item]
+        return slice(int(self.residue_offsets[i]), int(self.residue_offsets[i + 1]))
+
+    def get_points(self, item: ResidueIDInterface) -> np.ndarray:
+        return self.points[self.residue_slice(item)]
+
+    def get_positions(self, item: ResidueIDInterface) -> np.ndarray:
+        return self.positions[self.residue_slice(item)]
+
     def __getitem__(self, item: ResidueIDInterface):
-        return self.partitioning[item]
+        residue_slice = self.residue_slice(item)
+        return {
+            (int(point[0]), int(point[1]), int(point[2])): (float(position[0]), float(position[1]), float(position[2]))
+            for point, position
+            in zip(self.points[residue_slice], self.positions[residue_slice])
+        }
 
     def __iter__(self) -> Iterator[ResidueIDInterface]:
-        for residue_id in self.partitioning:
+        for residue_id in self.residue_ids:
             yield residue_id
 
+    def __contains__(self, item: ResidueIDInterface) -> bool:
+        return item in self.residue_indexes
+
+    def __len__(self) -> int:
+        return len(self.residue_ids)
+
+    @property
+    def partitioning(self) -> typing.Dict[ResidueIDInterface, typing.Dict[GridCoordInterface, PositionInterface]]:
+        return {residue_id: self[residue_id] for residue_id in self.residue_ids}
+
+    @staticmethod
+    def from_residue_indexes(residue_ids: typing.List[ResidueIDInterface],
+                             residue_indexes: np.ndarray,
+                             points: np.ndarray,
+                             positions: np.ndarray,
+                             ):
+        # Group the points of each residue contiguously, ordered by the index of the residue in residue_ids
+        order = np.argsort(residue_indexes, kind="stable")
+        unique_residue_indexes, residue_starts = np.unique(residue_indexes[order], return_index=True)
+        residue_offsets = np.append(residue_starts, order.size).astype(np.int64)
+
+        return ([residue_ids[int(i)] for i in unique_residue_indexes],
+                np.ascontiguousarray(points[order], dtype=np.int32).reshape((-1, 3)),
+                np.ascontiguousarray(positions[order], dtype=np.float32).reshape((-1, 3)),
+                residue_offsets,
+                )
+
     @staticmethod
     def from_reference(reference: ReferenceInterface,
                        grid: gemmi.FloatGrid,
@@ -114,13 +163,15 @@ class Partitioning(PartitioningInterface):
 
         # Get the grid of points around the protein
 
-        coord_product = itertools.product(
-            range(grid_min_coord[0], grid_max_coord[0]),
-            range(grid_min_coord[1], grid_max_coord[1]),
-            range(grid_min_coord[2], grid_max_coord[2]),
-        )
-
-        coord_array = np.array([[x, y, z] for x, y, z in coord_product])
+        coord_array = np.stack(
+            np.meshgrid(
+                np.arange(grid_min_coord[0], grid_max_coord[0]),
+                np.arange(grid_min_coord[1], grid_max_coord[1]),
+                np.arange(grid_min_coord[2], grid_max_coord[2]),
+                indexing="ij",
+            ),
+            axis=-1,
+        ).reshape((-1, 3))
 
         coord_tuple = (coord_array[:, 0],
                        coord_array[:, 1],
@@ -230,6 +281,10 @@ class Partitioning(PartitioningInterface):
                              )
         return positions
 
+    @staticmethod
+    def get_position_array(mask, coord_array):
+        return grid_coords_to_orthogonal(mask, coord_array)
+
     @staticmethod
     def from_structure_multiprocess(structure: StructureInterface,
                                     grid: CrystallographicGridInterface,  #: Grid,
@@ -338,33 +393,17 @@ class Partitioning(PartitioningInterface):
         )
 
         # Get positions
-        position_list = Partitioning.get_position_list(mask, coord_array)
-        position_array = np.array(position_list)
+        position_array = Partitioning.get_position_array(mask, coord_array)
 
         distances, indexes = kdtree.query(position_array)
 
         # Get the partitions
-        partitions = {}
-        for i, coord_as_array in enumerate(coord_array):
-            coord = (int(coord_as_array[0]),
-                     int(coord_as_array[1]),
-                     int(coord_as_array[2]),
-                     )
-            position = position_list[i]
-
-            res_num = indexes[i]
-
-            res_id = res_indexes[res_num]
-            if res_id not in partitions:
-                partitions[res_id] = {}
-
-            # partitions[res_id][coord] = gemmi.Position(*position)
-
-            coord_unit_cell = (int(coord_array_unit_cell_in_mask[0][i]),
-                               int(coord_array_unit_cell_in_mask[1][i]),
-                               int(coord_array_unit_cell_in_mask[2][i]),
-                               )
-            partitions[res_id][coord] = position
+        residue_ids, points, positions, residue_offsets = Partitioning.from_residue_indexes(
+            [res_indexes[i] for i in range(len(res_indexes))],
+            np.asarray(indexes),
+            coord_array,
+            position_array,
+        )
 
         total_mask = np.zeros(mask_array.shape, dtype=np.int8)
         total_mask[
@@ -373,7 +412,8 @@ class Partitioning(PartitioningInterface):
             coord_array_unit_cell_in_mask[2][combined_indicies == 1],
         ] = 1
 
-        return Partitioning(partitions, mask,
+        return Partitioning(residue_ids, points, positions, residue_offsets,
+                            mask,
                             inner_mask,
                             contact_mask,
                             symmetry_mask, total_mask)
@@ -389,13 +429,7 @@ class Partitioning(PartitioningInterface):
         return coord_tuple
 
     def coord_array(self):
-
-        coord_list = []
-        for res_id in self.partitioning:
-            for coord in self.partitioning[res_id]:
-                coord_list.append(coord)
-
-        return np.array(coord_list)
+        return self.points
 
     @staticmethod
     def get_symmetry_contact_mask(structure: Structure, grid: gemmi.FloatGrid,
@@ -534,13 +568,14 @@ class Partitioning(PartitioningInterface):
         ccp4.write_ccp4_map(str(dir / PANDDA_TOTAL_MASK_FILE))
 
     def __getstate__(self):
-        # partitioning_python = PartitoningPython.from_gemmi(self.partitioning)
-        partitioning_python = self.partitioning
         protein_mask_python = Int8GridPython.from_gemmi(self.protein_mask)
         inner_mask_python = Int8GridPython.from_gemmi(self.inner_mask)
         contact_mask_python = Int8GridPython.from_gemmi(self.contact_mask)
         symmetry_mask_python = Int8GridPython.from_gemmi(self.symmetry_mask)
-        return (partitioning_python,
+        return (self.residue_ids,
+                self.points,
+                self.positions,
+                self.residue_offsets,
                 protein_mask_python,
                 inner_mask_python,
                 contact_mask_python,
@@ -549,18 +584,16 @@ class Partitioning(PartitioningInterface):
                 )
 
     def __setstate__(self, data):
-        partitioning_gemmi = data[0]
-        protein_mask_gemmi = data[1].to_gemmi()
-        inner_mask_gemmi = data[2].to_gemmi()
-        contact_mask_gemmi = data[3].to_gemmi()
-        symmetry_mask_gemmi = data[4].to_gemmi()
-
-        self.partitioning = partitioning_gemmi
-        self.protein_mask = protein_mask_gemmi
-        self.inner_mask = inner_mask_gemmi
-        self.contact_mask = contact_mask_gemmi
-        self.symmetry_mask = symmetry_mask_gemmi
-        self.total_mask = data[5]
+        self.residue_ids = data[0]
+        self.points = data[1]
+        self.positions = data[2]
+        self.residue_offsets = data[3]
+        self.protein_mask = data[4].to_gemmi()
+        self.inner_mask = data[5].to_gemmi()
+        self.contact_mask = data[6].to_gemmi()
+        self.symmetry_mask = data[7].to_gemmi()
+        self.total_mask = data[8]
+        self.__post_init__()
 
 
 @dataclasses.dataclass()
@@ -611,11 +644,14 @@ class Grid(GridInterface):
 
     def __setstate__(self, data):
         self.partitioning = Partitioning(data[1][0],
-                                         data[1][1].to_gemmi(),
-                                         data[1][2].to_gemmi(),
-                                         data[1][3].to_gemmi(),
+                                         data[1][1],
+                                         data[1][2],
+                                         data[1][3],
                                          data[1][4].to_gemmi(),
-                                         data[1][5]
+                                         data[1][5].to_gemmi(),
+                                         data[1][6].to_gemmi(),
+                                         data[1][7].to_gemmi(),
+                                         data[1][8]
                                          )
         self.grid = data[0].to_gemmi()
 
@@ -643,6 +679,45 @@ def get_grid_from_reference(
     return Grid(grid, partitioning)
 
 
+@dataclasses.dataclass()
+class ProteinMasks:
+    # Bit packed masks of the points near reference protein atoms, which only depend on the reference and grid
+    shape: typing.Tuple[int, int, int]
+    inner_packed: np.ndarray
+    outer_packed: np.ndarray
+
+    @staticmethod
+    def from_reference(reference: ReferenceInterface,
+                       grid: GridInterface,
+                       inner_radius: float = 1.25,
+                       outer_radius: float = 6.0,
+                       ):
+        shape = (grid.grid.nu, grid.grid.nv, grid.grid.nw)
+        unit_cell = grid.grid.unit_cell
+
+        protein_positions = np.array(
+            [[atom.pos.x, atom.pos.y, atom.pos.z] for atom in reference.dataset.structure.protein_atoms()]
+        ).reshape((-1, 3))
+
+        inner_mask = np.zeros(shape, dtype=bool)
+        inner_mask[get_points_around(shape, unit_cell, protein_positions, inner_radius)] = True
+
+        outer_mask = np.zeros(shape, dtype=bool)
+        outer_mask[get_points_around(shape, unit_cell, protein_positions, outer_radius)] = True
+
+        return ProteinMasks(shape, np.packbits(inner_mask, axis=None), np.packbits(outer_mask, axis=None))
+
+    def inner_mask(self) -> np.ndarray:
+        return self._unpack(self.inner_packed)
+
+    def outer_mask(self) -> np.ndarray:
+        return self._unpack(self.outer_packed)
+
+    def _unpack(self, packed: np.ndarray) -> np.ndarray:
+        size = self.shape[0] * self.shape[1] * self.shape[2]
+        return np.unpackbits(packed, count=size).astype(bool).reshape(self.shape)
+
+
 class GetGrid(GetGridInterface):
     def __call__(self,
                  reference: ReferenceInterface,
@@ -4,20 +4,21 @@ import time
 import typing
 from typing import *
 import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy.cluster.hierarchy import fclusterdata
 from sklearn.cluster import DBSCAN
 from joblib.externals.loky import set_loky_pickler
-from pandda_gemmi.analyse_interface import AlignmentInterface, AlignmentsInterface, CrystallographicGridInterface, DatasetsInterface, EDClusteringsInterface, EventsInterface, GridInterface, ModelInterface, PanDDAFSModelInterface, ProcessorInterface, StructureFactorsInterface, XmapsInterface
+from pandda_gemmi.analyse_interface import AlignmentInterface, AlignmentsInterface, DatasetsInterface, EDClusteringsInterface, EventsInterface, GridInterface, ModelInterface, PanDDAFSModelInterface, ProcessorInterface, StructureFactorsInterface, XmapsInterface
 
 set_loky_pickler('pickle')
 
 from pandda_gemmi.analyse_interface import *
 # from pandda_gemmi.pandda_functions import save_event_map
 from pandda_gemmi.python_types import *
-from pandda_gemmi.common import EventIDX, EventID, SiteID, Dtag, PositionsArray, delayed
+from pandda_gemmi.common import EventIDX, EventID, SiteID, Dtag, delayed, get_points_around
 from pandda_gemmi.dataset import Reference, Dataset, StructureFactors
-from pandda_gemmi.edalignment import Grid, Xmap, Alignment, Xmaps, Partitioning
+from pandda_gemmi.edalignment import Grid, Xmap, Alignment, Xmaps, NativeFrame
 from pandda_gemmi.model import Zmap, Zmaps, Model
 from pandda_gemmi.sites import Sites
 from pandda_gemmi.density_clustering import Cluster, Clustering, Clusterings
@@ -36,6 +37,7 @@ def save_event_map(
         mask_radius_symmetry: float,
         partitioning: PartitioningInterface,
         sample_rate: float,
+        native_frame: Optional[NativeFrame] = None,
         # native_grid,
 ):
     reference_xmap_grid = xmap.xmap
@@ -57,7 +59,7 @@ def save_event_map(
                                               copy=False,
                                               )
 
-    mean_array = model.mean
+    mean_array = model.get_mean_array(grid)
     event_map_reference_grid_array[:, :, :] = (reference_xmap_grid_array - (event.bdc.bdc * mean_array)) / (
             1 - event.bdc.bdc)
 
@@ -71,6 +73,7 @@ def save_event_map(
         partitioning,
         mask_radius_symmetry,
         sample_rate * 2,  # TODO: remove?
+        native_frame=native_frame,
     )
 
     # # # Get the event bounding box
@@ -103,25 +106,65 @@ def save_event_map(
     ccp4.write_ccp4_map(str(path))
 
 
+def write_native_frame_map(path: Path, native_frame: NativeFrame, values: np.ndarray):
+    ccp4 = gemmi.Ccp4Map()
+    ccp4.grid = native_frame.to_grid(values)
+    ccp4.update_ccp4_header(2, True)
+    ccp4.setup()
+    ccp4.write_ccp4_map(str(path))
+
+
+def save_dataset_event_maps(
+        paths: List[Path],
+        bdcs: List[float],
+        xmap: XmapInterface,
+        model: ModelInterface,
+        grid: GridInterface,
+        native_frame: NativeFrame,
+        num_threads: int = 1,
+):
+    # Interpolation back to the native frame is linear, so the xmap and mean are interpolated once and each event
+    # map is formed from them directly
+    xmap_values = native_frame.interpolate_values(xmap.xmap)
+    mean_values = native_frame.interpolate_values(Zmap.grid_from_grid_template(xmap.xmap, model.get_mean_array(grid)))
+
+    def write_event_map(path: Path, bdc: float):
+        write_native_frame_map(path, native_frame, (xmap_values - (bdc * mean_values)) / (1 - bdc))
+
+    with ThreadPoolExecutor(max(num_threads, 1)) as executor:
+        futures = [executor.submit(write_event_map, path, bdc) for path, bdc in zip(paths, bdcs)]
+        for future in futures:
+            future.result()
+
+
 def get_event_mask_indicies(zmap: ZmapInterface, cluster_positions_array: NDArrayInterface) -> NDArrayInterface:
     # cluster_positions_array = extrema_cart_coords_array[cluster_indicies]
-    positions = PositionsArray(cluster_positions_array).to_positions()
-    event_mask = gemmi.Int8Grid(*zmap.shape())
-    event_mask.spacegroup = zmap.spacegroup()
-    event_mask.set_unit_cell(zmap.unit_cell())
-    for position in positions:
-        event_mask.set_points_around(position,
-                                     radius=2.0,
-                                     value=1,
-                                     )
+    event_mask_array = np.zeros(zmap.shape(), dtype=np.int8)
+    event_mask_array[get_points_around(zmap.shape(), zmap.unit_cell(), cluster_positions_array, 2.0)] = 1
 
     # event_mask.symmetrize_max()
 
-    event_mask_array = np.array(event_mask, copy=True, dtype=np.int8)
     event_mask_indicies = np.nonzero(event_mask_array)
     return event_mask_indicies
 
 
+def get_bdc_correlations(xmap_values: np.ndarray, mean_values: np.ndarray, bdcs: np.ndarray) -> np.ndarray:
+    # Correlation of the mean map with xmap - bdc * mean for every bdc, from the centred second moments
+    xmap_values = xmap_values.astype(np.float64)
+    mean_values = mean_values.astype(np.float64)
+    xmap_centred = xmap_values - np.mean(xmap_values)
+    mean_centred = mean_values - np.mean(mean_values)
+
+    mean_variance = np.dot(mean_centred, mean_centred)
+    xmap_variance = np.dot(xmap_centred, xmap_centred)
+    covariance = np.dot(mean_centred, xmap_centred)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (covariance - bdcs * mean_variance) / np.sqrt(
+            mean_variance * (xmap_variance - 2 * bdcs * covariance + np.square(bdcs) * mean_variance)
+        )
+
+
 @dataclasses.dataclass()
 class BDC:
     bdc: float
@@ -134,8 +177,11 @@ class BDC:
 
     @staticmethod
     def from_cluster(xmap: Xmap, model: Model, cluster: Cluster, dtag: Dtag, grid: Grid,
-                     min_bdc=0.0, max_bdc=0.95, steps=100):
-        xmap_array = xmap.to_array(copy=True)
+                     min_bdc=0.0, max_bdc=0.95, steps=100, refine_steps=0, mean_array=None):
+        # The dense mean can be passed in to avoid rebuilding it for every cluster
+        if mean_array is None:
+            mean_array = model.get_mean_array(grid)
+        xmap_array = xmap.to_array(copy=False)
 
         cluster_indexes = cluster.event_mask_indicies
 
@@ -143,30 +189,31 @@ class BDC:
         protein_mask_indicies = np.nonzero(protein_mask)
 
         xmap_masked = xmap_array[protein_mask_indicies]
-        mean_masked = model.mean[protein_mask_indicies]
+        mean_masked = mean_array[protein_mask_indicies]
         cluster_array = np.full(protein_mask.shape, False)
         cluster_array[cluster_indexes] = True
         cluster_mask = cluster_array[protein_mask_indicies]
 
-        vals = {}
-        for val in np.linspace(min_bdc, max_bdc, steps):
-            subtracted_map = xmap_masked - val * mean_masked
-            cluster_vals = subtracted_map[cluster_mask]
-            # local_correlation = stats.pearsonr(mean_masked[cluster_mask],
-            #                                    cluster_vals)[0]
-            # local_correlation, local_offset = np.polyfit(x=mean_masked[cluster_mask], y=cluster_vals, deg=1)
-            local_correlation = np.corrcoef(x=mean_masked[cluster_mask], y=cluster_vals)[0, 1]
+        mean_cluster = mean_masked[cluster_mask]
+        xmap_cluster = xmap_masked[cluster_mask]
 
-            # global_correlation = stats.pearsonr(mean_masked,
-            #                                     subtracted_map)[0]
-            # global_correlation, global_offset = np.polyfit(x=mean_masked, y=subtracted_map, deg=1)
-            global_correlation = np.corrcoef(x=mean_masked, y=subtracted_map)[0, 1]
+        def get_vals(bdcs):
+            local_correlations = get_bdc_correlations(xmap_cluster, mean_cluster, bdcs)
+            global_correlations = get_bdc_correlations(xmap_masked, mean_masked, bdcs)
+            return np.abs(global_correlations - local_correlations)
 
-            vals[val] = np.abs(global_correlation - local_correlation)
+        bdcs = np.linspace(min_bdc, max_bdc, steps)
+        vals = get_vals(bdcs)
+        mean_fraction = bdcs[np.argmax(vals)]
 
-        mean_fraction = max(vals,
-                            key=lambda x: vals[x],
-                            )
+        # Optionally search more finely around the best fraction
+        if refine_steps > 0 and steps > 1:
+            step = bdcs[1] - bdcs[0]
+            fine_bdcs = np.linspace(max(mean_fraction - step, min_bdc), min(mean_fraction + step, max_bdc),
+                                    refine_steps)
+            fine_vals = get_vals(fine_bdcs)
+            if np.max(fine_vals) > np.max(vals):
+                mean_fraction = fine_bdcs[np.argmax(fine_vals)]
 
         return BDC(
             mean_fraction,
@@ -241,6 +288,7 @@ class Events:
             events = {event_id: event for event_id, event in zip(jobs.keys(), results)}
 
         else:
+            mean_array = model.get_mean_array(grid)
             for dtag in clusterings:
                 clustering = clusterings[dtag]
                 for event_idx in clustering:
@@ -249,7 +297,8 @@ class Events:
 
                     cluster = clustering[event_idx.event_idx]
                     xmap = xmaps[dtag]
-                    bdc = BDC.from_cluster(xmap, model, cluster, dtag, grid, min_bdc, max_bdc, )
+                    bdc = BDC.from_cluster(xmap, model, cluster, dtag, grid, min_bdc, max_bdc,
+                                           mean_array=mean_array)
 
                     site: SiteID = sites.event_to_site[event_id]
 
@@ -383,8 +432,9 @@ class Events:
             outer_mask: float,
             inner_mask_symmetry: float ,
             sample_rate: float,
-            native_grid: CrystallographicGridInterface,
             mapper: Optional[ProcessorInterface]=False,
+            native_frames: Optional[Dict[DtagInterface, NativeFrame]] = None,
+            num_threads: int = 4,
     ):
 
         processed_datasets = {}
@@ -419,39 +469,40 @@ class Events:
                 ) == 0:
                     event_dtag_list.append(dtag)
 
+            # The native frame of each dataset is computed once and shared by all of its event maps
+            if native_frames is None:
+                native_frames = {}
+            missing_dtag_list = [dtag for dtag in event_dtag_list if dtag not in native_frames]
             results = mapper(
                 delayed(
-                    Partitioning.from_structure_multiprocess)(
-                    datasets[dtag].structure,
-                    # grid,
-                    native_grid,
+                    NativeFrame.from_dataset)(
+                    datasets[dtag],
+                    alignments[dtag],
+                    grid,
+                    structure_factors,
                     outer_mask,
                     inner_mask_symmetry,
                 )
                 for dtag
-                in event_dtag_list
+                in missing_dtag_list
             )
 
-            partitioning_dict = {dtag: partitioning for dtag, partitioning in zip(event_dtag_list, results)}
+            native_frames = {**native_frames, **{dtag: native_frame for dtag, native_frame in zip(missing_dtag_list, results)}}
 
             results = mapper(
                 delayed(
-                    save_event_map)(
-                    processed_datasets[event_id.dtag].event_map_files[event_id.event_idx].path,
-                    xmaps[event_id.dtag],
+                    save_dataset_event_maps)(
+                    [processed_datasets[event_id.dtag].event_map_files[event_id.event_idx].path
+                     for event_id in event_id_list if event_id.dtag == dtag],
+                    [self[event_id].bdc.bdc for event_id in event_id_list if event_id.dtag == dtag],
+                    xmaps[dtag],
                     model,
-                    self[event_id],
-                    datasets[event_id.dtag],
-                    alignments[event_id.dtag],
                     grid,
-                    structure_factors,
-                    outer_mask,
-                    inner_mask_symmetry,
-                    partitioning_dict[event_id.dtag],
-                    sample_rate,
+                    native_frames[dtag],
+                    num_threads,
                 )
-                for event_id
-                in event_id_list
+                for dtag
+                in event_dtag_list
             )
 
 
@@ -7,7 +7,9 @@ import joblib
 import scipy
 from scipy import spatial as spsp, optimize
 from pathlib import Path
+import os
 import time
+import hashlib
 
 
 #
@@ -15,6 +17,7 @@ from pandda_gemmi.analyse_interface import *
 from pandda_gemmi.dataset import Dataset
 # from pandda_gemmi.fs import PanDDAFSModel, ProcessedDataset
 from pandda_gemmi.event import Cluster
+from pandda_gemmi.edalignment.grid import ProteinMasks
 # from pandda_gemmi.autobuild import score_structure_signal_to_noise_density, EXPERIMENTAL_score_structure_signal_to_noise_density
 from pandda_gemmi.scoring import EXPERIMENTAL_score_structure_signal_to_noise_density, score_structure_contour
 from pandda_gemmi.python_types import *
@@ -67,10 +70,19 @@ class ConformerFittingResult(ConformerFittingResultInterface):
 
 
 def get_structures_from_mol(mol: Chem.Mol, max_conformers) -> MutableMapping[ConfromerIDInterface, gemmi.Structure]:
-    fragment_structures: MutableMapping[ConfromerIDInterface, gemmi.Structure] = {}
-    for i, conformer in enumerate(mol.GetConformers()):
+    atom_symbols = [atom.GetSymbol() for atom in mol.GetAtoms()]
+    conformer_positions = [conformer.GetPositions() for conformer in mol.GetConformers()]
+
+    return get_structures_from_positions(atom_symbols, conformer_positions, max_conformers)
+
 
-        positions: np.ndarray = conformer.GetPositions()
+def get_structures_from_positions(
+        atom_symbols: List[str],
+        conformer_positions: List[np.ndarray],
+        max_conformers,
+) -> MutableMapping[ConfromerIDInterface, gemmi.Structure]:
+    fragment_structures: MutableMapping[ConfromerIDInterface, gemmi.Structure] = {}
+    for i, positions in enumerate(conformer_positions):
 
         structure: gemmi.Structure = gemmi.Structure()
         model: gemmi.Model = gemmi.Model(f"{i}")
@@ -80,9 +92,8 @@ def get_structures_from_mol(mol: Chem.Mol, max_conformers) -> MutableMapping[Con
         residue.seqid = gemmi.SeqId(1, ' ')
 
         # Loop over atoms, adding them to a gemmi residue
-        for j, atom in enumerate(mol.GetAtoms()):
+        for j, atom_symbol in enumerate(atom_symbols):
             # Get the atomic symbol
-            atom_symbol: str = atom.GetSymbol()
             gemmi_element: gemmi.Element = gemmi.Element(atom_symbol)
 
             # Get the position as a gemmi type
@@ -228,12 +239,72 @@ class Conformers(ConformersInterface):
         self.path = state[2]
 
 
+# Conformers already generated in this process, keyed by canonical smiles and embedding parameters
+_CONFORMER_CACHE: Dict[str, Tuple[List[str], List[np.ndarray]]] = {}
+
+
+def get_conformer_cache_key(mol: Chem.Mol, pruning_threshold, num_pose_samples, max_conformers) -> str:
+    canonical_smiles = Chem.MolToSmiles(mol, canonical=True)
+    key_string = f"{canonical_smiles} {pruning_threshold} {num_pose_samples} {max_conformers}"
+    return hashlib.sha256(key_string.encode()).hexdigest()
+
+
+def get_conformer_positions(
+        mol: Chem.Mol,
+        pruning_threshold,
+        num_pose_samples,
+        max_conformers,
+        conformer_cache_path: Optional[Path] = None,
+) -> Tuple[List[str], List[np.ndarray]]:
+    key = get_conformer_cache_key(mol, pruning_threshold, num_pose_samples, max_conformers)
+
+    if key in _CONFORMER_CACHE:
+        return _CONFORMER_CACHE[key]
+
+    cache_file = None
+    if conformer_cache_path:
+        cache_file = Path(conformer_cache_path) / f"{key}.npz"
+        if cache_file.exists():
+            with np.load(str(cache_file)) as cached:
+                atom_symbols = [str(symbol) for symbol in cached["atom_symbols"]]
+                conformer_positions = [positions for positions in cached["conformer_positions"]]
+            _CONFORMER_CACHE[key] = (atom_symbols, conformer_positions)
+            return _CONFORMER_CACHE[key]
+
+    # Generate conformers
+    mol: Chem.Mol = Chem.AddHs(mol)
+
+    # Generate conformers
+    cids = AllChem.EmbedMultipleConfs(
+        mol,
+        numConfs=num_pose_samples,
+        pruneRmsThresh=pruning_threshold)
+
+    # Only the conformers that can be used are kept
+    atom_symbols = [atom.GetSymbol() for atom in mol.GetAtoms()]
+    conformer_positions = [conformer.GetPositions() for conformer in mol.GetConformers()][:max_conformers + 1]
+    _CONFORMER_CACHE[key] = (atom_symbols, conformer_positions)
+
+    if cache_file:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_cache_file = cache_file.parent / f"{key}.{os.getpid()}.tmp.npz"
+        np.savez(
+            str(tmp_cache_file),
+            atom_symbols=np.array(atom_symbols),
+            conformer_positions=np.array(conformer_positions).reshape((-1, len(atom_symbols), 3)),
+        )
+        os.replace(str(tmp_cache_file), str(cache_file))
+
+    return atom_symbols, conformer_positions
+
+
 def get_conformers(
         fragment_dataset: ProcessedDatasetInterface,
         pruning_threshold=1.5,
         num_pose_samples=1000,
         max_conformers=10,
         debug: Debug = Debug.DEFAULT,
+        conformer_cache_path: Optional[Path] = None,
 ) -> ConformersInterface:
     # Decide how to load
     # fragment_structures = {}
@@ -273,18 +344,19 @@ def get_conformers(
         print(f'\t\tGetting mol from ligand smiles')
     mol = get_fragment_mol_from_dataset_smiles_path(smiles_path)
 
-    # Generate conformers
-    mol: Chem.Mol = Chem.AddHs(mol)
-
-    # Generate conformers
-    cids = AllChem.EmbedMultipleConfs(
+    # Generate conformers, or reuse those of the same ligand
+    atom_symbols, conformer_positions = get_conformer_positions(
         mol,
-        numConfs=num_pose_samples,
-        pruneRmsThresh=pruning_threshold)
+        pruning_threshold,
+        num_pose_samples,
+        max_conformers,
+        conformer_cache_path,
+    )
 
     # Translate to structures
-    fragment_structures: MutableMapping[ConfromerIDInterface, gemmi.Structure] = get_structures_from_mol(
-        mol,
+    fragment_structures: MutableMapping[ConfromerIDInterface, gemmi.Structure] = get_structures_from_positions(
+        atom_symbols,
+        conformer_positions,
         max_conformers,
     )
 
@@ -550,6 +622,56 @@ def score_fit_nonquant_array(structure_array, grid, distance, params):
     return float(-score)
 
 
+def transform_structure_population(
+        structure_array,
+        transform_arrays,
+        rotation_matrices,
+):
+    # structure_array[n, 3], transform_arrays[s, 3], rotation_matrices[s, 3, 3] -> transformed[s, n, 3]
+    structure_mean = np.mean(structure_array, axis=0)
+
+    demeaned_structure = structure_array - structure_mean
+
+    rotated_structures = np.matmul(demeaned_structure[np.newaxis, :, :], rotation_matrices)
+
+    transformed_arrays = rotated_structures + structure_mean + transform_arrays[:, np.newaxis, :]
+
+    return transformed_arrays
+
+
+def score_fit_nonquant_population(structure_array, grid, distance, population):
+    # Scores every candidate of a differential evolution population at once: population[6, s] -> scores[s]
+    x, y, z, rx, ry, rz = population
+
+    translations = distance * np.stack([x, y, z], axis=-1)
+
+    rotations = spsp.transform.Rotation.from_euler(
+        "xyz",
+        np.stack([rx * 360, ry * 360, rz * 360], axis=-1),
+        degrees=True)
+    rotation_matrices: np.ndarray = rotations.as_matrix()
+
+    transformed_structure_arrays = transform_structure_population(
+        structure_array,
+        translations,
+        rotation_matrices,
+    )
+
+    num_candidates, n = transformed_structure_arrays.shape[0], structure_array.shape[0]
+
+    vals = get_interpolated_values_c(
+        grid,
+        np.ascontiguousarray(transformed_structure_arrays.reshape((-1, 3))),
+        num_candidates * n,
+    ).reshape((num_candidates, n))
+
+    vals[vals > 3.0] = 3.0
+
+    scores = np.sum(vals, axis=1)
+
+    return -scores.astype(np.float64)
+
+
 def DEP_score_fit(structure, grid, distance, params):
     x, y, z, rx, ry, rz = params
 
@@ -797,7 +919,9 @@ def score_conformer_nonquant_array(cluster: Cluster,
                                    resolution,
                                    rate,
                                    event_fit_num_trys=3,
-                                   debug: Debug = Debug.DEFAULT) -> ConformerFittingResultInterface:
+                                   debug: Debug = Debug.DEFAULT,
+                                   event_fit_num_threads=1,
+                                   ) -> ConformerFittingResultInterface:
     # Center the conformer at the cluster
     centroid_cart = cluster.centroid
 
@@ -834,20 +958,17 @@ def score_conformer_nonquant_array(cluster: Cluster,
     if debug >= Debug.PRINT_NUMERICS:
         print(f"Structure array: {structure_array}")
 
-    scores = []
-    scores_signal_to_noise = []
-    logs = []
-    optimised_structures = []
-    for j in range(event_fit_num_trys):
+    def fit_conformer(j):
         start_diff_ev = time.time()
 
+        # The whole population is scored in one batch per generation
         res = optimize.differential_evolution(
-            lambda params: score_fit_nonquant_array(
+            lambda population: score_fit_nonquant_population(
                 structure_array,
                 zmap_grid,
                 # 12.0,
                 1.0,
-                params
+                population
             ),
             [
                 # (-3, 3), (-3, 3), (-3, 3),
@@ -856,29 +977,12 @@ def score_conformer_nonquant_array(cluster: Cluster,
                 (0.0, 1.0), (0.0, 1.0), (0.0, 1.0)
             ],
             # popsize=30,
+            vectorized=True,
+            updating="deferred",
         )
         if debug >= Debug.PRINT_NUMERICS:
             print(f"Fit Score: {res.fun}")
-        scores.append(res.fun)
         finish_diff_ev = time.time()
-        # TODO: back to debug
-        # if debug:
-        # print(f"\t\t\t\tdiff ev in: {finish_diff_ev - start_diff_ev}")
-        # print(f"\t\t\t\tOptimisation result: {res.x} {1-res.fun}")
-
-        # start_basin = time.time()
-        # res = optimize.basinhopping(
-        #     lambda params: score_fit(
-        #         probe_structure,
-        #         zmap_grid,
-        #         params
-        #     ),
-        #     x0=[0.0,0.0,0.0,0.0,0.0,0.0],
-        # )
-        # finish_basin = time.time()
-        # if debug:
-        #     print(f"\t\t\tbasin in: {finish_basin-start_basin}")
-        #     print(f"\t\t\tOptimisation result: {res.x} {res.fun}")
 
         # Get optimised fit
         x, y, z, rx, ry, rz = res.x
@@ -891,37 +995,13 @@ def score_conformer_nonquant_array(cluster: Cluster,
             ],
             degrees=True)
         rotation_matrix: np.ndarray = rotation.as_matrix().T
-        # optimised_structure = transform_structure(
-        #     probe_structure,
-        #     [x, y, z],
-        #     rotation_matrix
-        # )
         optimised_structure = transform_structure(
             centered_structure,
             [x, y, z],
             rotation_matrix
         )
-        optimised_structures.append(optimised_structure)
-
-        # TODO: Remove althogether
-        # optimised_structure.write_minimal_pdb(f"frag_{1-res.fun}_{str(res.x)}.pdb")
 
         # Score, by including the noise as well as signal
-        # if debug:
-        #     print(f"\t\t\t\tScoring optimized result by signal to noise")
-
-        # score, log = score_structure_signal_to_noise_density(
-        #     optimised_structure,
-        #     zmap_grid,
-        # )
-        # score = float(res.fun) / (int(cluster.values.size) + 1)
-
-        # score, log = EXPERIMENTAL_score_structure_rscc(
-        #     optimised_structure,
-        #     zmap_grid,
-        #     resolution,
-        #     rate
-        # )
         score, log = score_structure_contour(
             optimised_structure,
             zmap_grid,
@@ -931,10 +1011,21 @@ def score_conformer_nonquant_array(cluster: Cluster,
             structure_map_high_cut=0.6
         )
 
-        scores_signal_to_noise.append(score)
-        logs.append(log)
-        # score = 1-float(res.fun)
-        # print(f"\t\t\t\tScore: {score}")
+        return res, optimised_structure, score, log
+
+    if event_fit_num_threads > 1:
+        fits = joblib.Parallel(n_jobs=event_fit_num_threads, prefer="threads")(
+            joblib.delayed(fit_conformer)(j) for j in range(event_fit_num_trys)
+        )
+    else:
+        fits = [fit_conformer(j) for j in range(event_fit_num_trys)]
+
+    scores = [float(fit[0].fun) for fit in fits]
+    optimised_structures = [fit[1] for fit in fits]
+    scores_signal_to_noise = [fit[2] for fit in fits]
+    logs = [fit[3] for fit in fits]
+    res = fits[-1][0]
+    score = scores_signal_to_noise[-1]
 
     if debug >= Debug.PRINT_NUMERICS:
         print(f"Best fit score: {1 - min(scores)}")
@@ -1356,7 +1447,9 @@ def score_conformer(cluster: Cluster, conformer, zmap_grid, debug=False):
 
 def score_fragment_conformers(cluster, fragment_conformers: ConformersInterface, zmap_grid, res, rate,
                               event_fit_num_trys=3,
-                              debug: Debug = Debug.DEFAULT) -> LigandFittingResultInterface:
+                              debug: Debug = Debug.DEFAULT,
+                              event_fit_num_threads=1,
+                              ) -> LigandFittingResultInterface:
     if debug >= Debug.PRINT_NUMERICS:
         print("\t\t\t\tGetting fragment conformers from model")
 
@@ -1367,7 +1460,7 @@ def score_fragment_conformers(cluster, fragment_conformers: ConformersInterface,
         # results[conformer_id] = score_conformer(cluster, conformer, zmap_grid, debug)
         # results[conformer_id] = score_conformer_array(cluster, conformer, zmap_grid, debug)
         results[conformer_id] = score_conformer_nonquant_array(cluster, conformer, zmap_grid, res, rate,
-                                                               event_fit_num_trys, debug)
+                                                               event_fit_num_trys, debug, event_fit_num_threads)
 
     # scores = {conformer_id: result[0] for conformer_id, result in results.items()}
     # structures = {conformer_id: result[1] for conformer_id, result in results.items()}
@@ -1387,11 +1480,13 @@ def score_fragment_conformers(cluster, fragment_conformers: ConformersInterface,
 
 def score_cluster(cluster, zmap_grid: gemmi.FloatGrid, fragment_conformers: ConformersInterface, res, rate,
                   event_fit_num_trys=3,
-                  debug: Debug = Debug.DEFAULT) -> EventScoringResultInterface:
+                  debug: Debug = Debug.DEFAULT,
+                  event_fit_num_threads=1,
+                  ) -> EventScoringResultInterface:
     if debug:
         print(f"\t\t\t\tScoring cluster")
     ligand_fitting_result = score_fragment_conformers(cluster, fragment_conformers, zmap_grid, res, rate,
-                                                      event_fit_num_trys, debug)
+                                                      event_fit_num_trys, debug, event_fit_num_threads)
 
     return EventScoringResult(ligand_fitting_result)
 
@@ -1424,10 +1519,13 @@ def score_clusters(
         res, rate,
 event_fit_num_trys=3,
         debug: Debug = Debug.DEFAULT,
+        conformer_cache_path: Optional[Path] = None,
+        event_fit_num_threads=1,
 ) -> Dict[Tuple[int, int], EventScoringResultInterface]:
     if debug >= Debug.PRINT_SUMMARIES:
         print(f"\t\t\tGetting fragment conformers...")
-    fragment_conformers: ConformersInterface = get_conformers(fragment_dataset, debug=debug)
+    fragment_conformers: ConformersInterface = get_conformers(fragment_dataset, debug=debug,
+                                                              conformer_cache_path=conformer_cache_path)
 
     results = {
         cluster_id: EventScoringResult(
@@ -1456,7 +1554,7 @@ event_fit_num_trys=3,
         zmap_grid = zmaps[cluster_id]
 
         results[cluster_id] = score_cluster(cluster, zmap_grid, fragment_conformers, res, rate, event_fit_num_trys,
-                                            debug)
+                                            debug, event_fit_num_threads)
 
     return results
 
@@ -1538,7 +1636,7 @@ class EventScoringResult(EventScoringResultInterface):
 def get_event_map_reference_grid_quantised(
         reference_xmap_grid: CrystallographicGridInterface,
         zmap_grid: CrystallographicGridInterface,
-        model: ModelInterface,
+        mean_array: NDArrayInterface,
         event: EventInterface,
         reference_xmap_grid_array: NDArrayInterface,
         inner_mask_grid: CrystallographicGridInterface,
@@ -1562,7 +1660,6 @@ def get_event_map_reference_grid_quantised(
                                               copy=False,
                                               )
 
-    mean_array = model.mean
     event_map_reference_grid_array[:, :, :] = (reference_xmap_grid_array - (event.bdc.bdc * mean_array)) / (
             1 - event.bdc.bdc)
 
@@ -1641,11 +1738,11 @@ def get_event_map_reference_grid_quantised(
 def get_event_map_reference_grid(
         reference_xmap_grid: CrystallographicGridInterface,
         zmap_grid: CrystallographicGridInterface,
-        model: ModelInterface,
+        mean_array: NDArrayInterface,
         event: EventInterface,
         reference_xmap_grid_array: NDArrayInterface,
-        inner_mask_grid: CrystallographicGridInterface,
-        outer_mask_grid: CrystallographicGridInterface,
+        inner_mask: NDArrayInterface,
+        outer_mask: NDArrayInterface,
         event_map_cut: float,
         below_cut_score: float,
         event_density_score: float,
@@ -1665,22 +1762,10 @@ def get_event_map_reference_grid(
                                               copy=False,
                                               )
 
-    mean_array = model.mean
     event_map_reference_grid_array[:, :, :] = (reference_xmap_grid_array - (event.bdc.bdc * mean_array)) / (
             1 - event.bdc.bdc)
 
     # Mask the protein except around the event
-    # inner_mask_int_array = grid.partitioning.inner_mask
-    inner_mask_int_array = np.array(
-        inner_mask_grid,
-        copy=False,
-        dtype=np.int8,
-    )
-    outer_mask_int_array = np.array(
-        outer_mask_grid,
-        copy=False,
-        dtype=np.int8,
-    )
 
     # high_mask = np.zeros(inner_mask_int_array.shape, dtype=bool)
     # high_mask[event_map_reference_grid_array >= event_map_cut] = True
@@ -1700,12 +1785,8 @@ def get_event_map_reference_grid(
     # event_map_reference_grid_array[zmap_array > 2.0] = event_density_score
 
     # Event mask
-    event_mask = np.zeros(inner_mask_int_array.shape, dtype=bool)
+    event_mask = np.zeros(inner_mask.shape, dtype=bool)
     event_mask[event.cluster.event_mask_indicies] = True
-    inner_mask = np.zeros(inner_mask_int_array.shape, dtype=bool)
-    inner_mask[np.nonzero(inner_mask_int_array)] = True
-    outer_mask = np.zeros(inner_mask_int_array.shape, dtype=bool)
-    outer_mask[np.nonzero(outer_mask_int_array)] = True
 
     # Mask the protein except at event sites with a penalty
     event_map_reference_grid_array[inner_mask & (~event_mask)] = protein_score
@@ -1744,6 +1825,22 @@ def get_event_map_reference_grid(
 class GetEventScoreInbuilt(GetEventScoreInbuiltInterface):
     tag: Literal["inbuilt"] = "inbuilt"
 
+    def __init__(self,
+                 conformer_cache_path: Optional[Path] = None,
+                 event_fit_num_threads: int = 1,
+                 protein_masks: Optional[ProteinMasks] = None,
+                 ):
+        self.conformer_cache_path = conformer_cache_path
+        self.event_fit_num_threads = event_fit_num_threads
+        self.protein_masks = protein_masks
+
+    def get_protein_masks(self, reference, grid) -> ProteinMasks:
+        shape = (grid.grid.nu, grid.grid.nv, grid.grid.nw)
+        if (self.protein_masks is None) or (tuple(self.protein_masks.shape) != shape):
+            self.protein_masks = ProteinMasks.from_reference(reference, grid)
+
+        return self.protein_masks
+
     def __call__(self,
                  test_dtag,
                  model_number,
@@ -1781,28 +1878,16 @@ class GetEventScoreInbuilt(GetEventScoreInbuiltInterface):
         reference_xmap_grid = dataset_xmap.xmap
         reference_xmap_grid_array = np.array(reference_xmap_grid, copy=True)
 
-        # Mask protein
+        # Mask protein, reusing the masks of previous calls against the same reference and grid
         if debug >= Debug.PRINT_SUMMARIES:
             print("\t\tMasking protein...")
-        inner_mask_grid = gemmi.Int8Grid(*[grid.grid.nu, grid.grid.nv, grid.grid.nw])
-        inner_mask_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-        inner_mask_grid.set_unit_cell(grid.grid.unit_cell)
-        for atom in reference.dataset.structure.protein_atoms():
-            pos = atom.pos
-            inner_mask_grid.set_points_around(pos,
-                                              radius=1.25,
-                                              value=1,
-                                              )
+        protein_masks = self.get_protein_masks(reference, grid)
+        inner_mask = protein_masks.inner_mask()
+        outer_mask = protein_masks.outer_mask()
 
-        outer_mask_grid = gemmi.Int8Grid(*[grid.grid.nu, grid.grid.nv, grid.grid.nw])
-        outer_mask_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-        outer_mask_grid.set_unit_cell(grid.grid.unit_cell)
-        for atom in reference.dataset.structure.protein_atoms():
-            pos = atom.pos
-            outer_mask_grid.set_points_around(pos,
-                                              radius=6.0,
-                                              value=1,
-                                              )
+        # The dense zmap and mean are built once for all events
+        zmap_grid = zmap.get_grid(grid)
+        mean_array = model.get_mean_array(grid)
 
         if debug >= Debug.PRINT_SUMMARIES:
             print("\t\tIterating events...")
@@ -1834,12 +1919,12 @@ class GetEventScoreInbuilt(GetEventScoreInbuiltInterface):
             # )
             event_map_reference_grid, noise = get_event_map_reference_grid(
                 reference_xmap_grid,
-                zmap.zmap,
-                model,
+                zmap_grid,
+                mean_array,
                 event,
                 reference_xmap_grid_array,
-                inner_mask_grid,
-                outer_mask_grid,
+                inner_mask,
+                outer_mask,
                 event_map_cut,
                 below_cut_score,
                 event_density_score,
@@ -1857,6 +1942,8 @@ class GetEventScoreInbuilt(GetEventScoreInbuiltInterface):
                 processed_dataset,
                 res, rate, event_fit_num_trys,
                 debug=debug,
+                conformer_cache_path=self.conformer_cache_path,
+                event_fit_num_threads=self.event_fit_num_threads,
             )
             time_scoring_finish = time.time()
             if debug >= Debug.PRINT_SUMMARIES:
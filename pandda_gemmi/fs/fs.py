@@ -425,9 +425,9 @@ class ZMapFile:
     def from_dir(path: Path, dtag: str):
         return ZMapFile(path / PANDDA_Z_MAP_FILE.format(dtag=dtag))
 
-    def save_reference_frame_zmap(self, zmap: Zmap):
+    def save_reference_frame_zmap(self, zmap: Zmap, grid: GridInterface):
         ccp4 = gemmi.Ccp4Map()
-        ccp4.grid = zmap.zmap
+        ccp4.grid = zmap.get_grid(grid)
         ccp4.update_ccp4_header(2, True)
         ccp4.grid.symmetrize_max()
         ccp4.write_ccp4_map(str(self.path))
@@ -445,9 +445,9 @@ class MeanMapFile:
     def from_dir(path: Path, dtag: str):
         return ZMapFile(path / PANDDA_Z_MAP_FILE.format(dtag=dtag))
 
-    def save_reference_frame_zmap(self, zmap: Zmap):
+    def save_reference_frame_zmap(self, zmap: Zmap, grid: GridInterface):
         ccp4 = gemmi.Ccp4Map()
-        ccp4.grid = zmap.zmap
+        ccp4.grid = zmap.get_grid(grid)
         ccp4.update_ccp4_header(2, True)
         ccp4.grid.symmetrize_max()
         ccp4.write_ccp4_map(str(self.path))
@@ -465,9 +465,9 @@ class StdMapFile:
     def from_dir(path: Path, dtag: str):
         return ZMapFile(path / PANDDA_Z_MAP_FILE.format(dtag=dtag))
 
-    def save_reference_frame_zmap(self, zmap: Zmap):
+    def save_reference_frame_zmap(self, zmap: Zmap, grid: GridInterface):
         ccp4 = gemmi.Ccp4Map()
-        ccp4.grid = zmap.zmap
+        ccp4.grid = zmap.get_grid(grid)
         ccp4.update_ccp4_header(2, True)
         ccp4.grid.symmetrize_max()
         ccp4.write_ccp4_map(str(self.path))
@@ -1 +1 @@
-from pandda_gemmi.model.zmap import Zmap, Zmaps, Model
+from pandda_gemmi.model.zmap import Zmap, Zmaps, Model, GetSigmaSMBisect, GetSigmaSMNewton, GetSigmaSMRoot, RunningStatistics
@@ -23,11 +23,28 @@ from pandda_gemmi.edalignment import XmapArray, Xmap, Grid, Xmaps
 from pandda_gemmi.python_types import *
 
 
+def densify(array_flat: NDArrayInterface, grid: GridInterface, fill: float = 0.0) -> NDArrayInterface:
+    # Scatter values at the points of the grid's total mask into a full unit cell array
+    total_mask = grid.partitioning.total_mask
+    array = np.full(total_mask.shape, fill, dtype=np.float32)
+    array[total_mask == 1] = array_flat
+    return array
+
+
 @dataclasses.dataclass()
 class Model(ModelInterface):
-    mean: NDArrayInterface
+    # The mean and sigma_s_m maps are only stored at the grid points in the grid's total mask, in C order
+    mean_flat: NDArrayInterface
     sigma_is: typing.Dict[DtagInterface, float]
-    sigma_s_m: NDArrayInterface
+    sigma_s_m_flat: NDArrayInterface
+
+    def get_mean_array(self, grid: GridInterface) -> NDArrayInterface:
+        # Allocates a full unit cell array
+        return densify(self.mean_flat, grid)
+
+    def get_sigma_s_m_array(self, grid: GridInterface) -> NDArrayInterface:
+        # Allocates a full unit cell array
+        return densify(self.sigma_s_m_flat, grid)
 
     @staticmethod
     def mean_from_xmap_array(masked_train_xmap_array: XmapArray):
@@ -56,11 +73,15 @@ class Model(ModelInterface):
                              mean_array: np.ndarray,
                              sigma_is: typing.Dict[Dtag, float],
                              process_local,
+                             sigma_s_m_func: typing.Optional[GetSigmaSMInterface] = None,
                              ):
+        if not sigma_s_m_func:
+            sigma_s_m_func = GetSigmaSMBisect()
+
         # Estimate the adjusted pointwise variance
         sigma_is_array = np.array([sigma_is[dtag] for dtag in masked_train_xmap_array],
                                   dtype=np.float32)[:, np.newaxis]
-        sigma_s_m_flat = Model.calculate_sigma_s_m_np(
+        sigma_s_m_flat = sigma_s_m_func(
             mean_array,
             masked_train_xmap_array.xmap_array,
             sigma_is_array,
@@ -78,18 +99,10 @@ class Model(ModelInterface):
         # mask = grid.partitioning.protein_mask
         # mask_array = np.array(mask, copy=False, dtype=np.int8)
 
-        total_mask = grid.partitioning.total_mask
-
-        mean = np.zeros(total_mask.shape, dtype=np.float32)
-        mean[total_mask == 1] = mean_flat
-
-        sigma_s_m = np.zeros(total_mask.shape, dtype=np.float32)
-        sigma_s_m[total_mask == 1] = sigma_s_m_flat
-
         return Model(
-            mean,
+            np.asarray(mean_flat, dtype=np.float32),
             sigma_is,
-            sigma_s_m,
+            np.asarray(sigma_s_m_flat, dtype=np.float32),
         )
 
     # @staticmethod
@@ -172,7 +185,7 @@ class Model(ModelInterface):
                 x0=np.power(2.0, -20),
             )
 
-            sigma_ms[x] = result_root
+            sigma_ms[x] = result_root.x[0]
 
         return np.abs(sigma_ms)
 
@@ -284,6 +297,86 @@ class Model(ModelInterface):
 
         return sigma_ms
 
+    @staticmethod
+    def calculate_sigma_s_m_newton(mean: np.array,
+                                   arrays: np.array,
+                                   sigma_is_array: np.array,
+                                   process_local=None,
+                                   start: float = 0.0,
+                                   stop: float = 20.0,
+                                   max_iterations: int = 50,
+                                   tolerance: float = 1e-6,
+                                   ):
+        # Solve d(log liklihood)/d(sigma_s_m) = 0 for every point at once with a safeguarded Newton iteration
+        # mean[m]
+        # arrays[n,m]
+        # sigma_i_array[n, 1]
+        #
+        # The root is found in v = sigma_s_m ** 2, where the derivative does not vanish at zero. Points whose
+        # bracket does not contain a sign change are set to zero, as in the bisection solver.
+        squared_residuals = np.square(arrays - mean[np.newaxis, :])  # n, m
+        squared_errors = np.square(sigma_is_array)  # n, 1
+
+        def func(v, mask):
+            variances = v[np.newaxis, :] + squared_errors  # n, m'
+            inverse_variances = 1.0 / variances
+            weighted_residuals = squared_residuals[:, mask] * np.square(inverse_variances)
+            f = np.sum(weighted_residuals, axis=0) - np.sum(inverse_variances, axis=0)
+            df = np.sum(np.square(inverse_variances), axis=0) - 2 * np.sum(weighted_residuals * inverse_variances,
+                                                                            axis=0)
+            return f, df
+
+        num_points = mean.shape[0]
+        all_points = np.full(num_points, True)
+
+        v_lower = np.full(num_points, start ** 2, dtype=np.float64)
+        v_upper = np.full(num_points, stop ** 2, dtype=np.float64)
+        f_lower, _ = func(v_lower, all_points)
+        f_upper, _ = func(v_upper, all_points)
+
+        # Points with no sign change over the bracket have no root to find
+        bracketed = (f_lower * f_upper) <= 0
+        f_lower_positive = f_lower > 0
+
+        # Start from the moment estimate of the excess variance, which is usually close to the root
+        v = np.mean(squared_residuals, axis=0) - np.mean(squared_errors)
+        v = np.clip(v, v_lower, v_upper).astype(np.float64)
+
+        active = np.copy(bracketed)
+        for i in range(max_iterations):
+            if not np.any(active):
+                break
+
+            v_active = v[active]
+            f, df = func(v_active, active)
+
+            # Shrink the bracket around the root
+            same_sign_as_lower = (f > 0) == f_lower_positive[active]
+            lower_active = v_lower[active]
+            upper_active = v_upper[active]
+            lower_active[same_sign_as_lower] = v_active[same_sign_as_lower]
+            upper_active[~same_sign_as_lower] = v_active[~same_sign_as_lower]
+            v_lower[active] = lower_active
+            v_upper[active] = upper_active
+
+            # Take a Newton step, falling back to bisection when it would leave the bracket
+            with np.errstate(divide="ignore", invalid="ignore"):
+                v_new = v_active - (f / df)
+            out_of_bracket = ~np.isfinite(v_new) | (v_new <= lower_active) | (v_new >= upper_active)
+            v_new[out_of_bracket] = lower_active[out_of_bracket] + (
+                    (upper_active[out_of_bracket] - lower_active[out_of_bracket]) / 2)
+
+            # Retire points whose step has converged
+            converged = (np.abs(v_new - v_active) <= tolerance * np.maximum(v_new, 1.0)) | (f == 0)
+            v[active] = v_new
+            active_indexes = np.nonzero(active)[0]
+            active[active_indexes[converged]] = False
+
+        sigma_ms = np.sqrt(v)
+        sigma_ms[~bracketed] = 0.0
+
+        return sigma_ms.astype(np.float32)
+
     @staticmethod
     def maximise_over_range(func, start, stop, num, shape):
         xs = np.linspace(start, stop, num)
@@ -390,14 +483,17 @@ class Model(ModelInterface):
 
         return np.sum(term_1, axis=0) + np.sum(term_2, axis=0)
 
-    def evaluate(self, xmap: Xmap, dtag: Dtag):
-        xmap_array = np.copy(xmap.to_array())
+    def evaluate(self, xmap: Xmap, dtag: Dtag, grid: GridInterface):
+        return densify(self.evaluate_flat(xmap, dtag, grid), grid)
+
+    def evaluate_flat(self, xmap: Xmap, dtag: Dtag, grid: GridInterface):
+        xmap_array = xmap.to_array(copy=False)
 
-        if xmap_array.shape != self.mean.shape:
+        if xmap_array.shape != grid.partitioning.total_mask.shape:
             raise Exception("Wrong shape!")
 
-        residuals = (xmap_array - self.mean)
-        denominator = (np.sqrt(np.square(self.sigma_s_m) + np.square(self.sigma_is[dtag])))
+        residuals = (xmap_array[grid.partitioning.total_mask == 1] - self.mean_flat)
+        denominator = (np.sqrt(np.square(self.sigma_s_m_flat) + np.square(self.sigma_is[dtag])))
 
         return residuals / denominator
 
@@ -423,7 +519,7 @@ class Model(ModelInterface):
 
     def save_maps(self, pandda_dir: Path, shell: Shell, grid: Grid, p1: bool = True):
         # Mean map
-        mean_array = self.mean
+        mean_array = self.get_mean_array(grid)
 
         mean_grid = gemmi.FloatGrid(*mean_array.shape)
         mean_grid_array = np.array(mean_grid, copy=False)
@@ -444,7 +540,7 @@ class Model(ModelInterface):
                                                                          )))
 
         # sigma_s_m map
-        sigma_s_m_array = self.sigma_s_m
+        sigma_s_m_array = self.get_sigma_s_m_array(grid)
         sigma_s_m_grid = gemmi.FloatGrid(*sigma_s_m_array.shape)
         sigma_s_m_grid_array = np.array(sigma_s_m_grid, copy=False)
         sigma_s_m_array_typed = sigma_s_m_array.astype(sigma_s_m_grid_array.dtype)
@@ -465,61 +561,129 @@ class Model(ModelInterface):
                                                                           )))
 
 
-@dataclasses.dataclass()
-class Zmap(ZmapInterface):
-    zmap: gemmi.FloatGrid
+class GetSigmaSMBisect(GetSigmaSMInterface):
+    tag: Literal["bisect"] = "bisect"
+
+    def __call__(self, mean, arrays, sigma_is_array, process_local=None):
+        return Model.calculate_sigma_s_m_np(mean, arrays, sigma_is_array, process_local)
+
+
+class GetSigmaSMNewton(GetSigmaSMInterface):
+    tag: Literal["newton"] = "newton"
+
+    def __init__(self, max_iterations: int = 50, tolerance: float = 1e-6):
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+
+    def __call__(self, mean, arrays, sigma_is_array, process_local=None):
+        return Model.calculate_sigma_s_m_newton(
+            mean,
+            arrays,
+            sigma_is_array,
+            process_local,
+            max_iterations=self.max_iterations,
+            tolerance=self.tolerance,
+        )
+
+
+class GetSigmaSMRoot(GetSigmaSMInterface):
+    tag: Literal["root"] = "root"
+
+    def __call__(self, mean, arrays, sigma_is_array, process_local=None):
+        return Model.calculate_sigma_s_m(mean, arrays, sigma_is_array, process_local)
+
+
+class RunningStatistics:
+    # Running sum over rows of a shell's masked xmap array, updated with only the datasets that differ between
+    # successive comparator sets rather than recomputed for every set. Only the mean is kept this way: sigma_i is a
+    # quantile fit against the mean and sigma_s_m a per point likelihood solve, so neither has a running update
+    def __init__(self, masked_xmap_array: XmapArray):
+        self.masked_xmap_array = masked_xmap_array
+        self.dtags: typing.List[DtagInterface] = []
+        self.sum = np.zeros(masked_xmap_array.xmap_array.shape[1], dtype=np.float64)
+
+    def _accumulate(self, dtags, sign):
+        if len(dtags) == 0:
+            return
+        # Add row by row so that no rows are gathered into a copy
+        for index in self.masked_xmap_array.get_indexes(dtags):
+            if sign > 0:
+                self.sum += self.masked_xmap_array.xmap_array[index]
+            else:
+                self.sum -= self.masked_xmap_array.xmap_array[index]
+
+    def update(self, dtags: typing.List[DtagInterface]):
+        added = [dtag for dtag in dtags if dtag not in self.dtags]
+        removed = [dtag for dtag in self.dtags if dtag not in dtags]
+
+        # Rebuild from scratch if that touches fewer rows than updating
+        if len(added) + len(removed) >= len(dtags):
+            self.sum[:] = 0.0
+            self._accumulate(list(dtags), 1.0)
+        else:
+            self._accumulate(added, 1.0)
+            self._accumulate(removed, -1.0)
+
+        self.dtags = list(dtags)
+
+    def mean(self):
+        return (self.sum / len(self.dtags)).astype(np.float32)
 
     @staticmethod
-    def from_xmap(model: Model, xmap: Xmap, dtag: Dtag, model_number=0, debug: Debug=Debug.DEFAULT):
+    def order_by_overlap(comparison_sets: typing.Dict[int, typing.List[DtagInterface]]) -> typing.List[int]:
+        # Greedily visit the comparator sets so each differs as little as possible from the one before it
+        remaining = {key: set(dtags) for key, dtags in comparison_sets.items()}
+        if len(remaining) == 0:
+            return []
 
-        # Get zmap
-        zmap_array = model.evaluate(xmap, dtag)
+        key = next(iter(remaining))
+        current = remaining.pop(key)
+        order = [key]
+        while len(remaining) > 0:
+            key = min(remaining, key=lambda _key: len(current ^ remaining[_key]))
+            current = remaining.pop(key)
+            order.append(key)
 
-        # Symmeterize Positive values
-        new_zmap_grid_pos = xmap.new_grid()
-        new_zmap_array_pos = np.array(new_zmap_grid_pos, copy=False)
-        new_zmap_array_pos[:, :, :] = zmap_array[:, :, :]
-        new_zmap_grid_pos.symmetrize_max()
+        return order
 
-        # Symmetrize Negative values
-        new_zmap_grid_neg = xmap.new_grid()
-        new_zmap_array_neg = np.array(new_zmap_grid_neg, copy=False)
-        new_zmap_array_neg[:, :, :] = -zmap_array[:, :, :]
-        new_zmap_grid_neg.symmetrize_max()
 
-        # Get merged map
-        new_zmap_grid_symm = xmap.new_grid()
-        new_zmap_array_symm = np.array(new_zmap_grid_symm, copy=False)
-        new_zmap_array_symm[:, :, :] = new_zmap_array_pos[:, :, :] - new_zmap_array_neg[:, :, :]
+@dataclasses.dataclass()
+class Zmap(ZmapInterface):
+    # Z-scores at the points of the grid's total mask, in C order, with every other grid point taking the fill value
+    zmap_flat: NDArrayInterface
+    fill: float
+    grid_shape: typing.Tuple[int, int, int]
+    unit_cell_parameters: typing.Tuple[float, float, float, float, float, float]
 
-        # Get mean and std
-        zmap_mean = np.mean(zmap_array)
-        zmap_std = np.std(zmap_array)
+    @staticmethod
+    def from_xmap(model: Model, xmap: Xmap, dtag: Dtag, grid: GridInterface, model_number=0,
+                  debug: Debug=Debug.DEFAULT):
 
-        zmap_symm_mean = np.mean(new_zmap_array_symm)
-        zmap_symm_std = np.std(new_zmap_array_symm)
+        # Get zmap. Outside the total mask the xmap, mean and sigma_s_m are all zero, so the unnormalised zmap is too
+        zmap_flat = model.evaluate_flat(xmap, dtag, grid)
 
-        zmap_sparse_mean = np.mean(zmap_array[zmap_array != 0.0])
-        zmap_sparse_std = np.std(zmap_array[zmap_array != 0.0])
+        # Get mean and std
+        zmap_sparse_mean = np.mean(zmap_flat[zmap_flat != 0.0])
+        zmap_sparse_std = np.std(zmap_flat[zmap_flat != 0.0])
         if debug >= Debug.PRINT_SUMMARIES:
             print(f"\t\tZmap mean is: {zmap_sparse_mean}")
             print(f"\t\tZmap mean is: {zmap_sparse_std}")
-            print(f"\t\tZmap max is: {np.max(zmap_array[zmap_array != 0.0])}")
-            print(f"\t\tZmap >1 is: {zmap_array[zmap_array > 1.0].size}")
-            print(f"\t\tZmap >2 is: {zmap_array[zmap_array > 2.0].size}")
-            print(f"\t\tZmap >2.5 is: {zmap_array[zmap_array > 2.5].size}")
-            print(f"\t\tZmap >3 is: {zmap_array[zmap_array > 3.0].size}")
-
-            # TODO:L Remove altogether
-            # f = sns.displot(x=zmap_array[zmap_array != 0.0], kind="ecdf")
-            # f.set(xlim=(-10,10))
-            # f.savefig(f"{model_number}.png")
-            # plt.close('all')
-
-        normalised_zmap_array = (zmap_array - zmap_sparse_mean) / zmap_sparse_std
-
-        zmap = Zmap.grid_from_template(xmap, normalised_zmap_array)
-        return Zmap(zmap)
+            print(f"\t\tZmap max is: {np.max(zmap_flat[zmap_flat != 0.0])}")
+            print(f"\t\tZmap >1 is: {zmap_flat[zmap_flat > 1.0].size}")
+            print(f"\t\tZmap >2 is: {zmap_flat[zmap_flat > 2.0].size}")
+            print(f"\t\tZmap >2.5 is: {zmap_flat[zmap_flat > 2.5].size}")
+            print(f"\t\tZmap >3 is: {zmap_flat[zmap_flat > 3.0].size}")
+
+        normalised_zmap_flat = (zmap_flat - zmap_sparse_mean) / zmap_sparse_std
+        fill = (zmap_flat.dtype.type(0.0) - zmap_sparse_mean) / zmap_sparse_std
+
+        unit_cell = xmap.xmap.unit_cell
+        return Zmap(
+            normalised_zmap_flat,
+            float(fill),
+            tuple(grid.partitioning.total_mask.shape),
+            (unit_cell.a, unit_cell.b, unit_cell.c, unit_cell.alpha, unit_cell.beta, unit_cell.gamma),
+        )
 
     @staticmethod
     def grid_from_template(xmap: Xmap, zmap_array: np.array):
@@ -547,21 +711,33 @@ class Zmap(ZmapInterface):
 
         return new_grid
 
-    def to_array(self, copy=True):
-        return np.array(self.zmap, copy=copy)
+    def get_grid(self, grid: GridInterface) -> gemmi.FloatGrid:
+        # Allocates a full unit cell grid, so is only used for writing, symmetrising and the like
+        new_grid = gemmi.FloatGrid(*self.grid_shape)
+        new_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+        new_grid.set_unit_cell(self.unit_cell())
+
+        new_grid_array = np.array(new_grid, copy=False)
+        new_grid_array[:, :, :] = self.to_array(grid)
+
+        return new_grid
+
+    def to_array(self, grid: GridInterface) -> NDArrayInterface:
+        # Allocates a full unit cell array
+        return densify(self.zmap_flat, grid, self.fill)
 
     def shape(self):
-        return [self.zmap.nu, self.zmap.nv, self.zmap.nw]
+        return list(self.grid_shape)
 
     def spacegroup(self):
-        return self.zmap.spacegroup
+        return gemmi.find_spacegroup_by_name("P 1")
 
     def unit_cell(self):
-        return self.zmap.unit_cell
+        return gemmi.UnitCell(*self.unit_cell_parameters)
 
-    def save(self, path: Path, p1: bool = True):
+    def save(self, path: Path, grid: GridInterface, p1: bool = True):
         ccp4 = gemmi.Ccp4Map()
-        ccp4.grid = self.zmap
+        ccp4.grid = self.get_grid(grid)
         if p1:
             ccp4.grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
         else:
@@ -569,24 +745,18 @@ class Zmap(ZmapInterface):
         ccp4.update_ccp4_header(2, True)
         ccp4.write_ccp4_map(str(path))
 
-    def __getstate__(self):
-        return XmapPython.from_gemmi(self.zmap)
-
-    def __setstate__(self, zmap_pyhton: XmapPython):
-        self.zmap = zmap_pyhton.to_gemmi()
-
 
 @dataclasses.dataclass()
 class Zmaps:
     zmaps: typing.Dict[Dtag, Zmap]
 
     @staticmethod
-    def from_xmaps(model: ModelInterface, xmaps: XmapsInterface, model_number: ModelIDInterface=0,
-                   debug: Debug=Debug.DEFAULT):
+    def from_xmaps(model: ModelInterface, xmaps: XmapsInterface, grid: GridInterface,
+                   model_number: ModelIDInterface=0, debug: Debug=Debug.DEFAULT):
         zmaps = {}
         for dtag in xmaps:
             xmap = xmaps[dtag]
-            zmap = Zmap.from_xmap(model, xmap, dtag, model_number=model_number, debug=debug)
+            zmap = Zmap.from_xmap(model, xmap, dtag, grid, model_number=model_number, debug=debug)
             zmaps[dtag] = zmap
 
         return zmaps
@@ -792,7 +792,8 @@ class PanDDAOutputMaps:
                 save_reference_frame_zmap(
                     pandda_fs_model.processed_datasets.processed_datasets[
                         test_dtag].z_map_file.path.parent / f'{model_number}_ref.ccp4',
-                    model_result.zmap
+                    model_result.zmap,
+                    grid,
                 )
                 save_native_frame_zmap(
                     pandda_fs_model.processed_datasets.processed_datasets[
@@ -881,7 +882,6 @@ class PanDDAOutputMaps:
             outer_mask,
             inner_mask_symmetry,
             sample_rate,
-            native_grid,
             mapper=ProcessLocalSerial(),
         )
 
@@ -26,7 +26,7 @@ from pandda_gemmi.common import Dtag, Partial
 from pandda_gemmi.dataset import StructureFactors, Dataset, Datasets, Resolution
 from pandda_gemmi.fs import PanDDAFSModel
 from pandda_gemmi.shells import Shell
-from pandda_gemmi.edalignment import Alignment, Grid, Xmap, Partitioning
+from pandda_gemmi.edalignment import Alignment, Grid, Xmap, Partitioning, NativeFrame
 from pandda_gemmi.model import Model, Zmap
 from pandda_gemmi.event import Event
 
@@ -1965,15 +1965,8 @@ def truncate(
     # truncate on reflections
     new_datasets_reflections = {}
     for dtag in dataset_resolution_truncated:
-        reflections = dataset_resolution_truncated[dtag].reflections.reflections
-        reflections_array = np.array(reflections)
-
-        print(f"Truncated reflections: {dtag}")
         truncated_dataset = dataset_resolution_truncated[dtag].truncate_reflections(common_reflections,
                                                                                     )
-        reflections = truncated_dataset.reflections.reflections
-        reflections_array = np.array(reflections)
-
         new_datasets_reflections[dtag] = truncated_dataset
 
     return new_datasets_reflections
@@ -2039,8 +2032,9 @@ def save_native_frame_zmap(
         mask_radius_symmetry: float,
         partitioning: PartitioningInterface,
         sample_rate: float,
+        native_frame: Optional[NativeFrame] = None,
 ):
-    reference_frame_zmap_grid = zmap.zmap
+    reference_frame_zmap_grid = zmap.get_grid(grid)
     # reference_frame_zmap_grid_array = np.array(reference_frame_zmap_grid, copy=True)
 
     # z_map_reference_grid = gemmi.FloatGrid(*[reference_frame_zmap_grid.nu,
@@ -2061,6 +2055,7 @@ def save_native_frame_zmap(
         partitioning,
         mask_radius_symmetry,
         sample_rate * 2,  # TODO: delete 2
+        native_frame=native_frame,
     )
 
     ccp4 = gemmi.Ccp4Map()
@@ -2071,9 +2066,10 @@ def save_native_frame_zmap(
 
 
 def save_reference_frame_zmap(path,
-                              zmap: CrystallographicGridInterface, ):
+                              zmap: ZmapInterface,
+                              grid: GridInterface, ):
     ccp4 = gemmi.Ccp4Map()
-    ccp4.grid = zmap.zmap
+    ccp4.grid = zmap.get_grid(grid)
     ccp4.update_ccp4_header(2, True)
     ccp4.setup()
     ccp4.write_ccp4_map(str(path))
@@ -2092,7 +2088,7 @@ def save_native_frame_mean_map(
         partitioning: Partitioning,
         sample_rate: float,
 ):
-    reference_frame_zmap_grid = zmap.zmap
+    reference_frame_zmap_grid = zmap.get_grid(grid)
 
     event_map_reference_grid = gemmi.FloatGrid(*[reference_frame_zmap_grid.nu,
                                                  reference_frame_zmap_grid.nv,
@@ -2106,7 +2102,7 @@ def save_native_frame_mean_map(
                                               copy=False,
                                               )
 
-    event_map_reference_grid_array[:, :, :] = model.mean
+    event_map_reference_grid_array[:, :, :] = model.get_mean_array(grid)
 
     event_map_grid = Xmap.from_aligned_map_c(
         event_map_reference_grid,
@@ -2141,7 +2137,7 @@ def save_native_frame_std_map(
         partitioning: Partitioning,
         sample_rate: float,
 ):
-    reference_frame_zmap_grid = zmap.zmap
+    reference_frame_zmap_grid = zmap.get_grid(grid)
 
     event_map_reference_grid = gemmi.FloatGrid(*[reference_frame_zmap_grid.nu,
                                                  reference_frame_zmap_grid.nv,
@@ -2156,7 +2152,7 @@ def save_native_frame_std_map(
                                               )
 
     event_map_reference_grid_array[:, :, :] = (
-        np.sqrt(np.square(model.sigma_s_m) + np.square(model.sigma_is[dtag])))
+        np.sqrt(np.square(model.get_sigma_s_m_array(grid)) + np.square(model.sigma_is[dtag])))
 
     event_map_grid = Xmap.from_aligned_map_c(
         event_map_reference_grid,
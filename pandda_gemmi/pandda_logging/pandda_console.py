@@ -508,8 +508,8 @@ class PanDDAConsole:
             dataset = datasets_initial[dtag]
             table.add_row(
                 dtag.dtag,
-                str(round(dataset.reflections.reflections.resolution_high(), 2)),
-                dataset.reflections.reflections.spacegroup.hm,
+                str(round(dataset.reflections.get_resolution(), 2)),
+                dataset.reflections.get_spacegroup_hm(),
             )
 
         self.console.print(table)
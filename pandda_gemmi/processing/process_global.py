@@ -1,4 +1,6 @@
 import re
+import zlib
+import hashlib
 import subprocess
 import pickle
 import secrets
@@ -6,12 +8,14 @@ import sys
 import time
 import os
 import inspect
+import itertools
 
 import dask
-from dask.distributed import Client, progress
+from dask.distributed import Client, progress, as_completed
 from dask_jobqueue import HTCondorCluster, PBSCluster, SGECluster, SLURMCluster
 
 from pandda_gemmi.analyse_interface import *
+from pandda_gemmi.processing.run_process_shell import path_to_obj, get_buffer_path
 
 from enum import IntEnum
 
@@ -44,6 +48,7 @@ class SGEFuture:
         self.result_path = result_path
         self.job_id = job_id
         self.debug = debug
+        self.num_missed_polls = 0
 
     def is_in_queue(self):
         p = subprocess.Popen(
@@ -80,6 +85,54 @@ class SGEFuture:
             return SGEResultStatus.FAILED
 
 
+class ArgumentStore:
+    # Pickled arguments keyed by a hash of their content, so that arguments shared between jobs are written once.
+    # Large buffers, such as numpy arrays, are written to their own files to be memory mapped when loaded
+    def __init__(self, path: Path, compress: bool = False, min_buffer_bytes: int = 2 ** 20):
+        self.path = path
+        self.compress = compress
+        self.min_buffer_bytes = min_buffer_bytes
+        self.written: Set[Path] = set()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def put(self, obj) -> Path:
+        # Objects are always pickled afresh, since they may have been mutated since they were last stored. Only the
+        # content address decides whether an entry needs writing
+        buffers = []
+
+        def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+            # Returning False keeps a buffer out of the pickle
+            if buffer.raw().nbytes < self.min_buffer_bytes:
+                return True
+            buffers.append(buffer)
+            return False
+
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+
+        hasher = hashlib.blake2b(data, digest_size=16)
+        for buffer in buffers:
+            hasher.update(buffer.raw())
+        path = self.path / (f"{hasher.hexdigest()}.pickle" + (".z" if self.compress else ""))
+
+        if (path not in self.written) and (not path.exists()):
+            for j, buffer in enumerate(buffers):
+                self.write(Path(get_buffer_path(path, j)), buffer.raw())
+            # The pickle is written last so that its presence means the whole entry is complete
+            self.write(path, zlib.compress(data, 1) if self.compress else data)
+        self.written.add(path)
+
+        return path
+
+    def write(self, path: Path, data):
+        tmp_path = path.with_name(f"{path.name}.{secrets.token_hex(8)}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, path: Path):
+        return path_to_obj(path)
+
+
 class QSubScheduler:
     def __init__(self,
                  queue,
@@ -89,7 +142,11 @@ class QSubScheduler:
                  walltime,
                  job_extra,
                  tmp_dir,
-                 debug: Debug = Debug.DEFAULT):
+                 debug: Debug = Debug.DEFAULT,
+                 min_poll_interval: float = 1.0,
+                 max_poll_interval: float = 60.0,
+                 compress_arguments: bool = False,
+                 ):
         self.queue = queue
         self.project = project
         self.cores = cores
@@ -98,6 +155,9 @@ class QSubScheduler:
         self.job_extra = job_extra
         self.tmp_dir: Path = tmp_dir
         self.debug = debug
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.argument_store = ArgumentStore(self.tmp_dir / "argument_store", compress=compress_arguments)
 
     def generate_io_path(self, ):
         code = secrets.token_hex(16)
@@ -107,12 +167,7 @@ class QSubScheduler:
         return path, code
 
     def save(self, obj):
-
-        path, code = self.generate_io_path()
-        with open(path, "wb") as f:
-            pickle.dump(obj, f)
-
-        return path
+        return self.argument_store.put(obj)
 
     def chmod(self, path):
         p = subprocess.Popen(
@@ -169,10 +224,13 @@ class QSubScheduler:
 
         self.write_script(job_script, job_script_path)
 
-        # Get submit command
         out_path = self.tmp_dir / f"{code}.out"
         err_path = self.tmp_dir / f"{code}.err"
+        job_id = self.submit_job(job_script_path, out_path, err_path)
 
+        return SGEFuture(output_path, job_id)
+
+    def submit_job(self, job_script_path: Path, out_path: Path, err_path: Path) -> str:
         _submit_command = submit_command.format(
             cores=self.cores,
             mem_per_core=self.mem_per_core,
@@ -202,7 +260,61 @@ class QSubScheduler:
             str(stdout),
         ).groups()[0]
 
-        return SGEFuture(output_path, job_id)
+        return job_id
+
+    def get_queued_job_ids(self) -> Optional[Set[str]]:
+        # None if the queue could not be listed, since an empty listing would otherwise look like every job had left
+        p = subprocess.Popen(
+            "qstat",
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stdout, stderr = p.communicate()
+
+        if self.debug >= Debug.PRINT_NUMERICS:
+            print(str(stdout))
+
+        if p.returncode != 0:
+            if self.debug >= Debug.PRINT_NUMERICS:
+                print(f"qstat exited with {p.returncode}: {str(stderr)}")
+            return None
+
+        return set(re.findall(r"^\s*([0-9]+)\s", stdout.decode(errors="replace"), flags=re.MULTILINE))
+
+    def poll(self, sge_futures: List[SGEFuture]) -> List[SGEResultStatus]:
+        # Completion is seen from the result files, so the queue is only listed once per round, and only if
+        # some results are missing
+        task_status = [SGEResultStatus.DONE if f.result_path.exists() else None for f in sge_futures]
+        if all(task_stat is not None for task_stat in task_status):
+            return task_status
+
+        queued_job_ids = self.get_queued_job_ids()
+        for j, sge_future in enumerate(sge_futures):
+            if task_status[j] is not None:
+                continue
+            # If the queue could not be listed the job's state is unknown, so leave it to the next round
+            if (queued_job_ids is None) or (sge_future.job_id in queued_job_ids):
+                sge_future.num_missed_polls = 0
+                task_status[j] = SGEResultStatus.RUNNING
+            # A job can finish between the result check and listing the queue
+            elif sge_future.result_path.exists():
+                task_status[j] = SGEResultStatus.DONE
+            # Only fail a job once it has been missing from two consecutive listings of the queue
+            else:
+                sge_future.num_missed_polls += 1
+                if sge_future.num_missed_polls >= 2:
+                    task_status[j] = SGEResultStatus.FAILED
+                else:
+                    task_status[j] = SGEResultStatus.RUNNING
+
+        return task_status
+
+    def get_poll_interval(self, poll_interval: Optional[float] = None, progressed: bool = True) -> float:
+        # Poll quickly while jobs are completing and back off while they are not
+        if (poll_interval is None) or progressed:
+            return self.min_poll_interval
+        return min(poll_interval * 2, self.max_poll_interval)
 
     def load(self, path):
         with open(path, "rb") as f:
@@ -211,7 +323,9 @@ class QSubScheduler:
         return obj
 
     def gather(self, sge_futures: List[SGEFuture]):
-        task_status = [f.status() for f in sge_futures]
+        poll_interval = self.get_poll_interval()
+        task_status = self.poll(sge_futures)
+        num_completed = 0
         while not all([task_stat == SGEResultStatus.DONE for task_stat in task_status]):
             completed = [x for x in task_status if x == SGEResultStatus.DONE]
             failed = [x for x in task_status if x == SGEResultStatus.FAILED]
@@ -219,14 +333,43 @@ class QSubScheduler:
             print(
                 f"\tCompleted {len(completed)}; failed {len(failed)}; running {len(running)} out of {len(task_status)} "
                 f"tasks...")
-            time.sleep(60)
-            task_status = [f.status() for f in sge_futures]
+            if len(failed) > 0:
+                failed_job_ids = [f.job_id for f, task_stat in zip(sge_futures, task_status)
+                                  if task_stat == SGEResultStatus.FAILED]
+                raise Exception(f"Jobs {failed_job_ids} left the queue without writing a result")
+
+            poll_interval = self.get_poll_interval(poll_interval, len(completed) > num_completed)
+            num_completed = len(completed)
+            time.sleep(poll_interval)
+            task_status = self.poll(sge_futures)
 
         results = [self.load(sge_future.result_path) for sge_future in sge_futures]
 
         return results
 
 
+class LocalQSubScheduler(QSubScheduler):
+    # Stands in for qsub and qstat by running job scripts as local processes, so that the distributed path can be
+    # tested and benchmarked on one machine
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.job_ids = itertools.count(1)
+        self.processes: Dict[str, subprocess.Popen] = {}
+
+    def submit_job(self, job_script_path: Path, out_path: Path, err_path: Path) -> str:
+        job_id = str(next(self.job_ids))
+        with open(out_path, "w") as out_file, open(err_path, "w") as err_file:
+            self.processes[job_id] = subprocess.Popen(
+                ["/bin/sh", str(job_script_path)],
+                stdout=out_file,
+                stderr=err_file,
+            )
+        return job_id
+
+    def get_queued_job_ids(self) -> Set[str]:
+        return {job_id for job_id, process in self.processes.items() if process.poll() is None}
+
+
 class DistributedProcessor(ProcessorInterface):
     def __init__(self,
                  tmp_dir,
@@ -242,7 +385,7 @@ class DistributedProcessor(ProcessorInterface):
                  watcher=True,
                  debug: Debug =Debug.DEFAULT,
                  ):
-        schedulers = ["HTCONDOR", "PBS", "SGE", "SLURM"]
+        schedulers = ["HTCONDOR", "PBS", "SGE", "SLURM", "LOCAL"]
         if scheduler not in schedulers:
             raise Exception(f"Supported schedulers are: {schedulers}")
 
@@ -269,19 +412,34 @@ class DistributedProcessor(ProcessorInterface):
         elif scheduler == "SLURM":
             raise NotImplementedError("SLURM cluster is not implemented")
 
+        elif scheduler == "LOCAL":
+            cluster = LocalQSubScheduler(
+                queue=queue,
+                project=project,
+                cores=cores_per_worker,
+                mem_per_core=f"{distributed_mem_per_core}",
+                walltime=walltime,
+                job_extra=[],
+                tmp_dir=tmp_dir,
+                debug=debug
+            )
+
         else:
             raise Exception(f"Scheduler {scheduler} is not one of the supported schedulers: {schedulers}")
 
         self.client = cluster
 
+    def submit(self, func: PartialInterface[P, V]) -> SGEFuture:
+        func_path = self.client.save(func.func)
+        arg_pickle_paths = [self.client.save(arg) for arg in func.args]
+        kwarg_pickle_paths = {kwrd: self.client.save(kwarg) for kwrd, kwarg in func.kwargs.items()}
+        return self.client.submit(func_path, *arg_pickle_paths, **kwarg_pickle_paths)
+
     def __call__(self, funcs: Iterable[PartialInterface[P, V]]) -> List[V]:
         result_futures = []
         for func in funcs:
-            func_path = self.client.save(func.func)
-            arg_pickle_paths = [self.client.save(arg) for arg in func.args]
-            kwarg_pickle_paths = {kwrd: self.client.save(kwarg) for kwrd, kwarg in func.kwargs.items()}
             # result_futures.append(self.client.submit(func.func, *func.args, **func.kwargs))
-            result_futures.append(self.client.submit(func_path, *arg_pickle_paths, **kwarg_pickle_paths))
+            result_futures.append(self.submit(func))
 
         # progress(result_futures)
 
@@ -289,6 +447,47 @@ class DistributedProcessor(ProcessorInterface):
 
         return results
 
+    def iterate(self,
+                funcs: Mapping[Hashable, PartialInterface[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        if max_in_flight is None:
+            max_in_flight = len(funcs)
+
+        func_items = iter(funcs.items())
+        in_flight: Dict[Hashable, SGEFuture] = {}
+
+        def submit_next():
+            for key, func in func_items:
+                in_flight[key] = self.submit(func)
+                return
+
+        for _ in range(max(max_in_flight, 1)):
+            submit_next()
+
+        poll_interval = self.client.get_poll_interval()
+        while len(in_flight) > 0:
+            keys = list(in_flight.keys())
+            task_status = self.client.poll([in_flight[key] for key in keys])
+
+            completed_keys = []
+            for key, status in zip(keys, task_status):
+                if status == SGEResultStatus.DONE:
+                    completed_keys.append(key)
+                elif status == SGEResultStatus.FAILED:
+                    raise Exception(f"Job {in_flight[key].job_id} left the queue without writing a result to "
+                                    f"{in_flight[key].result_path}")
+
+            for key in completed_keys:
+                sge_future = in_flight.pop(key)
+                submit_next()
+                yield key, self.client.load(sge_future.result_path)
+
+            poll_interval = self.client.get_poll_interval(poll_interval, len(completed_keys) > 0)
+            if (len(completed_keys) == 0) and (len(in_flight) > 0):
+                print(f"\tRunning {len(in_flight)} tasks...")
+                time.sleep(poll_interval)
+
 
 class DaskDistributedProcessor(ProcessorInterface):
 
@@ -389,3 +588,33 @@ class DaskDistributedProcessor(ProcessorInterface):
         results = self.client.gather(result_futures)
 
         return results
+
+    def submit(self, func: PartialInterface[P, V]):
+        arg_futures = [self.client.scatter(arg) for arg in func.args]
+        kwarg_futures = {kwrd: self.client.scatter(kwarg) for kwrd, kwarg in func.kwargs.items()}
+        return self.client.submit(func.func, *arg_futures, **kwarg_futures)
+
+    def iterate(self,
+                funcs: Mapping[Hashable, PartialInterface[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        if max_in_flight is None:
+            max_in_flight = len(funcs)
+
+        func_items = iter(funcs.items())
+        keys = {}
+        result_futures = as_completed()
+
+        def submit_next():
+            for key, func in func_items:
+                result_future = self.submit(func)
+                keys[result_future.key] = key
+                result_futures.add(result_future)
+                return
+
+        for _ in range(max(max_in_flight, 1)):
+            submit_next()
+
+        for result_future in result_futures:
+            submit_next()
+            yield keys.pop(result_future.key), result_future.result()
@@ -1,6 +1,17 @@
+import io
+import os
+import mmap
+import queue
+import atexit
+import pickle
+import weakref
+import dataclasses
 import numpy
+import numpy as np
 import ray
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from joblib import Parallel, delayed
 
 from pandda_gemmi.analyse_interface import *
@@ -14,6 +25,37 @@ class ProcessLocalSerial(ProcessorInterface):
 
         return results
 
+    def iterate(self,
+                funcs: Mapping[Hashable, Callable[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        for key, func in funcs.items():
+            yield key, func()
+
+
+def iterate_futures(submit: Callable[[Callable[P, V]], Any],
+                    funcs: Mapping[Hashable, Callable[P, V]],
+                    max_in_flight: int,
+                    ) -> Iterator[Tuple[Hashable, V]]:
+    # Yields (key, result) as concurrent futures complete, with at most max_in_flight submitted at once
+    func_items = iter(funcs.items())
+    in_flight = {}
+
+    def submit_next():
+        for key, func in func_items:
+            in_flight[submit(func)] = key
+            return
+
+    for _ in range(max(max_in_flight, 1)):
+        submit_next()
+
+    while len(in_flight) > 0:
+        done, _ = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+        for future in done:
+            key = in_flight.pop(future)
+            submit_next()
+            yield key, future.result()
+
 
 @ray.remote
 class RayWrapper(Generic[P, V]):
@@ -46,6 +88,32 @@ class ProcessLocalRay(ProcessorInterface):
         results = ray.get(tasks)
         return results
 
+    def iterate(self,
+                funcs: Mapping[Hashable, PartialInterface[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        assert ray.is_initialized() == True
+        if max_in_flight is None:
+            max_in_flight = len(funcs)
+
+        func_items = iter(funcs.items())
+        in_flight = {}
+
+        def submit_next():
+            for key, f in func_items:
+                in_flight[ray_wrapper.remote(f.func, *f.args, **f.kwargs)] = key
+                return
+
+        for _ in range(max(max_in_flight, 1)):
+            submit_next()
+
+        while len(in_flight) > 0:
+            done, _ = ray.wait(list(in_flight.keys()), num_returns=1)
+            for task in done:
+                key = in_flight.pop(task)
+                submit_next()
+                yield key, ray.get(task)
+
     def process_local_ray(self, funcs):
         assert ray.is_initialized() == True
         tasks = [f.func.remote(*f.args, **f.kwargs) for f in funcs]
@@ -57,29 +125,222 @@ def run_multiprocessing(func: PartialInterface[P, V]) -> V:
     return func()
 
 
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+def get_shared_memory_free_bytes() -> int:
+    try:
+        stat = os.statvfs(SHARED_MEMORY_DIR)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def attach_shared_array(name: str, shape, dtype: str) -> np.ndarray:
+    # The segment is mapped copy-on-write, so tasks may modify their arguments in place without affecting other
+    # tasks. The mapping is released with the array, so nothing stays attached after the task
+    file_descriptor = os.open(os.path.join(SHARED_MEMORY_DIR, name.lstrip("/")), os.O_RDONLY)
+    try:
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buffer = mmap.mmap(file_descriptor, max(size, 1), access=mmap.ACCESS_COPY)
+    finally:
+        os.close(file_descriptor)
+
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer)
+
+
+@dataclasses.dataclass()
+class SharedArrayEntry:
+    array_ref: weakref.ref
+    fingerprint: Tuple
+    count: int = 1
+    segment: Optional[shared_memory.SharedMemory] = None
+
+
+class SharedArrays:
+    # Arrays that are sent to workers more than once in a call are published to shared memory, and tasks then carry
+    # only a handle to them. Arrays are recognised by identity and a cheap fingerprint of their layout and a sample
+    # of their values, and every segment is released when the call finishes
+    def __init__(self, min_bytes: int, max_bytes: int, num_fingerprint_samples: int = 64):
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.num_fingerprint_samples = num_fingerprint_samples
+        self.entries: Dict[int, SharedArrayEntry] = {}
+        self.segments: List[shared_memory.SharedMemory] = []
+        self.shared_bytes = 0
+
+    def get_fingerprint(self, array: np.ndarray) -> Tuple:
+        sample_indexes = np.linspace(0, array.size - 1, num=min(array.size, self.num_fingerprint_samples),
+                                     dtype=np.int64)
+        return (
+            array.__array_interface__["data"][0],
+            array.shape,
+            array.strides,
+            array.dtype.str,
+            array.flat[sample_indexes].tobytes(),
+        )
+
+    def publish(self, array: np.ndarray) -> Optional[shared_memory.SharedMemory]:
+        # Leave at least half of the shared memory filesystem free for everything else
+        if (self.shared_bytes + array.nbytes > self.max_bytes) or (
+                array.nbytes > get_shared_memory_free_bytes() // 2):
+            return None
+
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+        self.segments.append(segment)
+        self.shared_bytes += array.nbytes
+        return segment
+
+    def get_handle(self, array: np.ndarray) -> Optional[Tuple[str, Tuple[int, ...], str]]:
+        if (array.dtype.hasobject) or (array.nbytes < self.min_bytes):
+            return None
+
+        fingerprint = self.get_fingerprint(array)
+        entry = self.entries.get(id(array))
+        if (entry is None) or (entry.array_ref() is not array) or (entry.fingerprint != fingerprint):
+            # Arrays only sent once are cheaper to pickle than to publish
+            self.entries[id(array)] = SharedArrayEntry(weakref.ref(array), fingerprint)
+            return None
+
+        entry.count += 1
+        if entry.segment is None:
+            entry.segment = self.publish(array)
+            if entry.segment is None:
+                return None
+
+        return entry.segment.name, array.shape, array.dtype.str
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+        self.entries = {}
+        self.shared_bytes = 0
+
+
+class SharedArrayPickler(pickle.Pickler):
+    def __init__(self, file, shared_arrays: SharedArrays):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_arrays = shared_arrays
+
+    def reducer_override(self, obj):
+        if isinstance(obj, np.ndarray):
+            handle = self.shared_arrays.get_handle(obj)
+            if handle is not None:
+                return attach_shared_array, handle
+
+        return NotImplemented
+
+
+def run_multiprocessing_pickled(func_bytes: bytes):
+    return pickle.loads(func_bytes)()
+
+
 class ProcessLocalSpawn(ProcessorInterface):
 
-    def __init__(self, n_jobs: int):
+    def __init__(self,
+                 n_jobs: int,
+                 shared_memory_min_bytes: int = 2 ** 20,
+                 shared_memory_max_bytes: int = 2 ** 32,
+                 ):
         self.n_jobs = n_jobs
+        self.shared_memory_min_bytes = shared_memory_min_bytes
+        self.shared_memory_max_bytes = shared_memory_max_bytes
+        self.pool = None
+
+    def get_pool(self):
+        # The pool is started once and kept warm for every later call
+        if self.pool is None:
+            try:
+                mp.set_start_method("spawn")
+            except Exception as e:
+                print(e)
+
+            self.pool = mp.get_context("spawn").Pool(self.n_jobs)
+            atexit.register(self.shutdown)
+
+        return self.pool
+
+    def get_shared_arrays(self) -> SharedArrays:
+        return SharedArrays(self.shared_memory_min_bytes, self.shared_memory_max_bytes)
+
+    @staticmethod
+    def dumps(func: PartialInterface[P, V], shared_arrays: SharedArrays) -> bytes:
+        f = io.BytesIO()
+        SharedArrayPickler(f, shared_arrays).dump(func)
+        return f.getvalue()
 
     def __call__(self, funcs: Iterable[PartialInterface[P, V]]) -> List[V]:
+        pool = self.get_pool()
+
+        shared_arrays = self.get_shared_arrays()
         try:
-            mp.set_start_method("spawn")
-        except Exception as e:
-            print(e)
-
-        with mp.Pool(self.n_jobs) as pool:
-            # results = pool.map(
-            #     run_multiprocessing,
-            #     funcs,
-            # )
             results = pool.map(
-                run_multiprocessing,
-                funcs,
+                run_multiprocessing_pickled,
+                [self.dumps(func, shared_arrays) for func in funcs],
             )
+        finally:
+            shared_arrays.close()
 
         return results
 
+    def iterate(self,
+                funcs: Mapping[Hashable, PartialInterface[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        pool = self.get_pool()
+        if max_in_flight is None:
+            max_in_flight = 2 * self.n_jobs
+
+        completed = queue.Queue()
+        func_items = iter(funcs.items())
+        num_in_flight = 0
+        shared_arrays = self.get_shared_arrays()
+
+        def submit_next():
+            for key, func in func_items:
+                pool.apply_async(
+                    run_multiprocessing_pickled,
+                    (self.dumps(func, shared_arrays),),
+                    callback=lambda result, _key=key: completed.put((_key, result, None)),
+                    error_callback=lambda exception, _key=key: completed.put((_key, None, exception)),
+                )
+                return 1
+            return 0
+
+        try:
+            for _ in range(max(max_in_flight, 1)):
+                num_in_flight += submit_next()
+
+            while num_in_flight > 0:
+                key, result, exception = completed.get()
+                num_in_flight -= 1
+                if exception is not None:
+                    raise exception
+                num_in_flight += submit_next()
+                yield key, result
+        finally:
+            # Tasks still in flight when iteration is abandoned may read their segments, so wait for them first
+            while num_in_flight > 0:
+                completed.get()
+                num_in_flight -= 1
+            shared_arrays.close()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        # The pool and shared memory belong to the process that created them
+        return (self.n_jobs, self.shared_memory_min_bytes, self.shared_memory_max_bytes)
+
+    def __setstate__(self, data):
+        self.__init__(*data)
+
 
 class ProcessLocalThreading(ProcessorInterface):
     def __init__(self, n_jobs: int):
@@ -96,3 +357,17 @@ class ProcessLocalThreading(ProcessorInterface):
         )
 
         return results
+
+    def iterate(self,
+                funcs: Mapping[Hashable, PartialInterface[P, V]],
+                max_in_flight: Optional[int] = None,
+                ) -> Iterator[Tuple[Hashable, V]]:
+        if max_in_flight is None:
+            max_in_flight = 2 * self.n_jobs
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            yield from iterate_futures(
+                lambda func: executor.submit(run_multiprocessing, func),
+                funcs,
+                max_in_flight,
+            )
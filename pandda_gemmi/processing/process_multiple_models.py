@@ -38,8 +38,8 @@ from pandda_gemmi.fs import PanDDAFSModel, MeanMapFile, StdMapFile
 from pandda_gemmi.dataset import (StructureFactors, Dataset, Datasets,
                                   Resolution, )
 from pandda_gemmi.shells import Shell, ShellMultipleModels
-from pandda_gemmi.edalignment import Partitioning, Xmap, XmapArray, Grid, from_unaligned_dataset_c, GetMapStatistics
-from pandda_gemmi.model import Zmap, Model, Zmaps
+from pandda_gemmi.edalignment import Xmap, XmapArray, Grid, NativeFrame, from_unaligned_dataset_c, GetMapStatistics
+from pandda_gemmi.model import Zmap, Model, Zmaps, RunningStatistics
 from pandda_gemmi.event import (
     Event, Clusterings, Clustering, Events, get_event_mask_indicies,
     save_event_map,
@@ -359,31 +359,47 @@ def get_models(
         shell_xmaps: XmapsInterface,
         grid: GridInterface,
         process_local: ProcessorInterface,
+        sigma_s_m_func: Optional[GetSigmaSMInterface] = None,
+        memmap_path: Optional[Path] = None,
 ):
+    # Mask the xmaps once for the shell, and serve each comparison set from the same array
     masked_xmap_array = XmapArray.from_xmaps(
         shell_xmaps,
         grid,
+        memmap_path=memmap_path,
     )
 
+    # Visit overlapping comparison sets consecutively so the running mean only needs the datasets that differ
+    running_statistics = RunningStatistics(masked_xmap_array)
     models = {}
-    for comparison_set_id, comparison_set_dtags in comparison_sets.items():
-        # comparison_set_dtags =
-
-        # Get the relevant dtags' xmaps
+    models_by_dtags = {}
+    for comparison_set_id in RunningStatistics.order_by_overlap(comparison_sets):
+        comparison_set_dtags = comparison_sets[comparison_set_id]
+
+        # Identical comparison sets give identical models
+        comparison_set_key = frozenset(comparison_set_dtags)
+        if comparison_set_key in models_by_dtags:
+            models[comparison_set_id] = models_by_dtags[comparison_set_key]
+            continue
+
+        # Get the relevant dtags' xmaps. This is the only per set copy of rows, and only if they are not adjacent,
+        # since the sigma_s_m solve needs them as one array
         masked_train_characterisation_xmap_array: XmapArray = masked_xmap_array.from_dtags(
             comparison_set_dtags)
-        masked_train_all_xmap_array: XmapArray = masked_xmap_array.from_dtags(
-            comparison_set_dtags + [test_dtag for test_dtag in test_dtags])
 
-        mean_array: np.ndarray = Model.mean_from_xmap_array(masked_train_characterisation_xmap_array,
-                                                            )  # Size of grid.partitioning.total_mask > 0
+        running_statistics.update(masked_train_characterisation_xmap_array.dtag_list)
+        mean_array: np.ndarray = running_statistics.mean()  # Size of grid.partitioning.total_mask > 0
         # dataset_log[constants.LOG_DATASET_MEAN] = summarise_array(mean_array)
         # update_log(dataset_log, dataset_log_path)
 
-        sigma_is: Dict[Dtag, float] = Model.sigma_is_from_xmap_array(masked_train_all_xmap_array,
+        sigma_is: Dict[Dtag, float] = Model.sigma_is_from_xmap_array(masked_train_characterisation_xmap_array,
                                                                      mean_array,
                                                                      1.5,
                                                                      )  # size of n
+        # The test datasets' rows are views into the shell array
+        for test_dtag in test_dtags:
+            if test_dtag not in sigma_is:
+                sigma_is[test_dtag] = Model.calculate_sigma_i(mean_array, masked_xmap_array[test_dtag], 1.5)
         # dataset_log[constants.LOG_DATASET_SIGMA_I] = {_dtag.dtag: float(sigma_i) for _dtag, sigma_i in sigma_is.items()}
         # update_log(dataset_log, dataset_log_path)
 
@@ -391,6 +407,7 @@ def get_models(
                                                            mean_array,
                                                            sigma_is,
                                                            process_local,
+                                                           sigma_s_m_func,
                                                            )  # size of total_mask > 0
         # dataset_log[constants.LOG_DATASET_SIGMA_S] = summarise_array(sigma_s_m)
         # update_log(dataset_log, dataset_log_path)
@@ -402,8 +419,9 @@ def get_models(
             grid,
         )
         models[comparison_set_id] = model
+        models_by_dtags[comparison_set_key] = model
 
-    return models
+    return {comparison_set_id: models[comparison_set_id] for comparison_set_id in comparison_sets}
 
 
 class ModelResult(ModelResultInterface):
@@ -474,6 +492,7 @@ def analyse_model(
     zmaps: ZmapsInterface = Zmaps.from_xmaps(
         model=model,
         xmaps={test_dtag: dataset_xmap, },
+        grid=grid,
         model_number=model_number,
         debug=debug,
     )
@@ -485,7 +504,8 @@ def analyse_model(
     model_log[constants.LOG_DATASET_Z_MAPS_TIME] = time_z_maps_finish - time_z_maps_start
     for dtag, zmap in zmaps.items():
         z_map_statistics = GetMapStatistics(
-            zmap
+            zmap,
+            grid,
         )
         model_log["ZMap statistics"] = {
             "mean": str(z_map_statistics.mean),
@@ -899,16 +919,12 @@ def process_dataset_multiple_models(
     ###################################################################
     time_output_zmap_start = time.time()
 
-    native_grid = dataset_truncated_datasets[test_dtag].reflections.transform_f_phi_to_map(
-        structure_factors.f,
-        structure_factors.phi,
-        # sample_rate=sample_rate,  # TODO: make this d_min/0.5?
-        sample_rate=dataset_truncated_datasets[test_dtag].reflections.get_resolution() / 0.5
-    )
-
-    partitioning = Partitioning.from_structure_multiprocess(
-        dataset_truncated_datasets[test_dtag].structure,
-        native_grid,
+    # The native frame FFT grid, partitioning and interpolation positions are shared by all of this dataset's maps
+    native_frame = NativeFrame.from_dataset(
+        dataset_truncated_datasets[test_dtag],
+        alignments[test_dtag],
+        grid,
+        structure_factors,
         outer_mask,
         inner_mask_symmetry,
     )
@@ -923,8 +939,9 @@ def process_dataset_multiple_models(
         structure_factors,
         outer_mask,
         inner_mask_symmetry,
-        partitioning,
+        None,
         sample_rate,
+        native_frame=native_frame,
     )
 
     # TODO: Remove altogether
@@ -933,7 +950,8 @@ def process_dataset_multiple_models(
             save_reference_frame_zmap(
                 pandda_fs_model.processed_datasets.processed_datasets[
                     test_dtag].z_map_file.path.parent / f'{model_number}_ref.ccp4',
-                model_result.zmap
+                model_result.zmap,
+                grid,
             )
             save_native_frame_zmap(
                 pandda_fs_model.processed_datasets.processed_datasets[
@@ -945,8 +963,9 @@ def process_dataset_multiple_models(
                 structure_factors,
                 outer_mask,
                 inner_mask_symmetry,
-                partitioning,
+                None,
                 sample_rate,
+                native_frame=native_frame,
             )
 
     # if statmaps:
@@ -1022,8 +1041,8 @@ def process_dataset_multiple_models(
         outer_mask,
         inner_mask_symmetry,
         sample_rate,
-        native_grid,
         mapper=ProcessLocalSerial(),
+        native_frames={test_dtag: native_frame},
     )
 
     if debug >= Debug.DATASET_MAPS:
@@ -1041,8 +1060,9 @@ def process_dataset_multiple_models(
                     structure_factors,
                     outer_mask,
                     inner_mask_symmetry,
-                    partitioning,
+                    None,
                     sample_rate,
+                    native_frame=native_frame,
                 )
 
     time_event_map_finish = time.time()
@@ -1137,6 +1157,8 @@ def process_shell_multiple_models(
         analyse_model_func: AnalyseModelInterface,
         score_events_func: GetEventScoreInterface,
         debug: Debug = Debug.DEFAULT,
+        sigma_s_m_func: Optional[GetSigmaSMInterface] = None,
+        working_resolution: Optional[float] = None,
 ):
     if debug >= Debug.DEFAULT:
         console.print_starting_process_shell(shell)
@@ -1181,8 +1203,10 @@ def process_shell_multiple_models(
     if debug >= Debug.DEFAULT:
         console.print_starting_truncating_shells()
 
-    shell_working_resolution: ResolutionInterface = Resolution(
-        max([datasets[dtag].reflections.get_resolution() for dtag in shell.all_dtags]))
+    # Shells processed as part of a group share the group's working resolution, so that their xmaps are identical
+    if working_resolution is None:
+        working_resolution = max([datasets[dtag].reflections.get_resolution() for dtag in shell.all_dtags])
+    shell_working_resolution: ResolutionInterface = Resolution(working_resolution)
     shell_truncated_datasets: DatasetsInterface = truncate(
         shell_datasets,
         resolution=shell_working_resolution,
@@ -1257,18 +1281,24 @@ def process_shell_multiple_models(
     ###################################################################
     if debug >= Debug.DEFAULT:
         console.print_starting_get_models()
+    if memory_availability == "very_low":
+        xmap_array_path = pandda_fs_model.shell_dirs.shell_dirs[shell.res].path / constants.PANDDA_XMAP_ARRAY_FILE
+    else:
+        xmap_array_path = None
     models: ModelsInterface = get_models(
         shell.test_dtags,
         shell.train_dtags,
         xmaps,
         grid,
         process_local_in_shell,
+        sigma_s_m_func,
+        xmap_array_path,
     )
 
     if debug >= Debug.PRINT_SUMMARIES:
         for model_key, model in models.items():
             save_array_to_map_file(
-                model.mean,
+                model.get_mean_array(grid),
                 grid.grid,
                 pandda_fs_model.pandda_dir / f"{shell.res}_{model_key}_mean.ccp4"
             )
@@ -1299,9 +1329,13 @@ def process_shell_multiple_models(
     dataset_dtags = {_dtag: [_dtag] + all_train_dtags for _dtag in shell.test_dtags}
     if debug >= Debug.PRINT_NUMERICS:
         print(f"\tDataset dtags are: {dataset_dtags}")
-    results: List[DatasetResultInterface] = process_local_over_datasets(
-        [
-            Partial(
+    # Each dataset's task writes its own maps and events, so only the shell log is updated here as results arrive.
+    # Autobuilding still starts once every shell has finished, since it is run over all events together
+    dataset_results: Dict[DtagInterface, DatasetResultInterface] = {}
+    shell_log[constants.LOG_SHELL_DATASET_LOGS] = {}
+    for test_dtag, result in process_local_over_datasets.iterate(
+        {
+            test_dtag: Partial(
                 process_dataset_multiple_models).paramaterise(
                 test_dtag,
                 # dataset_truncated_datasets={_dtag: shell_truncated_datasets[_dtag] for _dtag in
@@ -1336,16 +1370,13 @@ def process_shell_multiple_models(
 
             for test_dtag
             in shell.test_dtags
-        ],
-    )
-
-
-
-    # Update shell log with dataset results
-    shell_log[constants.LOG_SHELL_DATASET_LOGS] = {}
-    for result in results:
+        },
+    ):
+        # Update shell log with dataset results
         if result:
+            dataset_results[test_dtag] = result
             shell_log[constants.LOG_SHELL_DATASET_LOGS][str(result.dtag)] = result.log
+            update_log(shell_log, shell_log_path)
 
     time_shell_finish = time.time()
     shell_log[constants.LOG_SHELL_TIME] = time_shell_finish - time_shell_start
@@ -1353,7 +1384,7 @@ def process_shell_multiple_models(
 
     shell_result: ShellResultInterface = ShellResult(
         shell=shell,
-        dataset_results={dtag: result for dtag, result in zip(shell.test_dtags, results) if result},
+        dataset_results={dtag: dataset_results[dtag] for dtag in shell.test_dtags if dtag in dataset_results},
         log=shell_log,
 
     )
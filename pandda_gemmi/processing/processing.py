@@ -35,7 +35,7 @@ from pandda_gemmi.fs import PanDDAFSModel, MeanMapFile, StdMapFile
 from pandda_gemmi.dataset import (StructureFactors, Dataset, Datasets,
                                   Resolution, )
 from pandda_gemmi.shells import Shell
-from pandda_gemmi.edalignment import Partitioning, Xmap, XmapArray
+from pandda_gemmi.edalignment import Xmap, XmapArray, NativeFrame
 from pandda_gemmi.model import Zmap, Model, Zmaps
 from pandda_gemmi.event import Event, Clusterings, Clustering, Events, get_event_mask_indicies
 from pandda_gemmi.density_clustering import (
@@ -88,6 +88,8 @@ def process_dataset(
         sample_rate,
         statmaps,
         process_local=process_local_serial,
+        masked_train_xmap_array: Optional[XmapArray] = None,
+        masked_test_xmap: Optional[np.ndarray] = None,
 ):
     time_dataset_start = time.time()
 
@@ -96,13 +98,20 @@ def process_dataset(
     dataset_log[constants.LOG_DATASET_TRAIN] = [_dtag.dtag for _dtag in shell.train_dtags[0]]
     update_log(dataset_log, dataset_log_path)
 
-    masked_xmap_array = XmapArray.from_xmaps(
-        dataset_xmaps,
-        grid,
-    )
-
-    masked_train_xmap_array: XmapArray = masked_xmap_array.from_dtags(
-        [_dtag for _dtag in shell.train_dtags[0] + [test_dtag,]])
+    # The model is estimated from the training maps together with the test map. The training maps are a contiguous
+    # view of the shell array, and the test map's row is only copied in if it is not already one of them
+    if masked_train_xmap_array is None:
+        masked_train_xmap_array = XmapArray.from_xmaps(
+            dataset_xmaps,
+            grid,
+            dtags=shell.train_dtags[0],
+        )
+    if masked_test_xmap is None:
+        masked_test_xmap = XmapArray.from_xmaps(
+            {test_dtag: dataset_xmaps[test_dtag]},
+            grid,
+        )[test_dtag]
+    masked_train_xmap_array = masked_train_xmap_array.with_row(test_dtag, masked_test_xmap)
 
     ###################################################################
     # # Generate the statistical model of the dataset
@@ -145,6 +154,7 @@ def process_dataset(
     zmaps: Dict[Dtag, Zmap] = Zmaps.from_xmaps(
         model=model,
         xmaps={test_dtag: dataset_xmaps[test_dtag], },
+        grid=grid,
     )
     time_z_maps_finish = time.time()
     dataset_log[constants.LOG_DATASET_Z_MAPS_TIME] = time_z_maps_finish - time_z_maps_start
@@ -152,16 +162,11 @@ def process_dataset(
 
     zmap = zmaps[test_dtag]
 
-    native_grid = dataset_truncated_datasets[test_dtag].reflections.reflections.transform_f_phi_to_map(
-        structure_factors.f,
-        structure_factors.phi,
-        # sample_rate=sample_rate,  # TODO: make this d_min/0.5?
-        sample_rate=dataset_truncated_datasets[test_dtag].reflections.resolution().resolution / 0.5
-    )
-
-    partitioning = Partitioning.from_structure_multiprocess(
-        dataset_truncated_datasets[test_dtag].structure,
-        native_grid,
+    native_frame = NativeFrame.from_dataset(
+        dataset_truncated_datasets[test_dtag],
+        alignments[test_dtag],
+        grid,
+        structure_factors,
         outer_mask,
         inner_mask_symmetry,
     )
@@ -176,8 +181,9 @@ def process_dataset(
         structure_factors,
         outer_mask,
         inner_mask_symmetry,
-        partitioning,
+        None,
         sample_rate,
+        native_frame=native_frame,
     )
 
     # for dtag in zmaps:
@@ -476,8 +482,8 @@ def process_dataset(
         outer_mask,
         inner_mask_symmetry,
         sample_rate,
-        native_grid,
         mapper=ProcessLocalSerial(),
+        native_frames={test_dtag: native_frame},
     )
 
     time_event_map_finish = time.time()
@@ -580,6 +586,27 @@ def process_shell(
     shell_log[constants.LOG_SHELL_XMAP_TIME] = time_xmaps_finish - time_xmaps_start
     update_log(shell_log, shell_log_path)
 
+    # Get the datasets each test dataset is compared against
+    all_train_dtags_unmerged = [_dtag for l in shell.train_dtags.values() for _dtag in l]
+    all_train_dtags = []
+    for _dtag in all_train_dtags_unmerged:
+        if _dtag not in all_train_dtags:
+            all_train_dtags.append(_dtag)
+
+    # Mask the xmaps once for the whole shell, with the training maps adjacent so they can be served as a view
+    if memory_availability == "very_low":
+        xmap_array_path = pandda_fs_model.shell_dirs.shell_dirs[shell.res].path / constants.PANDDA_XMAP_ARRAY_FILE
+    else:
+        xmap_array_path = None
+    masked_xmap_array = XmapArray.from_xmaps(
+        xmaps,
+        grid,
+        dtags=all_train_dtags + [_dtag for _dtag in shell.test_dtags if _dtag not in all_train_dtags],
+        memmap_path=xmap_array_path,
+    )
+    # Made once so every dataset's task refers to the same view of the training rows
+    masked_train_xmap_array = masked_xmap_array.from_dtags(shell.train_dtags[0])
+
     ###################################################################
     # # Process each test dataset
     ###################################################################
@@ -616,23 +643,13 @@ def process_shell(
         process_local=process_local_in_dataset,
     )
 
-    # Process each dataset in the shell
-    all_train_dtags_unmerged = [_dtag for l in shell.train_dtags.values() for _dtag in l]
-    all_train_dtags = []
-    for _dtag in all_train_dtags_unmerged:
-        if _dtag not in all_train_dtags:
-            all_train_dtags.append(_dtag)
-
-    dataset_dtags = {_dtag: [_dtag] + all_train_dtags for _dtag in shell.test_dtags}
-
     results = process_local_over_datasets(
         [
             Partial(
                 process_dataset).paramaterise(
                 test_dtag,
-                dataset_truncated_datasets={_dtag: shell_truncated_datasets[_dtag] for _dtag in
-                                            dataset_dtags[test_dtag]},
-                dataset_xmaps={_dtag: xmaps[_dtag] for _dtag in dataset_dtags[test_dtag]},
+                dataset_truncated_datasets={test_dtag: shell_truncated_datasets[test_dtag]},
+                dataset_xmaps={test_dtag: xmaps[test_dtag]},
                 shell=shell,
                 alignments=alignments,
                 pandda_fs_model=pandda_fs_model,
@@ -651,6 +668,8 @@ def process_shell(
                 sample_rate=sample_rate,
                 statmaps=statmaps,
                 process_local=process_local_in_dataset,
+                masked_train_xmap_array=masked_train_xmap_array,
+                masked_test_xmap=masked_xmap_array[test_dtag],
             )
             for test_dtag
             in shell.test_dtags
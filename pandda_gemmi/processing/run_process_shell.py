@@ -1,11 +1,34 @@
+import os
+import zlib
 import pickle
 
+import numpy as np
 import fire
 
 
+def get_buffer_path(path, j):
+    return f"{path}.{j}.buffer"
+
+
+def load_buffer(path):
+    # Memory map large arrays copy on write, so they are paged in as they are used but can still be modified
+    if os.path.getsize(path) == 0:
+        return bytearray()
+    return np.memmap(path, dtype=np.uint8, mode="c")
+
+
 def path_to_obj(path):
     with open(path, "rb") as f:
-        obj = pickle.load(f)
+        data = f.read()
+    if str(path).endswith(".z"):
+        data = zlib.decompress(data)
+
+    # Objects from an argument store may keep their large buffers in separate files
+    buffers = []
+    while os.path.exists(get_buffer_path(path, len(buffers))):
+        buffers.append(load_buffer(get_buffer_path(path, len(buffers))))
+
+    obj = pickle.loads(data, buffers=buffers)
 
     return obj
 
@@ -36,8 +59,11 @@ def run(func_path, output_path, *arg_paths, **kwarg_paths):
 
     print(f"Ran function: Pickeling results...")
 
-    with open(output_path, "wb") as f:
+    # Write then move, so the result only appears once it is complete
+    tmp_output_path = f"{output_path}.tmp"
+    with open(tmp_output_path, "wb") as f:
         pickle.dump(result, f)
+    os.replace(tmp_output_path, output_path)
 
     print(f"Pickeled results! Returning!")
 
@@ -1,2 +1,4 @@
 from pandda_gemmi.shells.shells import Shell, Shells
-from pandda_gemmi.shells.shells_multiple_models import ShellMultipleModels, ShellsMultipleModels, get_shells_multiple_models
+from pandda_gemmi.shells.shells_multiple_models import (ShellMultipleModels, ShellsMultipleModels,
+                                                        get_shells_multiple_models, get_shell_working_resolution,
+                                                        get_shell_groups, get_shell_working_resolutions)
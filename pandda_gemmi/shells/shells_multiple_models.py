@@ -146,6 +146,53 @@ def get_shells_multiple_models(
     return shells
 
 
+def get_shell_working_resolution(shell: ShellMultipleModels, datasets: DatasetsInterface) -> float:
+    return max([datasets[dtag].reflections.get_resolution() for dtag in shell.all_dtags])
+
+
+def get_shell_groups(
+        shells: Dict[float, ShellMultipleModels],
+        datasets: DatasetsInterface,
+        max_resolution_difference: float,
+) -> List[List[float]]:
+    # Group shells that share training datasets and whose working resolutions are within max_resolution_difference
+    # of the finest in the group, so that they can all be processed at the coarsest one
+    working_resolutions = {res: get_shell_working_resolution(shell, datasets) for res, shell in shells.items()}
+
+    groups = []
+    groups_train_dtags = []
+    for res in sorted(shells, key=lambda _res: working_resolutions[_res]):
+        train_dtags = {dtag for dtags in shells[res].train_dtags.values() for dtag in dtags}
+
+        for group, group_train_dtags in zip(groups, groups_train_dtags):
+            if working_resolutions[res] - working_resolutions[group[0]] > max_resolution_difference:
+                continue
+            if len(train_dtags.intersection(group_train_dtags)) == 0:
+                continue
+            group.append(res)
+            group_train_dtags.update(train_dtags)
+            break
+        else:
+            groups.append([res, ])
+            groups_train_dtags.append(train_dtags)
+
+    return groups
+
+
+def get_shell_working_resolutions(
+        shells: Dict[float, ShellMultipleModels],
+        datasets: DatasetsInterface,
+        shell_groups: List[List[float]],
+) -> Dict[float, float]:
+    working_resolutions = {}
+    for group in shell_groups:
+        group_working_resolution = max([get_shell_working_resolution(shells[res], datasets) for res in group])
+        for res in group:
+            working_resolutions[res] = group_working_resolution
+
+    return working_resolutions
+
+
 @dataclasses.dataclass()
 class ShellsMultipleModels:
     shells: typing.Dict[int, ShellMultipleModels]
@@ -0,0 +1,40 @@
+import time
+
+import fire
+import numpy as np
+import gemmi
+
+from pandda_gemmi.common import fractional_to_orthogonal
+
+
+def orthogonalize_per_point(unit_cell, fractional_array):
+    positions_orthogonal = [unit_cell.orthogonalize(gemmi.Fractional(fractional[0],
+                                                                     fractional[1],
+                                                                     fractional[2],
+                                                                     )) for fractional in
+                            fractional_array]
+    return np.array([[position.x, position.y, position.z] for position in positions_orthogonal])
+
+
+def speed_fractional_to_orthogonal(num_points_list=(10 ** 5, 10 ** 6), seed=0):
+    unit_cell = gemmi.UnitCell(78.0, 92.0, 110.0, 90.0, 103.0, 90.0)
+    rng = np.random.default_rng(seed)
+
+    for num_points in num_points_list:
+        fractional_array = rng.uniform(-0.5, 1.5, (num_points, 3))
+
+        start = time.time()
+        per_point = orthogonalize_per_point(unit_cell, fractional_array)
+        per_point_time = time.time() - start
+
+        start = time.time()
+        vectorised = fractional_to_orthogonal(unit_cell, fractional_array)
+        vectorised_time = time.time() - start
+
+        max_difference = np.max(np.abs(per_point - vectorised))
+        print(f"{num_points} points: per point {per_point_time}s, vectorised {vectorised_time}s, "
+              f"max difference {max_difference}")
+
+
+if __name__ == "__main__":
+    fire.Fire(speed_fractional_to_orthogonal)
@@ -0,0 +1,43 @@
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+import gemmi
+
+from pandda_gemmi.dataset import Structure
+from pandda_gemmi.edalignment import Partitioning
+
+
+def speed_partitioning(pdb_file, grid_spacing=0.5, mask_radius=6.0, mask_radius_symmetry=3.0):
+    structure = Structure.from_file(Path(pdb_file))
+    unit_cell = structure.structure.cell
+
+    grid = gemmi.FloatGrid(
+        int(np.ceil(unit_cell.a / grid_spacing)),
+        int(np.ceil(unit_cell.b / grid_spacing)),
+        int(np.ceil(unit_cell.c / grid_spacing)),
+    )
+    grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+    grid.set_unit_cell(unit_cell)
+
+    start = time.time()
+    partitioning = Partitioning.from_structure(structure, grid, mask_radius, mask_radius_symmetry)
+    partitioning_time = time.time() - start
+    print(f"Grid {[grid.nu, grid.nv, grid.nw]}: partitioned {partitioning.points.shape[0]} points into "
+          f"{len(partitioning)} residues in {partitioning_time}s")
+
+    start = time.time()
+    position_list = Partitioning.get_position_list(partitioning.protein_mask, partitioning.points)
+    per_point_time = time.time() - start
+
+    start = time.time()
+    position_array = Partitioning.get_position_array(partitioning.protein_mask, partitioning.points)
+    vectorised_time = time.time() - start
+
+    max_difference = np.max(np.abs(np.array(position_list).reshape((-1, 3)) - position_array))
+    print(f"Positions: per point {per_point_time}s, vectorised {vectorised_time}s, max difference {max_difference}")
+
+
+if __name__ == "__main__":
+    fire.Fire(speed_partitioning)
@@ -0,0 +1,32 @@
+import time
+import tempfile
+from pathlib import Path
+
+import fire
+
+from pandda_gemmi.common import Partial
+from pandda_gemmi.processing.process_global import DistributedProcessor
+
+
+def speed_qsub_scheduler(num_tasks=20, task_time=2.0, min_poll_interval=1.0, max_poll_interval=60.0):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        processor = DistributedProcessor(Path(tmp_dir), scheduler="LOCAL")
+        processor.client.min_poll_interval = min_poll_interval
+        processor.client.max_poll_interval = max_poll_interval
+
+        funcs = [Partial(time.sleep).paramaterise(task_time) for _ in range(num_tasks)]
+
+        start = time.time()
+        processor(funcs)
+        gather_time = time.time() - start
+
+        start = time.time()
+        for _ in processor.iterate({j: func for j, func in enumerate(funcs)}, max_in_flight=num_tasks // 2):
+            pass
+        iterate_time = time.time() - start
+
+        print(f"{num_tasks} tasks of {task_time}s: gather {gather_time}s, iterate {iterate_time}s")
+
+
+if __name__ == "__main__":
+    fire.Fire(speed_qsub_scheduler)
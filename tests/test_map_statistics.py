@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import numpy as np
+import gemmi
+
+from pandda_gemmi.common import Dtag
+from pandda_gemmi.edalignment import Xmap, GetMapStatistics
+from pandda_gemmi.model import Model, Zmaps
+
+
+def get_test_xmap_and_grid(shape=(24, 28, 32), seed=0):
+    rng = np.random.default_rng(seed)
+    total_mask = (rng.random(shape) < 0.3).astype(np.int8)
+    grid = SimpleNamespace(partitioning=SimpleNamespace(total_mask=total_mask))
+
+    xmap_grid = gemmi.FloatGrid(*shape)
+    xmap_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+    xmap_grid.set_unit_cell(gemmi.UnitCell(30.0, 35.0, 40.0, 90.0, 90.0, 90.0))
+    xmap_array = np.array(xmap_grid, copy=False)
+    xmap_array[total_mask == 1] = rng.normal(0.0, 1.0, int(np.sum(total_mask))).astype(np.float32)
+
+    return Xmap(xmap_grid), grid
+
+
+def test_z_map_statistics_from_zmap():
+    # Mirrors the z-map statistics step of analyse_model
+    xmap, grid = get_test_xmap_and_grid()
+    dtag = Dtag("test")
+    num_points = int(np.sum(grid.partitioning.total_mask))
+    model = Model.from_mean_is_sms(
+        np.zeros(num_points, dtype=np.float32),
+        {dtag: 0.5},
+        np.ones(num_points, dtype=np.float32),
+        grid,
+    )
+
+    zmaps = Zmaps.from_xmaps(model=model, xmaps={dtag: xmap}, grid=grid)
+    for _dtag, zmap in zmaps.items():
+        z_map_statistics = GetMapStatistics(zmap, grid)
+
+        array = zmap.to_array(grid)
+        assert np.isclose(z_map_statistics.mean, np.mean(array[array > 0]))
+        assert np.isclose(z_map_statistics.std, np.std(array[array > 0]))
+        assert z_map_statistics.greater_1 == array[array > 1.0].size
+        assert z_map_statistics.greater_2 == array[array > 2.0].size
+        assert z_map_statistics.greater_3 == array[array > 3.0].size
+
+
+def test_map_statistics_from_xmap():
+    xmap, grid = get_test_xmap_and_grid(seed=1)
+
+    map_statistics = GetMapStatistics(xmap)
+
+    array = xmap.to_array()
+    assert map_statistics.greater_1 == array[array > 1.0].size
@@ -0,0 +1,43 @@
+import numpy as np
+
+from pandda_gemmi.model import GetSigmaSMBisect, GetSigmaSMNewton, GetSigmaSMRoot
+
+
+def process_serial(funcs):
+    return [func() for func in funcs]
+
+
+def get_test_arrays(num_datasets=30, num_points=500, seed=0):
+    rng = np.random.default_rng(seed)
+    sigma_is_array = rng.uniform(0.3, 1.0, (num_datasets, 1)).astype(np.float32)
+    sigma_s_ms = rng.uniform(0.0, 2.0, num_points)
+    arrays = rng.normal(0.0, 1.0, (num_datasets, num_points)) * np.sqrt(
+        np.square(sigma_is_array) + np.square(sigma_s_ms))
+    arrays = arrays.astype(np.float32)
+    mean = np.mean(arrays, axis=0)
+
+    return mean, arrays, sigma_is_array
+
+
+def test_sigma_s_m_newton_matches_root():
+    mean, arrays, sigma_is_array = get_test_arrays()
+
+    sigma_s_m_newton = GetSigmaSMNewton()(mean, arrays, sigma_is_array, process_serial)
+    sigma_s_m_root = GetSigmaSMRoot()(mean, arrays, sigma_is_array, process_serial)
+
+    # Points with no root in the bracket are set to zero by the vectorised solvers
+    has_root = sigma_s_m_newton > 0
+    assert np.sum(has_root) > 0.5 * mean.shape[0]
+    assert np.allclose(sigma_s_m_newton[has_root], sigma_s_m_root[has_root], rtol=1e-4, atol=1e-4)
+
+
+def test_sigma_s_m_newton_matches_bisect():
+    mean, arrays, sigma_is_array = get_test_arrays(num_points=5000, seed=1)
+
+    sigma_s_m_newton = GetSigmaSMNewton()(mean, arrays, sigma_is_array, process_serial)
+    sigma_s_m_bisect = GetSigmaSMBisect()(mean, arrays, sigma_is_array, process_serial)
+
+    assert sigma_s_m_newton.shape == sigma_s_m_bisect.shape
+    assert np.array_equal(sigma_s_m_newton == 0, sigma_s_m_bisect == 0)
+    assert np.allclose(sigma_s_m_newton, sigma_s_m_bisect, atol=1e-4)
+